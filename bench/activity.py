@@ -0,0 +1,82 @@
+"""
+PRIYA AI BOT - MESSAGE ACTIVITY BENCHMARK
+Counts the SQL statements and time one chat message costs for its
+counters, XP and coins, followed by the profile read the handler does.
+The legacy path (a counter UPDATE, add_xp and add_coins in one write,
+then a reload of the evicted user) is compared with the activity
+aggregator, whose flushes are amortised over the whole run.
+
+Usage:
+    python bench/activity.py
+    python bench/activity.py --users 500 --messages 20
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+from common import load_bot, make_users
+
+LEGACY_INCREMENT = """
+    UPDATE users
+    SET daily_requests = daily_requests + 1,
+        total_requests = total_requests + 1,
+        last_request_date=?
+    WHERE user_id=?
+"""
+
+def trace_all_connections(bot, statements):
+    """Count statements on the writer and on every pooled reader"""
+    def trace(sql):
+        statements[0] += 1
+    connect = bot.db._connect
+    def traced_connect():
+        connection = connect()
+        connection.set_trace_callback(trace)
+        return connection
+    bot.db._connect = traced_connect
+    bot.db._writer.set_trace_callback(trace)
+    with bot.db._idle_lock:
+        for connection in bot.db._idle:
+            connection.set_trace_callback(trace)
+
+def legacy_message(bot, user_id):
+    today = datetime.now().strftime("%Y-%m-%d")
+    with bot.db.write() as cur:
+        cur.execute(LEGACY_INCREMENT, (today, user_id))
+        bot.level_manager.add_xp(user_id, 10)
+        bot.coin_manager.add_coins(user_id, 5, "daily_message")
+    return bot.get_user(user_id)
+
+def aggregated_message(bot, user_id):
+    bot.activity_aggregator.record(user_id)
+    return bot.get_user(user_id)
+
+def measure(bot, label, users, messages, statements, handle):
+    before = statements[0]
+    started = time.perf_counter()
+    for _ in range(messages):
+        for user_id in users:
+            handle(bot, user_id)
+    bot.activity_aggregator.flush()
+    elapsed = time.perf_counter() - started
+    count = len(users) * messages
+    print(f"  {label:<12} {(statements[0] - before) / count:6.2f} statements/message  {elapsed / count * 1e6:7.1f} us/message")
+
+def main():
+    parser = argparse.ArgumentParser(description="Statements and time per message for message activity")
+    parser.add_argument("--users", type=int, default=200, help="users sending messages")
+    parser.add_argument("--messages", type=int, default=10, help="messages per user")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    users = make_users(bot, args.users)
+    statements = [0]
+    trace_all_connections(bot, statements)
+
+    print(f"{args.users} users x {args.messages} messages, flush every {bot.activity_aggregator.flush_threshold} events")
+    measure(bot, "legacy", users, args.messages, statements, legacy_message)
+    measure(bot, "aggregated", users, args.messages, statements, aggregated_message)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+PRIYA AI BOT - CACHE CODEC BENCHMARK
+Encodes and decodes real cache payload shapes with each cache codec and
+reports the encoded size and the time per call.
+
+Usage:
+    python bench/codecs.py
+    python bench/codecs.py --iterations 50000
+"""
+
+import argparse
+
+from common import load_bot, best_of, make_users
+
+def main():
+    parser = argparse.ArgumentParser(description="Size and speed of the cache codecs")
+    parser.add_argument("--iterations", type=int, default=20000, help="encode/decode calls per measurement")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    user_id, = make_users(bot, 1)
+    # The users row as _load_user caches it, which also registers its shape
+    with bot.db.read() as cur:
+        user = dict(cur.one("users.get", (user_id,)))
+    bot.row_codec.register(user)
+    memory = [
+        {"role": "user" if n % 2 == 0 else "assistant", "content": f"message {n} " + "kya haal hai bestie " * 5}
+        for n in range(20)
+    ]
+
+    codecs = [bot.JsonCodec(), bot.MarshalCodec(), bot.row_codec]
+    payloads = [(f"users row ({len(user)} cols)", user), (f"memory, {len(memory)} entries", memory)]
+
+    print(f"{'payload':<22} {'codec':<8} {'bytes':>6} {'encode':>10} {'decode':>10}")
+    for label, value in payloads:
+        for codec in codecs:
+            try:
+                data = codec.encode(value)
+            except (ValueError, TypeError):
+                continue
+            assert codec.decode(data) == value
+            encode = best_of(lambda: codec.encode(value), number=args.iterations)
+            decode = best_of(lambda: codec.decode(data), number=args.iterations)
+            name = type(codec).__name__.replace("Codec", "").lower()
+            print(f"{label:<22} {name:<8} {len(data):>6} {encode * 1e6:>8.1f}us {decode * 1e6:>8.1f}us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+PRIYA AI BOT - BENCHMARK HELPERS
+bot.py opens its database at import time, so every benchmark points
+DATABASE_PATH at a scratch file before importing it.
+"""
+
+import os
+import sys
+import time
+import logging
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_bot(db_path=None, **env):
+    """Import bot.py against a scratch database; extra env vars apply first"""
+    os.environ["DATABASE_PATH"] = db_path or os.path.join(tempfile.mkdtemp(prefix="bot-bench-"), "bench.db")
+    os.environ.update({key: str(value) for key, value in env.items()})
+    sys.path.insert(0, ROOT)
+    logging.disable(logging.WARNING)
+    import bot
+    return bot
+
+def best_of(func, repeat=5, number=1):
+    """Fastest of `repeat` runs, in seconds per call"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+def make_users(bot, count, prefix="bench"):
+    """Create `count` users; returns their internal ids"""
+    return [
+        bot.create_user(800000000 + n, f"{prefix}{n}", "Bench", str(n))
+        for n in range(count)
+    ]
@@ -0,0 +1,71 @@
+"""
+PRIYA AI BOT - GROUP COMMIT BENCHMARK
+Counts commits per chat message for the writes handle_text makes: the
+user message, the activity record, then the reply and badge check in
+one unit of work. Runs them as direct calls, through the executor one
+message at a time, and with many messages in flight, for each
+durability mode.
+
+Usage:
+    python bench/group_commit.py
+    python bench/group_commit.py --users 200 --window-ms 5
+"""
+
+import asyncio
+import argparse
+import time
+
+from common import load_bot, make_users
+
+def turn_direct(bot, user_id):
+    bot.save_msg(user_id, "user", "hi")
+    bot.activity_aggregator.record(user_id)
+    bot.save_msg(user_id, "assistant", "hello")
+    bot.badge_manager.check_and_award(user_id)
+
+async def turn(bot, executor, user_id):
+    await executor.write(bot.save_msg, user_id, "user", "hi")
+    await executor.read(bot.activity_aggregator.record, user_id)
+    uow = bot.UnitOfWork(executor)
+    uow.add(bot.save_msg, user_id, "assistant", "hello")
+    uow.add(bot.badge_manager.check_and_award, user_id)
+    await uow.commit()
+
+def measure(bot, label, users, run):
+    commits = bot.db.stats['commits']
+    started = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started
+    # Land the batched activity so its commits are counted too
+    bot.activity_aggregator.flush()
+    per_message = (bot.db.stats['commits'] - commits) / len(users)
+    print(f"  {label:<28} {per_message:6.2f} commits/message  {len(users) / elapsed:8.0f} messages/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Commits per chat message with and without group commit")
+    parser.add_argument("--users", type=int, default=50, help="users sending one message each per run")
+    parser.add_argument("--window-ms", type=float, default=5, help="group commit window")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    users = make_users(bot, args.users)
+
+    print(f"{args.users} users, one chat turn each")
+    measure(bot, "direct sync calls", users, lambda: [turn_direct(bot, u) for u in users])
+
+    for durability in ("full", "group"):
+        executor = bot.DbExecutor(durability=durability, window_ms=args.window_ms)
+
+        async def serial():
+            for user_id in users:
+                await turn(bot, executor, user_id)
+
+        async def concurrent():
+            await asyncio.gather(*(turn(bot, executor, user_id) for user_id in users))
+
+        measure(bot, f"{durability}, serial", users, lambda: asyncio.run(serial()))
+        measure(bot, f"{durability}, {len(users)} in flight", users, lambda: asyncio.run(concurrent()))
+        executor.close()
+
+if __name__ == "__main__":
+    main()
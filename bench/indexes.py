@@ -0,0 +1,87 @@
+"""
+PRIYA AI BOT - HOT-PATH INDEX BENCHMARK
+Fills a scratch database with synthetic users and times the hot-path
+queries with the indexes of migration 0001 dropped, then rebuilt.
+
+Usage:
+    python bench/indexes.py                  # 1M users
+    python bench/indexes.py --users 100000
+"""
+
+import re
+import random
+import sqlite3
+import argparse
+import time
+
+from common import load_bot, best_of
+
+def populate(connection, count, seed=1):
+    rng = random.Random(seed)
+    now = int(time.time())
+    connection.execute("BEGIN")
+    connection.executemany(
+        "INSERT INTO users (user_id, telegram_id, username, first_name, role, created_at, last_request_date) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            (f"u{n:08d}", str(100000000 + n), f"user{n}", "Bench",
+             "admin" if n % 100000 == 0 else "user",
+             now - rng.randrange(365 * 86400), None)
+            for n in range(count)
+        )
+    )
+    connection.executemany(
+        "INSERT INTO user_levels (user_id, total_xp, created_at) VALUES (?, ?, ?)",
+        ((f"u{n:08d}", rng.randrange(1000000), now) for n in range(count))
+    )
+    connection.execute("COMMIT")
+
+def main():
+    parser = argparse.ArgumentParser(description="Time hot-path queries with and without the migration 0001 indexes")
+    parser.add_argument("--users", type=int, default=1000000, help="synthetic users to create")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per query; the fastest counts")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    version, _, steps = bot.MIGRATIONS[0]
+    assert version == "0001"
+    creates = [step for step in steps if step.startswith("CREATE INDEX")]
+    names = [re.search(r"EXISTS (\w+)", step).group(1) for step in creates]
+
+    connection = sqlite3.connect(bot.DATABASE_PATH, isolation_level=None)
+    started = time.perf_counter()
+    populate(connection, args.users)
+    print(f"Created {args.users} users in {time.perf_counter() - started:.1f}s")
+
+    middle = f"u{args.users // 2:08d}"
+    hot = [
+        ("find_user_by_username", "users.by_username", (f"user{args.users // 2}",)),
+        ("recent users (admin)", "admin.recent_users_limited", (10,)),
+        ("leaderboard top 10", "games.leaderboard", (10,)),
+        ("rank", "games.rank", (middle,)),
+        ("load_admins", "admin.admin_ids", ()),
+    ]
+
+    def timings():
+        return {
+            label: best_of(lambda: connection.execute(bot.queries.sql(name), params).fetchall(), args.repeat)
+            for label, name, params in hot
+        }
+
+    for name in names:
+        connection.execute(f"DROP INDEX IF EXISTS {name}")
+    without = timings()
+
+    started = time.perf_counter()
+    for step in creates:
+        connection.execute(step)
+    build = time.perf_counter() - started
+    indexed = timings()
+
+    for label, _, _ in hot:
+        print(f"  {label:<24} {without[label] * 1000:9.2f} ms -> {indexed[label] * 1000:7.2f} ms")
+    print(f"Building the indexes took {build:.1f}s")
+    connection.close()
+
+if __name__ == "__main__":
+    main()
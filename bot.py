@@ -6,6 +6,7 @@ Author: Subojeet Mandal
 """
 
 import os
+import sys
 import time
 import asyncio
 import httpx
@@ -20,17 +21,28 @@ import hashlib
 import hmac
 import pickle
 import sqlite3
+import zlib
+import marshal
+import struct
+import heapq
 import shutil
 import logging
 import uuid
 import csv
+import queue
+import atexit
+import bisect
 from datetime import datetime, timedelta
 from io import BytesIO, StringIO
-from functools import wraps
+from functools import wraps, partial
+from contextlib import contextmanager
 from typing import Dict, List, Optional, Any, Tuple, Union
 from enum import Enum
 from dataclasses import dataclass, asdict
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace, MappingProxyType
+from zoneinfo import ZoneInfo
 
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify, render_template, session, redirect, url_for, flash, make_response
@@ -62,6 +74,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class StartupTimer:
+    """Record how long each startup phase takes"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + (time.perf_counter() - started) * 1000
+
+    def report(self):
+        """Log the breakdown since process start"""
+        total = (time.perf_counter() - self.started) * 1000
+        breakdown = ", ".join(f"{name} {ms:.1f}ms" for name, ms in self.phases.items())
+        logger.info(f"⏱️ Startup {total:.1f}ms ({breakdown})")
+
+startup_timer = StartupTimer()
+
 # Environment
 ENV = os.getenv("ENVIRONMENT", "production")
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # Single bot token
@@ -103,12 +138,546 @@ OPENROUTER_KEYS = [key for key in OPENROUTER_KEYS if key and key != "key1_here"]
 
 # ==================== DATABASE SETUP ====================
 
-conn = sqlite3.connect("superbase.db", check_same_thread=False)
-conn.row_factory = sqlite3.Row
-cur = conn.cursor()
+DATABASE_PATH = os.getenv("DATABASE_PATH", "superbase.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+@dataclass
+class StorageProfile:
+    """SQLite tuning applied to every pooled connection"""
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size: int = -16000  # Negative values are KiB
+    mmap_size: int = 256 * 1024 * 1024
+    temp_store: str = "MEMORY"
+    busy_timeout: int = 5000  # Milliseconds
+    wal_autocheckpoint: int = 1000  # Pages; disabled while the checkpointer runs
+    checkpoint_interval: int = 30  # Seconds between background checkpoints
+    checkpoint_restart_bytes: int = 64 * 1024 * 1024  # WAL size that asks for a RESTART checkpoint
+    checkpoint_busy_timeout: int = 100  # Milliseconds a RESTART may wait for readers
+    journal_size_limit: int = 16 * 1024 * 1024  # WAL bytes kept on disk after it restarts
+    statement_cache_size: int = 256  # Prepared statements kept per connection
+
+    @classmethod
+    def from_env(cls):
+        """Build profile from DB_* environment variables"""
+        defaults = cls()
+        return cls(
+            journal_mode=os.getenv("DB_JOURNAL_MODE", defaults.journal_mode),
+            synchronous=os.getenv("DB_SYNCHRONOUS", defaults.synchronous),
+            cache_size=int(os.getenv("DB_CACHE_SIZE", defaults.cache_size)),
+            mmap_size=int(os.getenv("DB_MMAP_SIZE", defaults.mmap_size)),
+            temp_store=os.getenv("DB_TEMP_STORE", defaults.temp_store),
+            busy_timeout=int(os.getenv("DB_BUSY_TIMEOUT", defaults.busy_timeout)),
+            wal_autocheckpoint=int(os.getenv("DB_WAL_AUTOCHECKPOINT", defaults.wal_autocheckpoint)),
+            checkpoint_interval=int(os.getenv("DB_CHECKPOINT_INTERVAL", defaults.checkpoint_interval)),
+            checkpoint_restart_bytes=int(os.getenv("DB_CHECKPOINT_RESTART_BYTES", defaults.checkpoint_restart_bytes)),
+            checkpoint_busy_timeout=int(os.getenv("DB_CHECKPOINT_BUSY_TIMEOUT", defaults.checkpoint_busy_timeout)),
+            journal_size_limit=int(os.getenv("DB_JOURNAL_SIZE_LIMIT", defaults.journal_size_limit)),
+            statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", defaults.statement_cache_size))
+        )
+
+    def connection_pragmas(self):
+        """Per-connection PRAGMA statements"""
+        return [
+            "PRAGMA foreign_keys = ON",
+            f"PRAGMA synchronous = {self.synchronous}",
+            f"PRAGMA cache_size = {self.cache_size}",
+            f"PRAGMA mmap_size = {self.mmap_size}",
+            f"PRAGMA temp_store = {self.temp_store}",
+            f"PRAGMA busy_timeout = {self.busy_timeout}",
+            f"PRAGMA wal_autocheckpoint = {self.wal_autocheckpoint}",
+            f"PRAGMA journal_size_limit = {self.journal_size_limit}"
+        ]
+
+DB_QUERY_SAMPLES = int(os.getenv("DB_QUERY_SAMPLES", "1024"))
+QUERY_STATS_PATH = os.getenv("QUERY_STATS_PATH")  # Dump query statistics here on shutdown
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "0"))  # 0 disables the slow-query log
+
+class QueryRegistry:
+    """Named SQL statements with per-query timing.
+
+    Every runtime statement is registered once under a dotted name and run
+    through ``QueryCursor``, so the text passed to SQLite is identical on
+    every call and hits the connection's prepared statement cache. Calls,
+    total and p99 latency and rows returned (or changed, for writes) are
+    recorded per name.
+    """
+
+    def __init__(self, samples=1024, slow_query_ms=0):
+        self.samples = samples
+        self.slow_query_ms = slow_query_ms
+        self.statements = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, statements):
+        """Register a mapping of query name to SQL"""
+        for name, sql in statements.items():
+            if self.statements.get(name, sql) != sql:
+                raise ValueError(f"Query {name} is already registered with different SQL")
+            self.statements[name] = sql
+
+    def sql(self, name):
+        """SQL text for a registered query"""
+        try:
+            return self.statements[name]
+        except KeyError:
+            raise KeyError(f"Unknown query: {name}") from None
+
+    def record(self, name, elapsed, rows, failed=False):
+        """Record one execution of a query"""
+        with self._lock:
+            entry = self._stats.get(name)
+            if entry is None:
+                entry = self._stats[name] = {
+                    "calls": 0,
+                    "errors": 0,
+                    "slow": 0,
+                    "rows": 0,
+                    "total": 0.0,
+                    "samples": deque(maxlen=self.samples)
+                }
+            entry['calls'] += 1
+            entry['rows'] += rows
+            entry['total'] += elapsed
+            entry['samples'].append(elapsed)
+            if failed:
+                entry['errors'] += 1
+            if self.slow_query_ms and elapsed * 1000 >= self.slow_query_ms:
+                entry['slow'] += 1
+
+    def log_slow(self, name, elapsed, params):
+        """Log a statement that exceeded the slow-query threshold"""
+        shown = repr(params)
+        if len(shown) > 200:
+            # executemany() batches
+            shown = f"{shown[:200]}... ({len(params)} sets)"
+        logger.warning(f"🐢 Slow query {name} took {elapsed * 1000:.1f}ms in {self.caller()} params={shown}")
+
+    @staticmethod
+    def caller():
+        """Qualified name of the first function outside the query layer"""
+        frame = sys._getframe(1)
+        while frame and frame.f_code.co_filename == __file__ and frame.f_code.co_qualname.startswith(("QueryCursor.", "QueryRegistry.")):
+            frame = frame.f_back
+        if frame is None:
+            return "unknown"
+        return f"{frame.f_code.co_qualname}:{frame.f_lineno}"
+
+    def snapshot(self, sort_by="total_ms", limit=None):
+        """Per-query statistics, heaviest first"""
+        with self._lock:
+            items = [(name, dict(entry), sorted(entry['samples'])) for name, entry in self._stats.items()]
+        
+        result = []
+        for name, entry, samples in items:
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] if samples else 0.0
+            result.append({
+                "name": name,
+                "calls": entry['calls'],
+                "errors": entry['errors'],
+                "slow": entry['slow'],
+                "rows": entry['rows'],
+                "total_ms": round(entry['total'] * 1000, 3),
+                "avg_ms": round(entry['total'] * 1000 / entry['calls'], 3),
+                "p99_ms": round(p99 * 1000, 3)
+            })
+        result.sort(key=lambda item: item[sort_by], reverse=True)
+        return result[:limit] if limit else result
+
+    def to_json(self, **kwargs):
+        """Statistics as a JSON document"""
+        return json.dumps({
+            "generated_at": int(time.time()),
+            "registered": len(self.statements),
+            "queries": self.snapshot(**kwargs)
+        }, indent=2)
+
+    def dump(self, path):
+        """Write statistics to a JSON file"""
+        with open(path, "w") as f:
+            f.write(self.to_json())
+
+    def reset(self):
+        """Drop collected statistics"""
+        with self._lock:
+            self._stats.clear()
+
+queries = QueryRegistry(DB_QUERY_SAMPLES, DB_SLOW_QUERY_MS)
+
+class QueryCursor(sqlite3.Cursor):
+    """Cursor that runs registered queries by name and records their timing.
+
+    ``sql`` overrides the registered text for statements that are built at
+    runtime (dynamic column lists, table names); they are still timed under
+    the given name.
+    """
+
+    def _timed(self, name, params, sql, fetch, execute=None):
+        started = time.perf_counter()
+        try:
+            (execute or self.execute)(sql or queries.sql(name), params)
+            result, rows = fetch()
+        except sqlite3.Error:
+            queries.record(name, time.perf_counter() - started, 0, failed=True)
+            raise
+        elapsed = time.perf_counter() - started
+        queries.record(name, elapsed, rows)
+        if queries.slow_query_ms and elapsed * 1000 >= queries.slow_query_ms:
+            queries.log_slow(name, elapsed, params)
+        return result
+
+    def run(self, name, params=(), sql=None):
+        """Execute a statement; rows counts the rows it changed"""
+        return self._timed(name, params, sql, lambda: (self, max(self.rowcount, 0)))
+
+    def many(self, name, seq_of_params, sql=None):
+        """Execute a statement once per parameter set; rows counts the rows it changed"""
+        return self._timed(name, seq_of_params, sql, lambda: (self, max(self.rowcount, 0)), self.executemany)
+
+    def one(self, name, params=(), sql=None):
+        """Execute a query and fetch its first row"""
+        def fetch():
+            row = self.fetchone()
+            return row, 0 if row is None else 1
+        return self._timed(name, params, sql, fetch)
+
+    def all(self, name, params=(), sql=None):
+        """Execute a query and fetch every row"""
+        def fetch():
+            rows = self.fetchall()
+            return rows, len(rows)
+        return self._timed(name, params, sql, fetch)
+
+class ConnectionPool:
+    """SQLite connection pool with separate read and write connections.
+
+    Reads check out a pooled connection for the duration of a ``read()``
+    block, so the Flask thread and the bot event loop never share a cursor.
+    All writes go through one writer connection guarded by a re-entrant
+    lock; nested ``write()`` blocks become savepoints and only the
+    outermost block commits. A ``read()`` inside a ``write()`` on the same
+    thread uses the writer connection so it sees its own uncommitted rows.
+    Work that must wait for the outermost commit registers ``after_commit``;
+    work batched up to the end of the transaction registers ``before_commit``.
+
+    Readers need their own connections to the same database, so an
+    in-memory database (one per connection) is rejected.
+    """
+
+    def __init__(self, path, pool_size=8, profile=None):
+        if path == ":memory:" or str(path).startswith("file::memory:"):
+            raise ValueError("ConnectionPool needs a database file; readers cannot share an in-memory database")
+        self.path = path
+        self.pool_size = pool_size
+        self.profile = profile or StorageProfile()
+        self.stats = defaultdict(int)
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        self._idle = deque()
+        self._idle_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._writer = self._connect()
+        self._hooks = []  # (on_commit, on_rollback) of the open transaction
+        self._before = []  # (callback, on_rollback) to run before it commits
+        
+        # journal_mode is persistent, so it only needs setting once
+        row = self._writer.execute(f"PRAGMA journal_mode = {self.profile.journal_mode}").fetchone()
+        self.journal_mode = row[0].upper()
+
+    def _connect(self):
+        """Open a new connection with the storage profile applied"""
+        connection = sqlite3.connect(
+            self.path,
+            timeout=self.profile.busy_timeout / 1000,
+            check_same_thread=False,
+            isolation_level=None,  # Transactions are managed explicitly
+            cached_statements=self.profile.statement_cache_size
+        )
+        connection.row_factory = sqlite3.Row
+        for pragma in self.profile.connection_pragmas():
+            connection.execute(pragma)
+        self._count('connections_opened')
+        return connection
+
+    def _count(self, key):
+        # Reader threads and the writer thread both update stats
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _checkout(self):
+        with self._idle_lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def _checkin(self, connection):
+        with self._idle_lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    @contextmanager
+    def read(self):
+        """Yield a cursor for read-only queries"""
+        local = self._local
+        if getattr(local, 'write_depth', 0):
+            connection, owned = self._writer, False
+        elif getattr(local, 'reader', None) is not None:
+            connection, owned = local.reader, False
+        else:
+            connection, owned = self._checkout(), True
+            local.reader = connection
 
-# Enable foreign keys
-cur.execute("PRAGMA foreign_keys = ON")
+        self._count('reads')
+        cursor = connection.cursor(QueryCursor)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            if owned:
+                local.reader = None
+                self._checkin(connection)
+
+    @contextmanager
+    def write(self):
+        """Yield a cursor inside a write transaction"""
+        with self._write_lock:
+            local = self._local
+            depth = getattr(local, 'write_depth', 0)
+            savepoint = f"sp_{depth}"
+            cursor = self._writer.cursor(QueryCursor)
+            cursor.execute(f"SAVEPOINT {savepoint}" if depth else "BEGIN IMMEDIATE")
+            local.write_depth = depth + 1
+            mark = len(self._hooks)
+            hooks = ()
+            try:
+                yield cursor
+            except BaseException:
+                if depth:
+                    cursor.execute(f"ROLLBACK TO {savepoint}")
+                    cursor.execute(f"RELEASE {savepoint}")
+                else:
+                    cursor.execute("ROLLBACK")
+                    self._count('rollbacks')
+                hooks = [on_rollback for _, on_rollback in reversed(self._hooks[mark:])]
+                del self._hooks[mark:]
+                if not depth:
+                    hooks += self._drop_before_commit()
+                raise
+            else:
+                if depth:
+                    cursor.execute(f"RELEASE {savepoint}")
+                else:
+                    try:
+                        # Hooks may register more hooks while they run
+                        ran = 0
+                        while ran < len(self._before):
+                            self._before[ran][0]()
+                            ran += 1
+                        cursor.execute("COMMIT")
+                    except BaseException:
+                        cursor.execute("ROLLBACK")
+                        self._count('rollbacks')
+                        hooks = [on_rollback for _, on_rollback in reversed(self._hooks)]
+                        hooks += self._drop_before_commit()
+                        self._hooks.clear()
+                        raise
+                    self._count('commits')
+                    self._before.clear()
+                    hooks = [on_commit for on_commit, _ in self._hooks]
+                    self._hooks.clear()
+            finally:
+                local.write_depth = depth
+                cursor.close()
+                # Still under the write lock, so no other transaction starts in between
+                self._run_hooks(hooks)
+
+    def _run_hooks(self, hooks):
+        for hook in hooks:
+            if hook is None:
+                continue
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"❌ Transaction hook {getattr(hook, '__qualname__', hook)} failed: {e}")
+
+    def _drop_before_commit(self):
+        hooks = [on_rollback for _, on_rollback in reversed(self._before)]
+        self._before.clear()
+        return hooks
+
+    def before_commit(self, callback, on_rollback=None):
+        """Run callback inside the transaction, just before the outermost COMMIT.
+
+        Callbacks run even if the savepoint that registered them rolled
+        back, so they must be harmless to run spuriously. If the whole
+        transaction rolls back, on_rollback runs instead.
+        """
+        if not self.in_write():
+            raise RuntimeError("before_commit() needs an open write()")
+        self._before.append((callback, on_rollback))
+
+    def after_commit(self, on_commit, on_rollback=None):
+        """Run on_commit once the outermost write() commits.
+
+        If the enclosing block rolls back instead, on_rollback runs.
+        Outside a write, on_commit runs straight away.
+        """
+        if not self.in_write():
+            on_commit()
+            return
+        self._hooks.append((on_commit, on_rollback))
+
+    def in_write(self):
+        """True while the calling thread is inside a write() block"""
+        return getattr(self._local, 'write_depth', 0) > 0
+
+    def set_writer_pragma(self, pragma):
+        """Run a PRAGMA on the writer connection"""
+        with self._write_lock:
+            self._writer.execute(pragma)
+
+    def backup(self, target_path):
+        """Copy a consistent snapshot of the committed database, WAL included"""
+        target = sqlite3.connect(target_path)
+        try:
+            # A fresh connection only sees committed pages, so an open
+            # write transaction (e.g. a group-commit batch) is left out
+            source = self._connect()
+            try:
+                source.backup(target)
+            finally:
+                source.close()
+        finally:
+            target.close()
+
+    def close(self):
+        """Close all pooled connections"""
+        with self._idle_lock:
+            while self._idle:
+                self._idle.pop().close()
+        with self._write_lock:
+            self._writer.close()
+
+with startup_timer.phase("connect"):
+    db = ConnectionPool(DATABASE_PATH, DB_POOL_SIZE, StorageProfile.from_env())
+
+def db_write(func):
+    """Mark a manager method as a write so the async facade queues it on the writer thread"""
+    func.db_write = True
+    return func
+
+# ==================== BACKGROUND TASKS ====================
+
+class BackgroundTask(threading.Thread):
+    """Daemon thread that calls run_once() every interval seconds, or sooner when woken"""
+
+    def __init__(self, name, interval):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+
+    def run(self):
+        while True:
+            self._wake_event.wait(self.interval)
+            self._wake_event.clear()
+            if self._stop_event.is_set():
+                return
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"{self.name} failed: {e}")
+
+    def run_once(self):
+        raise NotImplementedError
+
+    def wake(self):
+        """Run the next iteration now instead of waiting for the interval"""
+        self._wake_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+class WalCheckpointer(BackgroundTask):
+    """Checkpoint the WAL off the write path.
+
+    While running, auto-checkpointing on the writer connection is turned
+    off so commits never pay for a checkpoint. A PASSIVE checkpoint runs
+    every interval. Once the WAL grows past the restart threshold a
+    RESTART checkpoint is tried instead, with a short busy timeout on the
+    checkpoint connection only, so it gives up rather than stall writers
+    behind a long reader. The writer then starts the WAL over and
+    journal_size_limit trims the file.
+    """
+
+    def __init__(self, pool):
+        super().__init__("wal-checkpointer", pool.profile.checkpoint_interval)
+        self.pool = pool
+        self.stats = {
+            "runs": 0,
+            "restarts": 0,
+            "busy": 0,
+            "last_run_at": None,
+            "last_duration_ms": 0.0,
+            "last_log_frames": 0,
+            "last_checkpointed_frames": 0
+        }
+        self._connection = None
+
+    def wal_size(self):
+        """Current WAL file size in bytes"""
+        try:
+            return os.path.getsize(f"{self.pool.path}-wal")
+        except OSError:
+            return 0
+
+    def start(self):
+        if self.pool.journal_mode != "WAL":
+            logger.info(f"Journal mode is {self.pool.journal_mode}, WAL checkpointer not started")
+            return
+        self._connection = self.pool._connect()
+        self._connection.execute(f"PRAGMA busy_timeout = {self.pool.profile.checkpoint_busy_timeout}")
+        self.pool.set_writer_pragma("PRAGMA wal_autocheckpoint = 0")
+        super().start()
+
+    def stop(self):
+        super().stop()
+        if self._connection is not None:
+            self.pool.set_writer_pragma(f"PRAGMA wal_autocheckpoint = {self.pool.profile.wal_autocheckpoint}")
+
+    def run_once(self):
+        mode = "RESTART" if self.wal_size() >= self.pool.profile.checkpoint_restart_bytes else "PASSIVE"
+        started = time.perf_counter()
+        busy, log_frames, checkpointed = self._connection.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        
+        self.stats['runs'] += 1
+        self.stats['last_run_at'] = int(time.time())
+        self.stats['last_duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        self.stats['last_log_frames'] = log_frames
+        self.stats['last_checkpointed_frames'] = checkpointed
+        if busy:
+            self.stats['busy'] += 1
+        elif mode == "RESTART":
+            self.stats['restarts'] += 1
+
+wal_checkpointer = WalCheckpointer(db)
+
+def storage_stats():
+    """Storage profile, WAL size and checkpoint statistics"""
+    profile = db.profile
+    return {
+        "journal_mode": db.journal_mode,
+        "synchronous": profile.synchronous,
+        "cache_size": profile.cache_size,
+        "mmap_size": profile.mmap_size,
+        "db_bytes": os.path.getsize(db.path) if os.path.exists(db.path) else 0,
+        "wal_bytes": wal_checkpointer.wal_size(),
+        "checkpoints": dict(wal_checkpointer.stats)
+    }
 
 # ==================== ENUMS ====================
 
@@ -135,640 +704,1901 @@ class Permission(Enum):
 
 # ==================== COMPLETE DATABASE SCHEMA ====================
 
-def init_database():
-    """Initialize complete database schema"""
-    
-    # Schema version tracking
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS schema_versions (
-        version TEXT PRIMARY KEY,
-        applied_at INTEGER,
-        description TEXT
-    )
-    """)
-    
-    # Users table
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id TEXT PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        language TEXT DEFAULT 'en',
-        role TEXT DEFAULT 'user',
-        plan_id TEXT DEFAULT 'free',
-        plan_expiry INTEGER,
-        voice_mode INTEGER DEFAULT 0,
-        voice_engine TEXT DEFAULT 'gtts',
-        voice_name TEXT DEFAULT '',
-        daily_requests INTEGER DEFAULT 0,
-        total_requests INTEGER DEFAULT 0,
-        last_request_date TEXT,
-        created_at INTEGER,
-        updated_at INTEGER,
-        is_verified INTEGER DEFAULT 0,
-        is_active INTEGER DEFAULT 1,
-        telegram_id TEXT UNIQUE,
-        email TEXT,
-        phone TEXT,
-        notes TEXT,
-        metadata TEXT,
-        preferences TEXT,
-        coin_balance INTEGER DEFAULT 1000,
-        total_coins_earned INTEGER DEFAULT 1000,
-        total_coins_spent INTEGER DEFAULT 0,
-        referral_code TEXT UNIQUE,
-        referred_by TEXT,
-        last_login INTEGER,
-        login_count INTEGER DEFAULT 0,
-        theme_preference TEXT DEFAULT 'default',
-        chat_bubble_style TEXT DEFAULT 'default',
-        emoji_pack TEXT DEFAULT 'default',
-        voice_style TEXT DEFAULT 'default'
-    )
-    """)
-    
-    # User Levels & XP
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS user_levels (
-        user_id TEXT PRIMARY KEY,
-        level INTEGER DEFAULT 1,
-        xp INTEGER DEFAULT 0,
-        total_xp INTEGER DEFAULT 0,
-        activity_score INTEGER DEFAULT 0,
-        next_level_xp INTEGER DEFAULT 100,
-        created_at INTEGER,
-        updated_at INTEGER,
-        FOREIGN KEY(user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    # Friend System
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS friend_requests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        from_user TEXT NOT NULL,
-        to_user TEXT NOT NULL,
-        status TEXT DEFAULT 'pending',
-        created_at INTEGER,
-        updated_at INTEGER,
-        FOREIGN KEY(from_user) REFERENCES users(user_id),
-        FOREIGN KEY(to_user) REFERENCES users(user_id),
-        UNIQUE(from_user, to_user)
-    )
-    """)
-    
-    # Friends list
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS friends (
-        user_id TEXT,
-        friend_id TEXT,
-        created_at INTEGER,
-        PRIMARY KEY(user_id, friend_id),
-        FOREIGN KEY(user_id) REFERENCES users(user_id),
-        FOREIGN KEY(friend_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    # Direct Chat Sessions
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS direct_chat_sessions (
-        id TEXT PRIMARY KEY,
-        user_a TEXT NOT NULL,
-        user_b TEXT NOT NULL,
-        status TEXT DEFAULT 'active',
-        smart_mode INTEGER DEFAULT 0,
-        auto_translate INTEGER DEFAULT 0,
-        spam_filter INTEGER DEFAULT 1,
-        created_at INTEGER,
-        last_message_at INTEGER,
-        FOREIGN KEY(user_a) REFERENCES users(user_id),
-        FOREIGN KEY(user_b) REFERENCES users(user_id),
-        UNIQUE(user_a, user_b)
-    )
-    """)
-    
-    # Chat Messages
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS chat_messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        session_id TEXT NOT NULL,
-        from_user TEXT NOT NULL,
-        message TEXT,
-        is_forwarded INTEGER DEFAULT 0,
-        translated_message TEXT,
-        created_at INTEGER,
-        FOREIGN KEY(session_id) REFERENCES direct_chat_sessions(id),
-        FOREIGN KEY(from_user) REFERENCES users(user_id)
-    )
-    """)
-    
-    # Block System
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS blocks (
-        user_id TEXT NOT NULL,
-        blocked_user_id TEXT NOT NULL,
-        created_at INTEGER,
-        PRIMARY KEY(user_id, blocked_user_id),
-        FOREIGN KEY(user_id) REFERENCES users(user_id),
-        FOREIGN KEY(blocked_user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    # Group Rooms
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS group_rooms (
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        description TEXT,
-        created_by TEXT,
-        is_private INTEGER DEFAULT 0,
-        max_members INTEGER DEFAULT 50,
-        created_at INTEGER,
-        updated_at INTEGER,
-        FOREIGN KEY(created_by) REFERENCES users(user_id)
-    )
-    """)
-    
-    # Group Members
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS group_members (
-        room_id TEXT,
-        user_id TEXT,
-        role TEXT DEFAULT 'member',
-        joined_at INTEGER,
-        last_read INTEGER,
-        PRIMARY KEY(room_id, user_id),
-        FOREIGN KEY(room_id) REFERENCES group_rooms(id),
-        FOREIGN KEY(user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    # Group Messages
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS group_messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        room_id TEXT,
-        user_id TEXT,
-        message TEXT,
-        created_at INTEGER,
-        FOREIGN KEY(room_id) REFERENCES group_rooms(id),
-        FOREIGN KEY(user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    # SHOP SYSTEM TABLES
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS shop_categories (
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        description TEXT,
-        icon TEXT,
-        display_order INTEGER DEFAULT 0,
-        is_active INTEGER DEFAULT 1,
-        created_at INTEGER
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS shop_items (
-        id TEXT PRIMARY KEY,
-        category_id TEXT,
-        name TEXT,
-        description TEXT,
-        price INTEGER,
-        item_type TEXT,
-        item_value TEXT,
-        stock INTEGER DEFAULT -1,
-        is_active INTEGER DEFAULT 1,
-        is_limited INTEGER DEFAULT 0,
-        purchase_limit INTEGER DEFAULT 0,
-        icon TEXT,
-        created_at INTEGER,
-        updated_at INTEGER,
-        FOREIGN KEY(category_id) REFERENCES shop_categories(id)
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS user_purchases (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT,
-        item_id TEXT,
-        quantity INTEGER,
-        price_paid INTEGER,
-        purchased_at INTEGER,
-        FOREIGN KEY(user_id) REFERENCES users(user_id),
-        FOREIGN KEY(item_id) REFERENCES shop_items(id)
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS user_inventory (
-        user_id TEXT,
-        item_id TEXT,
-        quantity INTEGER DEFAULT 1,
-        acquired_at INTEGER,
-        is_equipped INTEGER DEFAULT 0,
-        PRIMARY KEY(user_id, item_id),
-        FOREIGN KEY(user_id) REFERENCES users(user_id),
-        FOREIGN KEY(item_id) REFERENCES shop_items(id)
-    )
-    """)
-    
-    # GAMES TABLES
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS games (
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        description TEXT,
-        game_type TEXT,
-        min_players INTEGER DEFAULT 1,
-        max_players INTEGER DEFAULT 2,
-        is_active INTEGER DEFAULT 1,
-        coin_reward INTEGER DEFAULT 10,
-        xp_reward INTEGER DEFAULT 5,
-        created_at INTEGER
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS game_sessions (
-        id TEXT PRIMARY KEY,
-        game_id TEXT,
-        status TEXT DEFAULT 'waiting',
-        created_by TEXT,
-        created_at INTEGER,
-        started_at INTEGER,
-        ended_at INTEGER,
-        winner TEXT,
-        FOREIGN KEY(game_id) REFERENCES games(id),
-        FOREIGN KEY(created_by) REFERENCES users(user_id)
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS game_players (
-        session_id TEXT,
-        user_id TEXT,
-        score INTEGER DEFAULT 0,
-        joined_at INTEGER,
-        PRIMARY KEY(session_id, user_id),
-        FOREIGN KEY(session_id) REFERENCES game_sessions(id),
-        FOREIGN KEY(user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS game_moves (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        session_id TEXT,
-        user_id TEXT,
-        move_data TEXT,
-        created_at INTEGER,
-        FOREIGN KEY(session_id) REFERENCES game_sessions(id),
-        FOREIGN KEY(user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS quiz_questions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        question TEXT,
-        options TEXT,
-        correct_answer INTEGER,
-        difficulty TEXT DEFAULT 'medium',
-        category TEXT,
-        points INTEGER DEFAULT 10,
-        created_at INTEGER
-    )
-    """)
-    
-    # BADGES & ACHIEVEMENTS
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS badges (
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        description TEXT,
-        icon TEXT,
-        requirement_type TEXT,
-        requirement_value INTEGER,
-        coin_reward INTEGER DEFAULT 0,
-        xp_reward INTEGER DEFAULT 0,
-        created_at INTEGER
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS user_badges (
-        user_id TEXT,
-        badge_id TEXT,
-        earned_at INTEGER,
-        PRIMARY KEY(user_id, badge_id),
-        FOREIGN KEY(user_id) REFERENCES users(user_id),
-        FOREIGN KEY(badge_id) REFERENCES badges(id)
-    )
-    """)
-    
-    # REPORTS & MODERATION
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS reports (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        reporter_id TEXT,
-        reported_user_id TEXT,
-        reason TEXT,
-        details TEXT,
-        status TEXT DEFAULT 'pending',
-        created_at INTEGER,
-        resolved_at INTEGER,
-        resolved_by TEXT,
-        FOREIGN KEY(reporter_id) REFERENCES users(user_id),
-        FOREIGN KEY(reported_user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS moderation_logs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        moderator_id TEXT,
-        action TEXT,
-        target_user TEXT,
-        reason TEXT,
-        created_at INTEGER,
-        FOREIGN KEY(moderator_id) REFERENCES users(user_id),
-        FOREIGN KEY(target_user) REFERENCES users(user_id)
-    )
-    """)
-    
-    # DYNAMIC MENU SYSTEM
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS menus (
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        parent_id TEXT,
-        menu_type TEXT DEFAULT 'user',  -- user, admin, both
-        command TEXT,
-        data TEXT,
-        icon TEXT,
-        display_order INTEGER DEFAULT 0,
-        is_active INTEGER DEFAULT 1,
-        required_permission TEXT,
-        created_at INTEGER,
-        updated_at INTEGER
-    )
-    """)
-    
-    # USER SESSIONS FOR CHAT
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS user_sessions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT,
-        session_type TEXT,
-        session_data TEXT,
-        created_at INTEGER,
-        expires_at INTEGER,
-        FOREIGN KEY(user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    # DAILY COINS CLAIM
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS daily_claims (
-        user_id TEXT PRIMARY KEY,
-        last_claim INTEGER,
-        streak INTEGER DEFAULT 0,
-        FOREIGN KEY(user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    # SYSTEM CONFIG
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS system_config (
-        key TEXT PRIMARY KEY,
-        value TEXT,
-        updated_at INTEGER,
-        updated_by TEXT
-    )
-    """)
-    
-    # Insert default categories if not exists
-    cur.execute("SELECT COUNT(*) FROM shop_categories")
-    if cur.fetchone()[0] == 0:
-        categories = [
-            ("cosmetics", "🎨 Cosmetics", "Profile themes, chat bubbles & more", "🎨", 1),
-            ("features", "⚡ Features", "Unlock premium features", "⚡", 2),
-            ("powerups", "🤖 Power-ups", "AI enhancement items", "🤖", 3),
-            ("utility", "🛠️ Utility", "Useful items & tools", "🛠️", 4)
-        ]
-        for cat_id, name, desc, icon, order in categories:
-            cur.execute("""
-                INSERT INTO shop_categories (id, name, description, icon, display_order, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (cat_id, name, desc, icon, order, int(time.time())))
-    
-    # Insert default shop items
-    cur.execute("SELECT COUNT(*) FROM shop_items")
-    if cur.fetchone()[0] == 0:
-        items = [
-            # Cosmetics
-            ("theme_dark", "cosmetics", "🌙 Dark Theme", "Dark mode for your profile", 500, "theme", "dark", -1),
-            ("theme_neon", "cosmetics", "✨ Neon Theme", "Bright neon profile theme", 800, "theme", "neon", -1),
-            ("bubble_rounded", "cosmetics", "💬 Rounded Bubbles", "Rounded chat bubbles", 300, "bubble", "rounded", -1),
-            ("bubble_modern", "cosmetics", "🌟 Modern Bubbles", "Modern chat bubble style", 400, "bubble", "modern", -1),
-            ("emoji_premium", "cosmetics", "😎 Premium Emojis", "Exclusive emoji pack", 600, "emoji", "premium", -1),
-            ("voice_robot", "cosmetics", "🤖 Robot Voice", "Robot style voice", 700, "voice", "robot", -1),
-            
-            # Features
-            ("fast_ai", "features", "⚡ Fast AI", "Priority AI responses", 1000, "feature", "fast_ai", -1),
-            ("long_memory", "features", "🧠 Long Memory", "Extended conversation memory", 1500, "feature", "long_memory", -1),
-            ("creative_mode", "features", "🎨 Creative Mode", "More creative responses", 1200, "feature", "creative_mode", -1),
-            
-            # Power-ups
-            ("xp_boost", "powerups", "📈 XP Boost", "2x XP for 24 hours", 800, "powerup", "xp_boost", 10),
-            ("coin_boost", "powerups", "💰 Coin Boost", "2x coins for 24 hours", 1000, "powerup", "coin_boost", 10),
-            
-            # Utility
-            ("name_change", "utility", "📝 Name Change", "Change your username", 2000, "utility", "name_change", 1),
-            ("profile_badge", "utility", "🏅 Special Badge", "Get a unique profile badge", 3000, "utility", "profile_badge", 1)
-        ]
-        for item_id, cat_id, name, desc, price, item_type, item_value, stock in items:
-            cur.execute("""
-                INSERT INTO shop_items (id, category_id, name, description, price, item_type, item_value, stock, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (item_id, cat_id, name, desc, price, item_type, item_value, stock, int(time.time())))
-    
-    # Insert default games
-    cur.execute("SELECT COUNT(*) FROM games")
-    if cur.fetchone()[0] == 0:
-        games = [
-            ("quiz", "📝 Quiz Battle", "Test your knowledge", "quiz", 1, 2, 20, 15),
-            ("memory", "🧠 Memory Game", "Test your memory", "memory", 1, 1, 15, 10),
-            ("reaction", "⚡ Reaction Test", "How fast are you?", "reaction", 1, 2, 10, 5),
-            ("puzzle", "🧩 Puzzle Challenge", "Solve the puzzle", "puzzle", 1, 1, 25, 20)
-        ]
-        for game_id, name, desc, g_type, min_p, max_p, coin_reward, xp_reward in games:
-            cur.execute("""
-                INSERT INTO games (id, name, description, game_type, min_players, max_players, coin_reward, xp_reward, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (game_id, name, desc, g_type, min_p, max_p, coin_reward, xp_reward, int(time.time())))
-    
-    # Insert default badges
-    cur.execute("SELECT COUNT(*) FROM badges")
-    if cur.fetchone()[0] == 0:
-        badges = [
-            ("beginner", "🌟 Beginner", "Complete 10 chats", "messages", 10, 100, 50),
-            ("social", "🤝 Socialite", "Make 5 friends", "friends", 5, 200, 100),
-            ("gamer", "🎮 Gamer", "Play 10 games", "games", 10, 300, 150),
-            ("streak_7", "🔥 7 Day Streak", "7 day login streak", "streak", 7, 500, 200),
-            ("streak_30", "⚡ 30 Day Streak", "30 day login streak", "streak", 30, 2000, 1000),
-            ("shopper", "🛍️ Shopper", "Buy 5 shop items", "purchases", 5, 400, 150)
-        ]
-        for badge_id, name, desc, req_type, req_value, coin, xp in badges:
-            cur.execute("""
-                INSERT INTO badges (id, name, description, icon, requirement_type, requirement_value, coin_reward, xp_reward, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (badge_id, name, desc, "🏆", req_type, req_value, coin, xp, int(time.time())))
-    
-    # Insert default menus
-    cur.execute("SELECT COUNT(*) FROM menus")
-    if cur.fetchone()[0] == 0:
-        menus = [
-            # User menus
-            ("user_main", "📱 Main Menu", None, "user", "main", None, "🏠", 1),
-            ("user_profile", "👤 My Profile", "user_main", "user", "profile", None, "👤", 1),
-            ("user_friends", "🤝 Friends", "user_main", "user", "friends", None, "🤝", 2),
-            ("user_shop", "🛒 Shop", "user_main", "user", "shop", None, "🛒", 3),
-            ("user_games", "🎮 Games", "user_main", "user", "games", None, "🎮", 4),
-            ("user_chat", "💬 Direct Chat", "user_main", "user", "connect", None, "💬", 5),
-            
-            # Admin menus
-            ("admin_main", "⚙️ Admin Panel", None, "admin", "admin", None, "⚙️", 1),
-            ("admin_users", "👥 Manage Users", "admin_main", "admin", "admin_users", None, "👥", 1, "manage_users"),
-            ("admin_features", "⚡ Features", "admin_main", "admin", "admin_features", None, "⚡", 2, "manage_features"),
-            ("admin_shop", "🛍️ Manage Shop", "admin_main", "admin", "admin_shop", None, "🛍️", 3, "manage_shop"),
-            ("admin_games", "🎲 Manage Games", "admin_main", "admin", "admin_games", None, "🎲", 4, "manage_games"),
-            ("admin_broadcast", "📢 Broadcast", "admin_main", "admin", "broadcast", None, "📢", 5, "manage_broadcast"),
-            ("admin_stats", "📊 Statistics", "admin_main", "admin", "stats", None, "📊", 6, "view_analytics"),
-            ("admin_clear", "🗑️ Clear Database", "admin_main", "admin", "clearall", None, "🗑️", 7, "manage_users")
-        ]
-        for menu_id, name, parent, menu_type, cmd, data, icon, order, *perms in menus:
-            perm = perms[0] if perms else None
-            cur.execute("""
-                INSERT INTO menus (id, name, parent_id, menu_type, command, data, icon, display_order, required_permission, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (menu_id, name, parent, menu_type, cmd, data, icon, order, perm, int(time.time())))
-    
-    # Insert default config
-    cur.execute("SELECT COUNT(*) FROM system_config")
-    if cur.fetchone()[0] == 0:
-        configs = [
-            ("daily_coins", "1000"),
-            ("max_friends", "100"),
-            ("max_group_members", "50"),
-            ("maintenance_mode", "false"),
-            ("welcome_message", "Welcome to Priya AI Bot! 🎉"),
-            ("default_language", "en"),
-            ("xp_per_message", "10"),
-            ("coins_per_message", "5")
-        ]
-        for key, value in configs:
+BASE_SCHEMA_VERSION = "0000"
+
+def create_schema():
+    """Create base tables"""
+    with db.write() as cur:
+        # Schema version tracking
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_versions (
+            version TEXT PRIMARY KEY,
+            applied_at INTEGER,
+            description TEXT
+        )
+        """)
+    
+        # Users table
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            language TEXT DEFAULT 'en',
+            role TEXT DEFAULT 'user',
+            plan_id TEXT DEFAULT 'free',
+            plan_expiry INTEGER,
+            voice_mode INTEGER DEFAULT 0,
+            voice_engine TEXT DEFAULT 'gtts',
+            voice_name TEXT DEFAULT '',
+            daily_requests INTEGER DEFAULT 0,
+            total_requests INTEGER DEFAULT 0,
+            last_request_date TEXT,
+            created_at INTEGER,
+            updated_at INTEGER,
+            is_verified INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1,
+            telegram_id TEXT UNIQUE,
+            email TEXT,
+            phone TEXT,
+            notes TEXT,
+            metadata TEXT,
+            preferences TEXT,
+            coin_balance INTEGER DEFAULT 1000,
+            total_coins_earned INTEGER DEFAULT 1000,
+            total_coins_spent INTEGER DEFAULT 0,
+            referral_code TEXT UNIQUE,
+            referred_by TEXT,
+            last_login INTEGER,
+            login_count INTEGER DEFAULT 0,
+            theme_preference TEXT DEFAULT 'default',
+            chat_bubble_style TEXT DEFAULT 'default',
+            emoji_pack TEXT DEFAULT 'default',
+            voice_style TEXT DEFAULT 'default'
+        )
+        """)
+    
+        # User Levels & XP
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_levels (
+            user_id TEXT PRIMARY KEY,
+            level INTEGER DEFAULT 1,
+            xp INTEGER DEFAULT 0,
+            total_xp INTEGER DEFAULT 0,
+            activity_score INTEGER DEFAULT 0,
+            next_level_xp INTEGER DEFAULT 100,
+            created_at INTEGER,
+            updated_at INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        # Friend System
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS friend_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_user TEXT NOT NULL,
+            to_user TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at INTEGER,
+            updated_at INTEGER,
+            FOREIGN KEY(from_user) REFERENCES users(user_id),
+            FOREIGN KEY(to_user) REFERENCES users(user_id),
+            UNIQUE(from_user, to_user)
+        )
+        """)
+    
+        # Friends list
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS friends (
+            user_id TEXT,
+            friend_id TEXT,
+            created_at INTEGER,
+            PRIMARY KEY(user_id, friend_id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id),
+            FOREIGN KEY(friend_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        # Direct Chat Sessions
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS direct_chat_sessions (
+            id TEXT PRIMARY KEY,
+            user_a TEXT NOT NULL,
+            user_b TEXT NOT NULL,
+            status TEXT DEFAULT 'active',
+            smart_mode INTEGER DEFAULT 0,
+            auto_translate INTEGER DEFAULT 0,
+            spam_filter INTEGER DEFAULT 1,
+            created_at INTEGER,
+            last_message_at INTEGER,
+            FOREIGN KEY(user_a) REFERENCES users(user_id),
+            FOREIGN KEY(user_b) REFERENCES users(user_id),
+            UNIQUE(user_a, user_b)
+        )
+        """)
+    
+        # Chat Messages
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            from_user TEXT NOT NULL,
+            message TEXT,
+            is_forwarded INTEGER DEFAULT 0,
+            translated_message TEXT,
+            created_at INTEGER,
+            FOREIGN KEY(session_id) REFERENCES direct_chat_sessions(id),
+            FOREIGN KEY(from_user) REFERENCES users(user_id)
+        )
+        """)
+    
+        # Block System
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS blocks (
+            user_id TEXT NOT NULL,
+            blocked_user_id TEXT NOT NULL,
+            created_at INTEGER,
+            PRIMARY KEY(user_id, blocked_user_id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id),
+            FOREIGN KEY(blocked_user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        # Group Rooms
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS group_rooms (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            created_by TEXT,
+            is_private INTEGER DEFAULT 0,
+            max_members INTEGER DEFAULT 50,
+            created_at INTEGER,
+            updated_at INTEGER,
+            FOREIGN KEY(created_by) REFERENCES users(user_id)
+        )
+        """)
+    
+        # Group Members
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS group_members (
+            room_id TEXT,
+            user_id TEXT,
+            role TEXT DEFAULT 'member',
+            joined_at INTEGER,
+            last_read INTEGER,
+            PRIMARY KEY(room_id, user_id),
+            FOREIGN KEY(room_id) REFERENCES group_rooms(id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        # Group Messages
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS group_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id TEXT,
+            user_id TEXT,
+            message TEXT,
+            created_at INTEGER,
+            FOREIGN KEY(room_id) REFERENCES group_rooms(id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        # SHOP SYSTEM TABLES
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS shop_categories (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            icon TEXT,
+            display_order INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1,
+            created_at INTEGER
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS shop_items (
+            id TEXT PRIMARY KEY,
+            category_id TEXT,
+            name TEXT,
+            description TEXT,
+            price INTEGER,
+            item_type TEXT,
+            item_value TEXT,
+            stock INTEGER DEFAULT -1,
+            is_active INTEGER DEFAULT 1,
+            is_limited INTEGER DEFAULT 0,
+            purchase_limit INTEGER DEFAULT 0,
+            icon TEXT,
+            created_at INTEGER,
+            updated_at INTEGER,
+            FOREIGN KEY(category_id) REFERENCES shop_categories(id)
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            item_id TEXT,
+            quantity INTEGER,
+            price_paid INTEGER,
+            purchased_at INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(user_id),
+            FOREIGN KEY(item_id) REFERENCES shop_items(id)
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_inventory (
+            user_id TEXT,
+            item_id TEXT,
+            quantity INTEGER DEFAULT 1,
+            acquired_at INTEGER,
+            is_equipped INTEGER DEFAULT 0,
+            PRIMARY KEY(user_id, item_id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id),
+            FOREIGN KEY(item_id) REFERENCES shop_items(id)
+        )
+        """)
+    
+        # GAMES TABLES
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS games (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            game_type TEXT,
+            min_players INTEGER DEFAULT 1,
+            max_players INTEGER DEFAULT 2,
+            is_active INTEGER DEFAULT 1,
+            coin_reward INTEGER DEFAULT 10,
+            xp_reward INTEGER DEFAULT 5,
+            created_at INTEGER
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS game_sessions (
+            id TEXT PRIMARY KEY,
+            game_id TEXT,
+            status TEXT DEFAULT 'waiting',
+            created_by TEXT,
+            created_at INTEGER,
+            started_at INTEGER,
+            ended_at INTEGER,
+            winner TEXT,
+            FOREIGN KEY(game_id) REFERENCES games(id),
+            FOREIGN KEY(created_by) REFERENCES users(user_id)
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS game_players (
+            session_id TEXT,
+            user_id TEXT,
+            score INTEGER DEFAULT 0,
+            joined_at INTEGER,
+            PRIMARY KEY(session_id, user_id),
+            FOREIGN KEY(session_id) REFERENCES game_sessions(id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS game_moves (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            user_id TEXT,
+            move_data TEXT,
+            created_at INTEGER,
+            FOREIGN KEY(session_id) REFERENCES game_sessions(id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS quiz_questions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            question TEXT,
+            options TEXT,
+            correct_answer INTEGER,
+            difficulty TEXT DEFAULT 'medium',
+            category TEXT,
+            points INTEGER DEFAULT 10,
+            created_at INTEGER
+        )
+        """)
+    
+        # BADGES & ACHIEVEMENTS
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS badges (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            icon TEXT,
+            requirement_type TEXT,
+            requirement_value INTEGER,
+            coin_reward INTEGER DEFAULT 0,
+            xp_reward INTEGER DEFAULT 0,
+            created_at INTEGER
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_badges (
+            user_id TEXT,
+            badge_id TEXT,
+            earned_at INTEGER,
+            PRIMARY KEY(user_id, badge_id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id),
+            FOREIGN KEY(badge_id) REFERENCES badges(id)
+        )
+        """)
+    
+        # REPORTS & MODERATION
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reporter_id TEXT,
+            reported_user_id TEXT,
+            reason TEXT,
+            details TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at INTEGER,
+            resolved_at INTEGER,
+            resolved_by TEXT,
+            FOREIGN KEY(reporter_id) REFERENCES users(user_id),
+            FOREIGN KEY(reported_user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS moderation_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            moderator_id TEXT,
+            action TEXT,
+            target_user TEXT,
+            reason TEXT,
+            created_at INTEGER,
+            FOREIGN KEY(moderator_id) REFERENCES users(user_id),
+            FOREIGN KEY(target_user) REFERENCES users(user_id)
+        )
+        """)
+    
+        # DYNAMIC MENU SYSTEM
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS menus (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            parent_id TEXT,
+            menu_type TEXT DEFAULT 'user',  -- user, admin, both
+            command TEXT,
+            data TEXT,
+            icon TEXT,
+            display_order INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1,
+            required_permission TEXT,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+        """)
+    
+        # USER SESSIONS FOR CHAT
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            session_type TEXT,
+            session_data TEXT,
+            created_at INTEGER,
+            expires_at INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        # DAILY COINS CLAIM
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_claims (
+            user_id TEXT PRIMARY KEY,
+            last_claim INTEGER,
+            streak INTEGER DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """)
+    
+        # SYSTEM CONFIG
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS system_config (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at INTEGER,
+            updated_by TEXT
+        )
+        """)
+    
+def seed_defaults():
+    """Insert default catalog and config rows"""
+    with db.write() as cur:
+        # Insert default categories if not exists
+        cur.execute("SELECT COUNT(*) FROM shop_categories")
+        if cur.fetchone()[0] == 0:
+            categories = [
+                ("cosmetics", "🎨 Cosmetics", "Profile themes, chat bubbles & more", "🎨", 1),
+                ("features", "⚡ Features", "Unlock premium features", "⚡", 2),
+                ("powerups", "🤖 Power-ups", "AI enhancement items", "🤖", 3),
+                ("utility", "🛠️ Utility", "Useful items & tools", "🛠️", 4)
+            ]
+            for cat_id, name, desc, icon, order in categories:
+                cur.execute("""
+                    INSERT INTO shop_categories (id, name, description, icon, display_order, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (cat_id, name, desc, icon, order, int(time.time())))
+    
+        # Insert default shop items
+        cur.execute("SELECT COUNT(*) FROM shop_items")
+        if cur.fetchone()[0] == 0:
+            items = [
+                # Cosmetics
+                ("theme_dark", "cosmetics", "🌙 Dark Theme", "Dark mode for your profile", 500, "theme", "dark", -1),
+                ("theme_neon", "cosmetics", "✨ Neon Theme", "Bright neon profile theme", 800, "theme", "neon", -1),
+                ("bubble_rounded", "cosmetics", "💬 Rounded Bubbles", "Rounded chat bubbles", 300, "bubble", "rounded", -1),
+                ("bubble_modern", "cosmetics", "🌟 Modern Bubbles", "Modern chat bubble style", 400, "bubble", "modern", -1),
+                ("emoji_premium", "cosmetics", "😎 Premium Emojis", "Exclusive emoji pack", 600, "emoji", "premium", -1),
+                ("voice_robot", "cosmetics", "🤖 Robot Voice", "Robot style voice", 700, "voice", "robot", -1),
+            
+                # Features
+                ("fast_ai", "features", "⚡ Fast AI", "Priority AI responses", 1000, "feature", "fast_ai", -1),
+                ("long_memory", "features", "🧠 Long Memory", "Extended conversation memory", 1500, "feature", "long_memory", -1),
+                ("creative_mode", "features", "🎨 Creative Mode", "More creative responses", 1200, "feature", "creative_mode", -1),
+            
+                # Power-ups
+                ("xp_boost", "powerups", "📈 XP Boost", "2x XP for 24 hours", 800, "powerup", "xp_boost", 10),
+                ("coin_boost", "powerups", "💰 Coin Boost", "2x coins for 24 hours", 1000, "powerup", "coin_boost", 10),
+            
+                # Utility
+                ("name_change", "utility", "📝 Name Change", "Change your username", 2000, "utility", "name_change", 1),
+                ("profile_badge", "utility", "🏅 Special Badge", "Get a unique profile badge", 3000, "utility", "profile_badge", 1)
+            ]
+            for item_id, cat_id, name, desc, price, item_type, item_value, stock in items:
+                cur.execute("""
+                    INSERT INTO shop_items (id, category_id, name, description, price, item_type, item_value, stock, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (item_id, cat_id, name, desc, price, item_type, item_value, stock, int(time.time())))
+    
+        # Insert default games
+        cur.execute("SELECT COUNT(*) FROM games")
+        if cur.fetchone()[0] == 0:
+            games = [
+                ("quiz", "📝 Quiz Battle", "Test your knowledge", "quiz", 1, 2, 20, 15),
+                ("memory", "🧠 Memory Game", "Test your memory", "memory", 1, 1, 15, 10),
+                ("reaction", "⚡ Reaction Test", "How fast are you?", "reaction", 1, 2, 10, 5),
+                ("puzzle", "🧩 Puzzle Challenge", "Solve the puzzle", "puzzle", 1, 1, 25, 20)
+            ]
+            for game_id, name, desc, g_type, min_p, max_p, coin_reward, xp_reward in games:
+                cur.execute("""
+                    INSERT INTO games (id, name, description, game_type, min_players, max_players, coin_reward, xp_reward, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (game_id, name, desc, g_type, min_p, max_p, coin_reward, xp_reward, int(time.time())))
+    
+        # Insert default badges
+        cur.execute("SELECT COUNT(*) FROM badges")
+        if cur.fetchone()[0] == 0:
+            badges = [
+                ("beginner", "🌟 Beginner", "Complete 10 chats", "messages", 10, 100, 50),
+                ("social", "🤝 Socialite", "Make 5 friends", "friends", 5, 200, 100),
+                ("gamer", "🎮 Gamer", "Play 10 games", "games", 10, 300, 150),
+                ("streak_7", "🔥 7 Day Streak", "7 day login streak", "streak", 7, 500, 200),
+                ("streak_30", "⚡ 30 Day Streak", "30 day login streak", "streak", 30, 2000, 1000),
+                ("shopper", "🛍️ Shopper", "Buy 5 shop items", "purchases", 5, 400, 150)
+            ]
+            for badge_id, name, desc, req_type, req_value, coin, xp in badges:
+                cur.execute("""
+                    INSERT INTO badges (id, name, description, icon, requirement_type, requirement_value, coin_reward, xp_reward, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (badge_id, name, desc, "🏆", req_type, req_value, coin, xp, int(time.time())))
+    
+        # Insert default menus
+        cur.execute("SELECT COUNT(*) FROM menus")
+        if cur.fetchone()[0] == 0:
+            menus = [
+                # User menus
+                ("user_main", "📱 Main Menu", None, "user", "main", None, "🏠", 1),
+                ("user_profile", "👤 My Profile", "user_main", "user", "profile", None, "👤", 1),
+                ("user_friends", "🤝 Friends", "user_main", "user", "friends", None, "🤝", 2),
+                ("user_shop", "🛒 Shop", "user_main", "user", "shop", None, "🛒", 3),
+                ("user_games", "🎮 Games", "user_main", "user", "games", None, "🎮", 4),
+                ("user_chat", "💬 Direct Chat", "user_main", "user", "connect", None, "💬", 5),
+            
+                # Admin menus
+                ("admin_main", "⚙️ Admin Panel", None, "admin", "admin", None, "⚙️", 1),
+                ("admin_users", "👥 Manage Users", "admin_main", "admin", "admin_users", None, "👥", 1, "manage_users"),
+                ("admin_features", "⚡ Features", "admin_main", "admin", "admin_features", None, "⚡", 2, "manage_features"),
+                ("admin_shop", "🛍️ Manage Shop", "admin_main", "admin", "admin_shop", None, "🛍️", 3, "manage_shop"),
+                ("admin_games", "🎲 Manage Games", "admin_main", "admin", "admin_games", None, "🎲", 4, "manage_games"),
+                ("admin_broadcast", "📢 Broadcast", "admin_main", "admin", "broadcast", None, "📢", 5, "manage_broadcast"),
+                ("admin_stats", "📊 Statistics", "admin_main", "admin", "stats", None, "📊", 6, "view_analytics"),
+                ("admin_clear", "🗑️ Clear Database", "admin_main", "admin", "clearall", None, "🗑️", 7, "manage_users"),
+                ("admin_cache", "🗄️ Cache", "admin_main", "admin", "cache", None, "🗄️", 8, "view_analytics")
+            ]
+            for menu_id, name, parent, menu_type, cmd, data, icon, order, *perms in menus:
+                perm = perms[0] if perms else None
+                cur.execute("""
+                    INSERT INTO menus (id, name, parent_id, menu_type, command, data, icon, display_order, required_permission, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (menu_id, name, parent, menu_type, cmd, data, icon, order, perm, int(time.time())))
+    
+        # Insert default config
+        cur.execute("SELECT COUNT(*) FROM system_config")
+        if cur.fetchone()[0] == 0:
+            configs = [
+                ("daily_coins", "1000"),
+                ("max_friends", "100"),
+                ("max_group_members", "50"),
+                ("maintenance_mode", "false"),
+                ("welcome_message", "Welcome to Priya AI Bot! 🎉"),
+                ("default_language", "en"),
+                ("xp_per_message", "10"),
+                ("coins_per_message", "5")
+            ]
+            for key, value in configs:
+                cur.execute("""
+                    INSERT INTO system_config (key, value, updated_at)
+                    VALUES (?, ?, ?)
+                """, (key, value, int(time.time())))
+        
+        # Mark base schema as installed
+        cur.execute("""
+            INSERT OR IGNORE INTO schema_versions (version, applied_at, description)
+            VALUES (?, ?, 'Base schema and default data')
+        """, (BASE_SCHEMA_VERSION, int(time.time())))
+
+# ==================== MIGRATIONS ====================
+
+# Ordered (version, description, steps). A step is an SQL string or a
+# callable taking a cursor. Applied versions are recorded in
+# schema_versions; never edit a migration once shipped, add a new one.
+MIGRATIONS = [
+    ("0001", "Secondary indexes for hot-path lookups", [
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_request_date ON users(last_request_date)",
+        "CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)",
+        "CREATE INDEX IF NOT EXISTS idx_user_levels_total_xp ON user_levels(total_xp)",
+        "CREATE INDEX IF NOT EXISTS idx_friend_requests_to_status ON friend_requests(to_user, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_session_created ON chat_messages(session_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_from_user ON chat_messages(from_user)",
+        "CREATE INDEX IF NOT EXISTS idx_group_messages_room_created ON group_messages(room_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_game_players_user ON game_players(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_game_sessions_status_game ON game_sessions(status, game_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_game_sessions_status_created ON game_sessions(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_game_sessions_winner ON game_sessions(winner)",
+        "CREATE INDEX IF NOT EXISTS idx_user_purchases_user_item ON user_purchases(user_id, item_id)",
+        "CREATE INDEX IF NOT EXISTS idx_reports_status ON reports(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_quiz_questions_difficulty ON quiz_questions(difficulty)",
+        "CREATE INDEX IF NOT EXISTS idx_shop_items_category_price ON shop_items(category_id, price)",
+        "CREATE INDEX IF NOT EXISTS idx_menus_type_order ON menus(menu_type, display_order)",
+        "PRAGMA optimize"
+    ]),
+    ("0002", "Per-user counts of archived messages", [
+        """
+        CREATE TABLE IF NOT EXISTS message_archive_counts (
+            user_id TEXT PRIMARY KEY,
+            chat_messages INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    ]),
+    ("0003", "Keyset pagination indexes for message history", [
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_session_id ON chat_messages(session_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_group_messages_room_id ON group_messages(room_id, id)",
+        # History is ordered by id now, the created_at indexes only cost writes
+        "DROP INDEX IF EXISTS idx_chat_messages_session_created",
+        "DROP INDEX IF EXISTS idx_group_messages_room_created"
+    ]),
+    ("0004", "Cache table for the persistent cache tier", [
+        """
+        CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires_at INTEGER,
+            created_at INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON cache(expires_at)"
+    ]),
+    ("0005", "Cross-process cache invalidation log", [
+        """
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            key TEXT,
+            namespace TEXT,
+            created_at INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created_at ON cache_invalidations(created_at)"
+    ]),
+    ("0006", "Cache statistics entry in the admin menu", [
+        """
+        INSERT OR IGNORE INTO menus (id, name, parent_id, menu_type, command, data, icon, display_order, required_permission, created_at)
+        SELECT 'admin_cache', '🗄️ Cache', 'admin_main', 'admin', 'cache', NULL, '🗄️', 8, 'view_analytics', strftime('%s', 'now')
+        WHERE EXISTS (SELECT 1 FROM menus WHERE id = 'admin_main')
+        """
+    ]),
+    ("0007", "Append-only conversation memory log", [
+        """
+        CREATE TABLE IF NOT EXISTS conversation_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT,
+            created_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_conversation_log_user ON conversation_log(user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_conversation_log_created_at ON conversation_log(created_at)"
+    ]),
+    ("0008", "Append-only coin ledger with balance snapshots", [
+        """
+        CREATE TABLE IF NOT EXISTS coin_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL REFERENCES users(user_id),
+            amount INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            reason TEXT,
+            idempotency_key TEXT UNIQUE,
+            created_at INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_coin_transactions_user ON coin_transactions(user_id, id)",
+        # The ledger is the source of truth; users.coin_balance follows it
+        """
+        CREATE TRIGGER IF NOT EXISTS coin_transactions_apply
+        AFTER INSERT ON coin_transactions
+        BEGIN
+            UPDATE users
+            SET coin_balance = coin_balance + NEW.amount,
+                total_coins_earned = total_coins_earned + MAX(NEW.amount, 0),
+                total_coins_spent = total_coins_spent + MAX(-NEW.amount, 0)
+            WHERE user_id = NEW.user_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS coin_transactions_no_update
+        BEFORE UPDATE ON coin_transactions
+        BEGIN
+            SELECT RAISE(ABORT, 'coin_transactions is append-only');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS coin_transactions_no_delete
+        BEFORE DELETE ON coin_transactions
+        BEGIN
+            SELECT RAISE(ABORT, 'coin_transactions is append-only');
+        END
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS coin_snapshots (
+            user_id TEXT PRIMARY KEY,
+            balance INTEGER NOT NULL,
+            last_txn_id INTEGER NOT NULL DEFAULT 0,
+            taken_at INTEGER
+        )
+        """,
+        # Existing balances and the signup balance open each user's history
+        """
+        INSERT OR IGNORE INTO coin_snapshots (user_id, balance, last_txn_id, taken_at)
+        SELECT user_id, coin_balance, 0, strftime('%s', 'now') FROM users
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_open_coin_snapshot
+        AFTER INSERT ON users
+        BEGIN
+            INSERT OR IGNORE INTO coin_snapshots (user_id, balance, last_txn_id, taken_at)
+            VALUES (NEW.user_id, COALESCE(NEW.coin_balance, 0), 0, strftime('%s', 'now'));
+        END
+        """
+    ]),
+    ("0009", "Activity batch watermark on users and levels", [
+        # Batch sequence of the last activity flush applied to each row
+        "ALTER TABLE users ADD COLUMN activity_seq INTEGER DEFAULT 0",
+        "ALTER TABLE user_levels ADD COLUMN activity_seq INTEGER DEFAULT 0"
+    ]),
+    ("0010", "Bans table for the ban check", [
+        """
+        CREATE TABLE IF NOT EXISTS bans (
+            user_id TEXT PRIMARY KEY REFERENCES users(user_id),
+            reason TEXT,
+            banned_by TEXT REFERENCES users(user_id),
+            created_at INTEGER
+        )
+        """
+    ]),
+    ("0011", "Per-conversation index of archived months", [
+        # Which month files hold a conversation's archived rows, and their id range
+        """
+        CREATE TABLE IF NOT EXISTS message_archive_index (
+            table_name TEXT NOT NULL,
+            conversation TEXT NOT NULL,
+            month TEXT NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            PRIMARY KEY (table_name, conversation, month)
+        ) WITHOUT ROWID
+        """
+    ]),
+]
+
+def get_applied_versions():
+    """Schema versions recorded in the database"""
+    try:
+        with db.read() as cur:
+            cur.execute("SELECT version FROM schema_versions")
+            return {row['version'] for row in cur.fetchall()}
+    except sqlite3.OperationalError:
+        # Fresh database without schema_versions yet
+        return set()
+
+def run_migrations(applied=None):
+    """Apply pending migrations in order"""
+    if applied is None:
+        applied = get_applied_versions()
+    
+    for version, description, steps in MIGRATIONS:
+        if version in applied:
+            continue
+        
+        started = time.perf_counter()
+        with db.write() as cur:
+            for step in steps:
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
             cur.execute("""
-                INSERT INTO system_config (key, value, updated_at)
+                INSERT INTO schema_versions (version, applied_at, description)
                 VALUES (?, ?, ?)
-            """, (key, value, int(time.time())))
+            """, (version, int(time.time()), description))
+        
+        logger.info(f"✅ Applied migration {version}: {description} ({time.perf_counter() - started:.2f}s)")
+
+def init_database():
+    """Initialize database, skipping DDL and seeding when the schema is current"""
+    with startup_timer.phase("schema_check"):
+        applied = get_applied_versions()
+    
+    pending = [version for version, _, _ in MIGRATIONS if version not in applied]
+    if BASE_SCHEMA_VERSION in applied and not pending:
+        logger.info(f"✅ Database schema is current ({MIGRATIONS[-1][0]})")
+        return
     
-    conn.commit()
-    logger.info("✅ Database schema initialized successfully")
+    if BASE_SCHEMA_VERSION not in applied:
+        with startup_timer.phase("ddl"):
+            create_schema()
+        with startup_timer.phase("seed"):
+            seed_defaults()
+        logger.info("✅ Database schema initialized successfully")
+    
+    with startup_timer.phase("migrations"):
+        run_migrations(applied)
 
 # Initialize database
 init_database()
 
 # ==================== CACHE MANAGER ====================
 
+queries.register({
+    "cache.get": "SELECT value FROM cache WHERE key=? AND (expires_at IS NULL OR expires_at > ?)",
+    "cache.set": """
+        REPLACE INTO cache (key, value, expires_at, created_at)
+        VALUES (?, ?, ?, ?)
+    """,
+    "cache.delete": "DELETE FROM cache WHERE key=?",
+    "cache.delete_range": "DELETE FROM cache WHERE key >= ? AND key < ?",
+    "cache.purge_expired": "DELETE FROM cache WHERE expires_at < ?",
+    "cache.invalidation_publish": """
+        INSERT INTO cache_invalidations (origin, key, namespace, created_at)
+        VALUES (?, ?, ?, ?)
+    """,
+    "cache.invalidations_since": """
+        SELECT id, key, namespace FROM cache_invalidations
+        WHERE id > ? AND origin != ?
+        ORDER BY id
+    """,
+    "cache.invalidations_last": "SELECT COALESCE(MAX(id), 0) FROM cache_invalidations",
+    "cache.invalidated_since": """
+        SELECT key, namespace, MAX(created_at) AS created_at FROM cache_invalidations
+        WHERE created_at >= ?
+        GROUP BY key, namespace
+    """,
+    "cache.invalidations_prune": "DELETE FROM cache_invalidations WHERE created_at < ?"
+})
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "50000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_PURGE_INTERVAL = int(os.getenv("CACHE_PURGE_INTERVAL", "300"))
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", "60"))
+
+# Per-namespace (key prefix before ":") limits as (max entries, max bytes).
+# Namespaces not listed share the "*" quota.
+CACHE_NAMESPACE_QUOTAS = {
+    "user": (20000, 16 * 1024 * 1024),
+    "missing": (20000, 2 * 1024 * 1024),
+    "claim": (50000, 2 * 1024 * 1024),
+    "*": (5000, 8 * 1024 * 1024)
+}
+
+class MemoryTier:
+    """Bounded in-process cache with LRU eviction and lazy TTL expiry.
+
+    Each namespace keeps its own OrderedDict in recency order, so lookups,
+    inserts and evictions are O(1). Sizes are approximate (the length of
+    the value's JSON encoding). A namespace over its quota evicts its own
+    least recently used entries; when the tier as a whole is over its
+    limits, the namespace using the most bytes gives up entries first.
+    Expired entries are dropped when read, and purge_expired() sweeps the
+    rest.
+    """
+
+    def __init__(self, max_entries, max_bytes, quotas):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.quotas = quotas
+        self.entries = 0
+        self.bytes = 0
+        self.stats = defaultdict(int)
+        self.namespace_stats = defaultdict(lambda: defaultdict(int))
+        self._namespaces = defaultdict(OrderedDict)  # namespace -> key -> (value, expires_at, size)
+        self._hits = {}  # key -> hits while resident
+        self._bytes = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def namespace(key):
+        return key.split(":", 1)[0]
+
+    def _quota(self, namespace):
+        return self.quotas.get(namespace, self.quotas["*"])
+
+    def get(self, key):
+        """Value for key, or None if missing or expired"""
+        namespace = self.namespace(key)
+        with self._lock:
+            items = self._namespaces.get(namespace)
+            entry = items.get(key) if items else None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(namespace, key)
+                self.stats['expirations'] += 1
+                self.namespace_stats[namespace]['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+            
+            items.move_to_end(key)
+            self.stats['hits'] += 1
+            self.namespace_stats[namespace]['hits'] += 1
+            self._hits[key] = self._hits.get(key, 0) + 1
+            return value
+
+    def set(self, key, value, ttl=None, size=1):
+        """Store value for ttl seconds (None keeps it until evicted)"""
+        namespace = self.namespace(key)
+        expires_at = time.time() + ttl if ttl else None
+        max_entries, max_bytes = self._quota(namespace)
+        if size > max_bytes:
+            # Never let one value flush a whole namespace
+            self.delete(key)
+            return
+        
+        with self._lock:
+            items = self._namespaces[namespace]
+            if key in items:
+                self._remove(namespace, key)
+            items[key] = (value, expires_at, size)
+            self._bytes[namespace] += size
+            self.entries += 1
+            self.bytes += size
+            
+            while len(items) > max_entries or self._bytes[namespace] > max_bytes:
+                self._evict(namespace)
+            while self.entries > self.max_entries or self.bytes > self.max_bytes:
+                self._evict(max(self._bytes, key=self._bytes.get))
+
+    def delete(self, key):
+        namespace = self.namespace(key)
+        with self._lock:
+            if key in self._namespaces.get(namespace, ()):
+                self._remove(namespace, key)
+
+    def _remove(self, namespace, key):
+        _, _, size = self._namespaces[namespace].pop(key)
+        self._hits.pop(key, None)
+        self._bytes[namespace] -= size
+        self.entries -= 1
+        self.bytes -= size
+
+    def drop_namespace(self, namespace):
+        """Remove every entry in a namespace"""
+        with self._lock:
+            for key in list(self._namespaces.get(namespace, ())):
+                self._remove(namespace, key)
+
+    def _evict(self, namespace):
+        key = next(iter(self._namespaces[namespace]))
+        self._remove(namespace, key)
+        self.stats['evictions'] += 1
+        self.namespace_stats[namespace]['evictions'] += 1
+
+    def purge_expired(self):
+        """Drop every expired entry; returns how many were removed"""
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for namespace, items in self._namespaces.items():
+                expired = [key for key, (_, expires_at, _) in items.items()
+                           if expires_at is not None and expires_at <= now]
+                for key in expired:
+                    self._remove(namespace, key)
+                removed += len(expired)
+                self.namespace_stats[namespace]['expirations'] += len(expired)
+            self.stats['expirations'] += removed
+        return removed
+
+    def hot_keys(self, limit=20, namespace=None):
+        """Resident keys with the most hits, as (key, hits) pairs"""
+        with self._lock:
+            hits = list(self._hits.items())
+        if namespace:
+            hits = [(key, count) for key, count in hits if self.namespace(key) == namespace]
+        return heapq.nlargest(limit, hits, key=lambda item: item[1])
+
+    def usage(self):
+        """Entries and bytes per namespace"""
+        with self._lock:
+            return {
+                namespace: {"entries": len(items), "bytes": self._bytes[namespace]}
+                for namespace, items in self._namespaces.items()
+            }
+
+# ==================== CACHE CODECS ====================
+
+class JsonCodec:
+    """Fallback codec for any JSON-serialisable value"""
+    tag = b"J"
+
+    def encode(self, value):
+        return json.dumps(value, separators=(",", ":")).encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+class MarshalCodec:
+    """marshal for trusted, process-internal values of builtin types.
+
+    Raises ValueError for anything else so the next codec is tried. The
+    format is tied to the Python version; entries written by another
+    version fail to decode and are treated as misses.
+    """
+    tag = b"M"
+
+    def encode(self, value):
+        return marshal.dumps(value)
+
+    def decode(self, data):
+        return marshal.loads(data)
+
+class RowCodec:
+    """Dicts with a registered key set, stored as a tuple of values.
+
+    Column names are stored once per schema instead of once per value.
+    A schema's id is the CRC32 of its keys, so every process that
+    registers the same shape agrees on it.
+    """
+    tag = b"R"
+    _header = struct.Struct("<I")
+
+    def __init__(self):
+        self._columns = {}  # schema id -> keys
+        self._ids = {}  # keys -> schema id
+
+    def register(self, keys):
+        keys = tuple(keys)
+        if keys not in self._ids:
+            schema_id = zlib.crc32(",".join(keys).encode())
+            self._columns[schema_id] = keys
+            self._ids[keys] = schema_id
+        return self._ids[keys]
+
+    def encode(self, value):
+        if not isinstance(value, dict):
+            raise ValueError("not a row")
+        schema_id = self._ids.get(tuple(value))
+        if schema_id is None:
+            raise ValueError("unregistered row shape")
+        return self._header.pack(schema_id) + marshal.dumps(tuple(value.values()))
+
+    def decode(self, data):
+        (schema_id,) = self._header.unpack_from(data)
+        return dict(zip(self._columns[schema_id], marshal.loads(data[self._header.size:])))
+
+class CacheCodecs:
+    """Encode with the first codec that accepts a value; a tag byte records which.
+
+    Values persisted before codecs existed are JSON text and are still read.
+    """
+
+    def __init__(self, codecs):
+        self.codecs = codecs
+        self._by_tag = {codec.tag: codec for codec in codecs}
+        self.stats = defaultdict(int)
+
+    def encode(self, value):
+        for codec in self.codecs:
+            try:
+                data = codec.tag + codec.encode(value)
+            except (ValueError, TypeError):
+                continue
+            self.stats[codec.tag.decode()] += 1
+            return data
+        raise TypeError(f"no cache codec accepts {type(value).__name__}")
+
+    def decode(self, data):
+        if isinstance(data, str):
+            return json.loads(data)
+        return self._by_tag[data[:1]].decode(data[1:])
+
+CACHE_CODECS = {"json": JsonCodec, "marshal": MarshalCodec}
+CACHE_CODEC = os.getenv("CACHE_CODEC", "marshal")
+
+row_codec = RowCodec()
+
+# Row-shaped values first, then the configured codec, with JSON as the last resort
+cache_codecs = CacheCodecs([row_codec, CACHE_CODECS[CACHE_CODEC](), JsonCodec()])
+
+_MISSING = object()
+
 class CacheManager:
-    """Simple cache manager with SQLite backend"""
-    
-    def __init__(self, default_ttl=300):
+    """Two-tier cache: a bounded memory tier in front of the SQLite cache table.
+
+    Writes are acknowledged once they are in memory. The key is marked
+    dirty and CacheFlusher writes all dirty keys in one transaction every
+    CACHE_FLUSH_INTERVAL seconds, or sooner once CACHE_FLUSH_MAX keys are
+    pending. Only the latest value per key is written. Reads consult the
+    pending writes before SQLite, so an unflushed value is never shadowed
+    by an older persisted one. Each flush is a single transaction, so the
+    table is never left half-written.
+    
+    Every dirty write is also appended to a journal segment, which is
+    rotated by each flush and removed once that flush commits. Segments
+    left by a crash are replayed at startup by recover(), skipping
+    entries that expired or that another process invalidated since.
+    """
+    
+    def __init__(self, default_ttl=300, flush_threshold=500, codecs=None, journal_path=None):
         self.default_ttl = default_ttl
-        self.memory_cache = {}
-        self.cache_timestamps = {}
+        self.codecs = codecs or CacheCodecs([JsonCodec()])
+        self.flush_threshold = flush_threshold
+        self.journal_path = journal_path
+        self.memory = MemoryTier(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_NAMESPACE_QUOTAS)
+        self.flusher = None
+        self.channel = None
+        self.stats = defaultdict(int)
+        self.namespace_stats = defaultdict(lambda: defaultdict(int))
+        self._dirty = {}  # key -> (encoded, expires_at, created_at), or None for a delete
+        self._flushing = {}
+        self._doomed = set()  # Keys deleted by the open write transaction
+        self._dirty_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._missing_epoch = 0
+        self._lock = threading.Lock()  # Guards _missing_epoch
+        self.seq = 0
+        self._journal = None
+        self._segments = []
+        self._ready = False
     
     def get(self, key):
         """Get value from cache"""
         # Check memory cache first
-        if key in self.memory_cache:
-            if key in self.cache_timestamps and self.cache_timestamps[key] > time.time():
-                return self.memory_cache[key]
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        
+        stats = self.namespace_stats[MemoryTier.namespace(key)]
+        
+        # Then writes that are not flushed yet
+        with self._dirty_lock:
+            pending = self._dirty.get(key, self._flushing.get(key, _MISSING))
+        if pending is not _MISSING:
+            if pending is None or (pending[1] is not None and pending[1] <= time.time()):
+                stats['misses'] += 1
+                return None
+            value = self.codecs.decode(pending[0])
+            self.memory.set(key, value, 60, len(pending[0]))
+            stats['db_hits'] += 1
+            return value
         
         # Check database cache
-        cur.execute(
-            "SELECT value FROM cache WHERE key=? AND (expires_at IS NULL OR expires_at > ?)",
-            (key, int(time.time()))
-        )
-        row = cur.fetchone()
+        with db.read() as cur:
+            row = cur.one("cache.get", (key, int(time.time())))
         if row:
-            value = json.loads(row[0])
+            try:
+                value = self.codecs.decode(row[0])
+            except (KeyError, ValueError, EOFError, TypeError):
+                # Unknown row shape or another Python's marshal format
+                self.stats['decode_errors'] += 1
+                stats['misses'] += 1
+                return None
             # Store in memory
-            self.memory_cache[key] = value
-            self.cache_timestamps[key] = time.time() + 60
+            self.memory.set(key, value, 60, len(row[0]))
+            stats['db_hits'] += 1
             return value
+        stats['misses'] += 1
         return None
     
     def set(self, key, value, ttl=None):
         """Set value in cache"""
         expires = int(time.time()) + (ttl or self.default_ttl) if ttl != -1 else None
+        encoded = self.codecs.encode(value)
         
         # Store in memory
-        self.memory_cache[key] = value
-        self.cache_timestamps[key] = time.time() + (ttl or self.default_ttl)
+        self.memory.set(key, value, None if ttl == -1 else ttl or self.default_ttl, len(encoded))
         
-        # Store in database
-        cur.execute("""
-            REPLACE INTO cache (key, value, expires_at, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (key, json.dumps(value), expires, int(time.time())))
-        conn.commit()
+        # Persist on the next flush
+        self._mark_dirty(key, (encoded, expires, int(time.time())))
     
     def delete(self, key):
         """Delete from cache"""
-        if key in self.memory_cache:
-            del self.memory_cache[key]
-        if key in self.cache_timestamps:
-            del self.cache_timestamps[key]
+        self.memory.delete(key)
+        if self.channel is None or not self.channel.enabled:
+            self._mark_dirty(key, None)
+            return
         
-        cur.execute("DELETE FROM cache WHERE key=?", (key,))
-        conn.commit()
+        # Other processes re-read the key as soon as they see the
+        # invalidation, so the persisted copy goes in the same transaction.
+        # Inside the write that changed the data, every key it deletes is
+        # dropped and published together just before that commits.
+        if not db.in_write():
+            with db.write():
+                self.delete(key)
+            return
+        with self._dirty_lock:
+            if self._dirty.pop(key, _MISSING) is not _MISSING:
+                self._append(["drop", key])
+        if not self._doomed:
+            db.before_commit(self._delete_doomed, self._doomed.clear)
+        self._doomed.add(key)
+    
+    def _delete_doomed(self):
+        keys, self._doomed = self._doomed, set()
+        if not keys:
+            return
+        with db.write() as cur:
+            cur.many("cache.delete", [(key,) for key in keys])
+        self.channel.publish(keys=keys)
+        
+        def drop():
+            # Evict anything reloaded from the old rows before the commit
+            for key in keys:
+                self.memory.delete(key)
+        db.after_commit(drop)
+    
+    def delete_namespace(self, namespace):
+        """Drop every key in a namespace from both tiers, here and in other processes"""
+        prefix = f"{namespace}:"
+        with db.write() as cur:
+            with self._dirty_lock:
+                for key in [key for key in self._dirty if key.startswith(prefix)]:
+                    del self._dirty[key]
+                self._append(["drop_namespace", prefix])
+            # ";" sorts right after ":", so this is every key with the prefix
+            cur.run("cache.delete_range", (prefix, f"{namespace};"))
+            if self.channel is not None:
+                self.channel.publish(namespaces=(namespace,))
+        
+        self.memory.drop_namespace(namespace)
+        if self.channel is not None:
+            self.channel.run_handlers(namespace)
+    
+    def forget(self, keys):
+        """Drop keys after another process changed them, including unflushed copies"""
+        with self._lock:
+            # Bumped together with the drop, so no set_missing() slips in between
+            self._missing_epoch += 1
+            for key in keys:
+                self.memory.delete(key)
+        with self._dirty_lock:
+            for key in keys:
+                if self._dirty.pop(key, _MISSING) is not _MISSING:
+                    self._append(["drop", key])
+    
+    def _segment(self, seq):
+        return f"{self.journal_path}.{seq}"
+    
+    def _open_segment(self):
+        if self.journal_path:
+            self._journal = os.open(self._segment(self.seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._segments.append(self.seq)
+    
+    def _append(self, record):
+        # Called with _dirty_lock held, so lines follow the order of the writes
+        if self._journal is not None:
+            os.write(self._journal, json.dumps(record, separators=(",", ":")).encode() + b"\n")
+    
+    def recover(self):
+        """Write back journal segments left by a crash and open the next one"""
+        # Like flush(), hold the write lock before _dirty_lock
+        with db.write() as cur:
+            if self._ready:
+                return
+            
+            segments = []
+            if self.journal_path:
+                folder, prefix = os.path.split(self.journal_path)
+                for name in os.listdir(folder or "."):
+                    suffix = name[len(prefix) + 1:]
+                    if name.startswith(f"{prefix}.") and suffix.isdigit():
+                        segments.append(int(suffix))
+            
+            rows = {}
+            for seq in sorted(segments):
+                with open(self._segment(seq)) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # Torn final line
+                            continue
+                        if record[0] == "set":
+                            _, key, expires, created, encoded = record
+                            rows[key] = (base64.b64decode(encoded), expires, created)
+                        elif record[0] == "delete":
+                            rows[record[1]] = None
+                        elif record[0] == "drop":
+                            rows.pop(record[1], None)
+                        elif record[0] == "drop_namespace":
+                            for key in [key for key in rows if key.startswith(record[1])]:
+                                del rows[key]
+            
+            if rows:
+                now = int(time.time())
+                # Older entries may have missed invalidations that were pruned since
+                horizon = now - CACHE_INVALIDATION_RETENTION
+                invalidated = {}
+                for row in cur.all("cache.invalidated_since", (horizon,)):
+                    invalidated[row['key'] or f"{row['namespace']}:"] = row['created_at']
+                
+                def fresh(key, row):
+                    if row[2] < horizon or (row[1] is not None and row[1] <= now):
+                        return False
+                    changed = max(invalidated.get(key, 0), invalidated.get(f"{MemoryTier.namespace(key)}:", 0))
+                    return changed < row[2]
+                
+                stale = [key for key, row in rows.items() if row is not None and not fresh(key, row)]
+                for key in stale:
+                    del rows[key]
+                cur.many("cache.set", [(key, *row) for key, row in rows.items() if row is not None])
+                cur.many("cache.delete", [(key,) for key, row in rows.items() if row is None])
+                logger.info(f"♻️ Replayed {len(rows)} cache writes from the journal, skipped {len(stale)} stale")
+            
+            with self._dirty_lock:
+                self.seq = max(segments, default=0) + 1
+                self._open_segment()
+                self._ready = True
+            
+            def replayed():
+                for seq in segments:
+                    os.remove(self._segment(seq))
+            
+            def rolled_back():
+                # Leave the segments for the next attempt
+                with self._dirty_lock:
+                    if self._journal is not None:
+                        os.close(self._journal)
+                        self._journal = None
+                    self._segments.clear()
+                    self._ready = False
+            
+            db.after_commit(replayed, rolled_back)
+    
+    def _mark_dirty(self, key, row):
+        if not self._ready:
+            self.recover()
+        
+        with self._dirty_lock:
+            self._dirty[key] = row
+            if row is None:
+                self._append(["delete", key])
+            else:
+                self._append(["set", key, row[1], row[2], base64.b64encode(row[0]).decode()])
+            backlog = len(self._dirty)
+        
+        if backlog >= self.flush_threshold:
+            if self.flusher is not None and self.flusher.is_alive():
+                self.flusher.wake()
+            elif not db.in_write():
+                self.flush()
+    
+    def flush(self):
+        """Write every dirty key to SQLite in one transaction"""
+        if not self._dirty:
+            return 0
+        
+        with self._flush_lock:
+            with db.write() as cur:
+                # Nobody else can commit while this transaction holds
+                # the write lock, so after this poll no value about to
+                # be flushed can be older than another process's change
+                if self.channel is not None:
+                    self.channel.poll()
+                
+                # Swapped inside the transaction so a write-through
+                # delete() is ordered entirely before or after this flush
+                with self._dirty_lock:
+                    batch = self._flushing = self._dirty
+                    self._dirty = {}
+                    seq = self.seq
+                    self.seq += 1
+                    journal = self._journal
+                    self._open_segment()
+                if journal is not None:
+                    os.close(journal)
+                db.after_commit(lambda: self._flushed(seq, batch), lambda: self._restore(batch))
+                
+                for key, row in batch.items():
+                    if row is None:
+                        cur.run("cache.delete", (key,))
+                    else:
+                        cur.run("cache.set", (key, *row))
+                # Values are filled from committed rows, whose change
+                # already published its invalidation; only deletes need one
+                deleted = [key for key, row in batch.items() if row is None]
+                if deleted and self.channel is not None:
+                    self.channel.publish(keys=deleted)
+            
+            self.stats['flushes'] += 1
+            self.stats['rows_flushed'] += len(batch)
+            return len(batch)
+    
+    def _flushed(self, seq, batch):
+        with self._dirty_lock:
+            if self._flushing is batch:
+                self._flushing = {}
+            # Segments up to seq only hold writes this flush or earlier ones committed
+            done = [s for s in self._segments if s <= seq]
+            self._segments = [s for s in self._segments if s > seq]
+        for segment in done:
+            os.remove(self._segment(segment))
+    
+    def _restore(self, batch):
+        with self._dirty_lock:
+            if self._flushing is batch:
+                self._flushing = {}
+            # Retry on the next flush unless the key was written again meanwhile
+            for key, row in batch.items():
+                self._dirty.setdefault(key, row)
+    
+    def missing_token(self):
+        """Take before a lookup whose miss may be passed to set_missing()"""
+        return self._missing_epoch
+    
+    def is_missing(self, key):
+        """True if key was recently looked up and found to have no row"""
+        if self.memory.get(f"missing:{key}") is None:
+            return False
+        self.namespace_stats[MemoryTier.namespace(key)]['negative_hits'] += 1
+        return True
+    
+    @contextmanager
+    def loading(self, key):
+        """Time the load that follows a miss on key"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.namespace_stats[MemoryTier.namespace(key)]
+            stats['loads'] += 1
+            stats['load_ms'] += (time.perf_counter() - start) * 1000
+    
+    def snapshot(self):
+        """Hit rates, size, churn and load latency per key namespace"""
+        usage = self.memory.usage()
+        tier = {namespace: dict(counts) for namespace, counts in list(self.memory.namespace_stats.items())}
+        own = {namespace: dict(counts) for namespace, counts in list(self.namespace_stats.items())}
+        
+        namespaces = {}
+        for namespace in sorted(set(usage) | set(tier) | set(own)):
+            held = usage.get(namespace, {})
+            memory = tier.get(namespace, {})
+            counts = own.get(namespace, {})
+            hits = memory.get('hits', 0)
+            db_hits = counts.get('db_hits', 0)
+            misses = counts.get('misses', 0)
+            lookups = hits + db_hits + misses
+            loads = counts.get('loads', 0)
+            namespaces[namespace] = {
+                "entries": held.get('entries', 0),
+                "bytes": held.get('bytes', 0),
+                "hits": hits,
+                "db_hits": db_hits,
+                "misses": misses,
+                "hit_rate": round((hits + db_hits) / lookups, 3) if lookups else None,
+                "negative_hits": counts.get('negative_hits', 0),
+                "evictions": memory.get('evictions', 0),
+                "expirations": memory.get('expirations', 0),
+                "loads": loads,
+                "avg_load_ms": round(counts.get('load_ms', 0) / loads, 3) if loads else None
+            }
+        
+        return {
+            "entries": self.memory.entries,
+            "bytes": self.memory.bytes,
+            "max_entries": self.memory.max_entries,
+            "max_bytes": self.memory.max_bytes,
+            "pending_writes": self.pending(),
+            "flushes": self.stats['flushes'],
+            "rows_flushed": self.stats['rows_flushed'],
+            "decode_errors": self.stats['decode_errors'],
+            "namespaces": namespaces
+        }
+    
+    def set_missing(self, key, token, ttl=None):
+        """Remember for a short time, in memory only, that key has no row.
+
+        Skipped if clear_missing() ran since token was taken, because the
+        row may have been inserted after the lookup read.
+        """
+        with self._lock:
+            if token == self._missing_epoch:
+                self.memory.set(f"missing:{key}", True, ttl or NEGATIVE_CACHE_TTL)
+    
+    def clear_missing(self, *keys):
+        """Forget negative entries; call in the write that inserts the rows.
+
+        Outside a write they are forgotten at once. Inside one, other
+        processes are told with that transaction and this one forgets
+        them once it commits, when the rows become visible.
+        """
+        keys = [f"missing:{key}" for key in keys]
+        db.after_commit(lambda: self.forget(keys))
+        if self.channel is not None:
+            self.channel.publish(keys=keys)
+    
+    def pending(self):
+        """Number of writes waiting for the next flush"""
+        with self._dirty_lock:
+            return len(self._dirty)
     
     def clear(self):
         """Clear expired cache"""
-        cur.execute("DELETE FROM cache WHERE expires_at < ?", (int(time.time()),))
-        conn.commit()
+        self.flush()
+        with db.write() as cur:
+            cur.run("cache.purge_expired", (int(time.time()),))
+            if self.channel is not None:
+                self.channel.prune(cur)
         
         # Clear expired memory cache
-        now = time.time()
-        self.memory_cache = {k: v for k, v in self.memory_cache.items() 
-                           if k in self.cache_timestamps and self.cache_timestamps[k] > now}
+        self.memory.purge_expired()
+
+CACHE_FLUSH_INTERVAL = float(os.getenv("CACHE_FLUSH_INTERVAL", "1"))
+CACHE_FLUSH_MAX = int(os.getenv("CACHE_FLUSH_MAX", "500"))
+CACHE_JOURNAL = os.getenv("CACHE_JOURNAL", f"{DATABASE_PATH}.cache")
+
+cache = CacheManager(flush_threshold=CACHE_FLUSH_MAX, codecs=cache_codecs, journal_path=CACHE_JOURNAL)
+
+class CacheFlusher(BackgroundTask):
+    """Flush dirty cache keys on a timer, or early when the backlog is large"""
+
+    def __init__(self, cache_manager, interval):
+        super().__init__("cache-flusher", interval)
+        self.cache_manager = cache_manager
+        cache_manager.flusher = self
+
+    def run_once(self):
+        self.cache_manager.flush()
+
+    def stop(self):
+        super().stop()
+        self.cache_manager.flush()
+
+class CacheJanitor(BackgroundTask):
+    """Periodically purge expired cache entries from both tiers"""
+
+    def __init__(self, cache_manager, interval):
+        super().__init__("cache-janitor", interval)
+        self.cache_manager = cache_manager
+
+    def run_once(self):
+        self.cache_manager.clear()
+
+cache_flusher = CacheFlusher(cache, CACHE_FLUSH_INTERVAL)
+cache_janitor = CacheJanitor(cache, CACHE_PURGE_INTERVAL)
+
+# Pending cache writes survive a normal interpreter exit even without main()
+atexit.register(cache.flush)
+
+# ==================== CACHE INVALIDATION ====================
+
+CACHE_INVALIDATION_POLL = float(os.getenv("CACHE_INVALIDATION_POLL", "0.25"))
+CACHE_INVALIDATION_RETENTION = int(os.getenv("CACHE_INVALIDATION_RETENTION", "3600"))
+
+class InvalidationChannel:
+    """Broadcast cache invalidations to every process sharing the database.
+
+    Invalidations are rows in cache_invalidations, written in the same
+    transaction as the change they describe. Each process checks
+    PRAGMA data_version on a connection of its own, which only changes
+    after some other connection commits, and reads new rows only then.
+    Keys are dropped from the memory tier; a namespace invalidation drops
+    the whole namespace and runs the handlers registered for it. Setting
+    CACHE_INVALIDATION_POLL=0 turns publishing and polling off for
+    single-process deployments.
+    """
+
+    def __init__(self, pool, cache_manager, enabled=True):
+        self.pool = pool
+        self.cache_manager = cache_manager
+        self.enabled = enabled
+        self.origin = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.handlers = defaultdict(list)
+        self.stats = defaultdict(int)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._data_version = None
+        self._last_id = 0
+        self._outbox = set()  # (key, namespace) published by the open transaction
+        cache_manager.channel = self
+        if enabled:
+            self._conn = pool._connect()
+            self._last_id = self._conn.execute(queries.sql("cache.invalidations_last")).fetchone()[0]
+
+    def on_namespace(self, namespace, handler):
+        """Call handler whenever a namespace is invalidated, here or elsewhere"""
+        self.handlers[namespace].append(handler)
+
+    def run_handlers(self, namespace):
+        for handler in self.handlers[namespace]:
+            handler()
+
+    def publish(self, keys=(), namespaces=()):
+        """Record invalidations with the caller's write transaction.
+
+        They are collected until just before it commits and written once
+        per key, in one statement. Outside a write they get a
+        transaction of their own.
+        """
+        if not self.enabled:
+            return
+        if not self.pool.in_write():
+            with self.pool.write():
+                self.publish(keys, namespaces)
+            return
+        if not self._outbox:
+            self.pool.before_commit(self._write_outbox, self._outbox.clear)
+        self._outbox.update((key, None) for key in keys)
+        self._outbox.update((None, namespace) for namespace in namespaces)
+
+    def _write_outbox(self):
+        entries, self._outbox = self._outbox, set()
+        if not entries:
+            return
+        now = int(time.time())
+        with self.pool.write() as cur:
+            cur.many("cache.invalidation_publish", [(self.origin, key, namespace, now) for key, namespace in entries])
+        self.stats['published'] += len(entries)
+
+    def poll(self):
+        """Apply invalidations committed by other processes; returns how many"""
+        if not self.enabled:
+            return 0
+        
+        with self._lock:
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version:
+                return 0
+            self._data_version = version
+            
+            cur = self._conn.cursor(QueryCursor)
+            try:
+                rows = cur.all("cache.invalidations_since", (self._last_id, self.origin))
+            finally:
+                cur.close()
+            if rows:
+                self._last_id = rows[-1]['id']
+        
+        keys = [row['key'] for row in rows if row['key'] is not None]
+        if keys:
+            self.cache_manager.forget(keys)
+        for row in rows:
+            if row['namespace'] is not None:
+                self.cache_manager.memory.drop_namespace(row['namespace'])
+                self.run_handlers(row['namespace'])
+        
+        self.stats['polls'] += 1
+        self.stats['applied'] += len(rows)
+        return len(rows)
+
+    def prune(self, cur):
+        """Drop invalidations every process has had time to see"""
+        cur.run("cache.invalidations_prune", (int(time.time()) - CACHE_INVALIDATION_RETENTION,))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self.enabled = False
+
+class InvalidationListener(BackgroundTask):
+    """Poll the invalidation channel between requests"""
+
+    def __init__(self, channel, interval):
+        super().__init__("cache-invalidations", interval)
+        self.channel = channel
+
+    def run_once(self):
+        self.channel.poll()
+
+invalidations = InvalidationChannel(db, cache, enabled=CACHE_INVALIDATION_POLL > 0)
+invalidation_listener = InvalidationListener(invalidations, CACHE_INVALIDATION_POLL or 1)
+
+# ==================== REQUEST COALESCING ====================
+
+class _Flight:
+    """One in-progress load that other callers can wait on"""
+
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Collapse concurrent loads of the same key into one.
+
+    The first caller for a key runs the load; callers arriving while it is
+    in flight wait and receive the same result (or exception). Loads made
+    inside a write transaction bypass coalescing because they may see
+    uncommitted rows, as do re-entrant loads of a key the thread is
+    already loading.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = defaultdict(lambda: {"loads": 0, "shared": 0})
+
+    def do(self, namespace, key, load):
+        """Run load() once for all concurrent callers of (namespace, key)"""
+        if db.in_write():
+            return load()
+
+        flight_key = (namespace, key)
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            if flight is None:
+                flight = self._flights[flight_key] = _Flight()
+                leader = True
+            elif flight.owner == threading.get_ident():
+                flight, leader = None, False
+            else:
+                flight.waiters += 1
+                self.stats[namespace]['shared'] += 1
+                leader = False
+
+        if flight is None:
+            return load()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = load()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[flight_key]
+                self.stats[namespace]['loads'] += 1
+            flight.done.set()
+
+    def snapshot(self):
+        """Loads run and duplicate loads suppressed, per namespace and in total"""
+        with self._lock:
+            stats = {namespace: dict(counts) for namespace, counts in self.stats.items()}
+            in_flight = len(self._flights)
+        return {
+            "loads": sum(counts['loads'] for counts in stats.values()),
+            "shared": sum(counts['shared'] for counts in stats.values()),
+            "in_flight": in_flight,
+            "namespaces": stats
+        }
+
+single_flight = SingleFlight()
 
-cache = CacheManager()
+def cached_lookup(key, name, params):
+    """Run a single-row query, remembering a miss for NEGATIVE_CACHE_TTL seconds.
+
+    For rows that are only inserted when the schema is seeded; lookups of
+    rows inserted at runtime must also call cache.clear_missing() there.
+    """
+    if cache.is_missing(key):
+        return None
+    
+    token = cache.missing_token()
+    with cache.loading(key), db.read() as cur:
+        row = cur.one(name, params)
+    if row is None:
+        cache.set_missing(key, token)
+    return row
+
+def coalesced(namespace):
+    """Share one in-flight call among concurrent callers with the same arguments"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            return single_flight.do(namespace, args, lambda: func(*args))
+        return wrapper
+    return decorator
 
 # ==================== USER MANAGER ====================
 
+queries.register({
+    "users.get": "SELECT * FROM users WHERE user_id=?",
+    "users.id_by_telegram": "SELECT user_id FROM users WHERE telegram_id=?",
+    "users.telegram_by_id": "SELECT telegram_id FROM users WHERE user_id=?",
+    "users.insert": """
+        INSERT INTO users (
+            user_id, username, first_name, last_name, role, plan_id,
+            created_at, updated_at, telegram_id, referral_code, coin_balance
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+    "levels.insert_default": """
+        INSERT INTO user_levels (user_id, next_level_xp, created_at, updated_at)
+        VALUES (?, ?, ?, ?)
+    """,
+    "users.by_username": "SELECT * FROM users WHERE username=?",
+    "users.insert_web_admin": """
+        INSERT INTO users (user_id, username, role, created_at)
+        VALUES (?, ?, 'admin', ?)
+    """
+})
+
+IDENTITY_MAP_SIZE = int(os.getenv("IDENTITY_MAP_SIZE", "100000"))
+
+class IdentityMap:
+    """Bidirectional telegram_id <-> user_id map.
+
+    Pairs are loaded lazily on first lookup and added by create_user. A
+    user's Telegram id never changes, so entries need no invalidation;
+    past max_entries the least recently used pairs are dropped.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._by_telegram = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def remember(self, user_id, telegram_id):
+        """Record the pairing for a user"""
+        user_id, telegram_id = str(user_id), str(telegram_id)
+        with self._lock:
+            self._by_telegram[telegram_id] = user_id
+            self._by_telegram.move_to_end(telegram_id)
+            self._by_user[user_id] = telegram_id
+            while len(self._by_telegram) > self.max_entries:
+                _, evicted = self._by_telegram.popitem(last=False)
+                self._by_user.pop(evicted, None)
+
+    def cached(self, telegram_id):
+        """user_id for a Telegram id if it is already mapped, without touching the database"""
+        telegram_id = str(telegram_id)
+        with self._lock:
+            user_id = self._by_telegram.get(telegram_id)
+            if user_id is not None:
+                self._by_telegram.move_to_end(telegram_id)
+        return user_id
+
+    def user_id(self, telegram_id):
+        """Internal user_id for a Telegram id, or None if there is no such user"""
+        user_id = self.cached(telegram_id)
+        if user_id is not None:
+            self.stats['hits'] += 1
+            return user_id
+        
+        self.stats['misses'] += 1
+        return single_flight.do("identity", str(telegram_id), lambda: self._load_user_id(str(telegram_id)))
+
+    def _load_user_id(self, telegram_id):
+        # Unregistered chats are remembered so repeats never reach SQLite
+        if cache.is_missing(f"telegram:{telegram_id}"):
+            return None
+        
+        token = cache.missing_token()
+        with cache.loading(f"telegram:{telegram_id}"), db.read() as cur:
+            row = cur.one("users.id_by_telegram", (telegram_id,))
+        if row is None:
+            cache.set_missing(f"telegram:{telegram_id}", token)
+            return None
+        self.remember(row['user_id'], telegram_id)
+        return row['user_id']
+
+    def telegram_id(self, user_id):
+        """Telegram id for an internal user_id, or None if the user has none"""
+        user_id = str(user_id)
+        with self._lock:
+            telegram_id = self._by_user.get(user_id)
+        if telegram_id is not None:
+            self.stats['hits'] += 1
+            return telegram_id
+        
+        self.stats['misses'] += 1
+        with db.read() as cur:
+            row = cur.one("users.telegram_by_id", (user_id,))
+        if row is None or not row['telegram_id']:
+            return None
+        self.remember(user_id, row['telegram_id'])
+        return row['telegram_id']
+
+    def canonical(self, user_id):
+        """Internal user_id for either kind of id"""
+        user_id = str(user_id)
+        # Telegram ids are numeric, internal ids are UUIDs
+        if user_id.isdigit():
+            return self.user_id(user_id)
+        return user_id
+
+identity_map = IdentityMap(IDENTITY_MAP_SIZE)
+
 def get_user(user_id):
-    """Get user by ID"""
+    """Get user by internal ID or Telegram ID"""
+    user_id = identity_map.canonical(user_id)
+    if user_id is None:
+        return None
+    
     # Try cache first
-    cache_key = f"user:{user_id}"
-    cached = cache.get(cache_key)
+    cached = cache.get(f"user:{user_id}")
     if cached:
-        return cached
+        return activity_aggregator.merge(cached)
+    return activity_aggregator.merge(_load_user(user_id))
+
+@coalesced("user")
+def _load_user(user_id):
+    """Load a user row into the cache; concurrent misses share one query"""
+    if cache.is_missing(f"user:{user_id}"):
+        return None
     
-    cur.execute("SELECT * FROM users WHERE user_id=? OR telegram_id=?", (str(user_id), str(user_id)))
-    row = cur.fetchone()
+    token = cache.missing_token()
+    with cache.loading(f"user:{user_id}"), db.read() as cur:
+        row = cur.one("users.get", (user_id,))
     if row:
         user = dict(row)
-        cache.set(cache_key, user, 300)  # Cache for 5 minutes
+        row_codec.register(user)
+        cache.set(f"user:{user_id}", user, 300)  # Cache for 5 minutes
+        if user['telegram_id']:
+            identity_map.remember(user_id, user['telegram_id'])
         return user
+    cache.set_missing(f"user:{user_id}", token)
     return None
 
+@db_write
 def create_user(telegram_id, username="", first_name="", last_name=""):
     """Create new user"""
     user_id = str(uuid.uuid4())
@@ -778,35 +2608,25 @@ def create_user(telegram_id, username="", first_name="", last_name=""):
     referral_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
     
     try:
-        cur.execute("""
-            INSERT INTO users (
-                user_id, username, first_name, last_name, role, plan_id,
-                created_at, updated_at, telegram_id, referral_code, coin_balance
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user_id, username, first_name, last_name, "user", "free",
-            now, now, str(telegram_id), referral_code, 1000
-        ))
-        
-        # Create level entry
-        cur.execute("""
-            INSERT INTO user_levels (user_id, created_at, updated_at)
-            VALUES (?, ?, ?)
-        """, (user_id, now, now))
-        
-        conn.commit()
+        with db.write() as cur:
+            cur.run("users.insert", (
+                user_id, username, first_name, last_name, "user", "free",
+                now, now, str(telegram_id), referral_code, 1000
+            ))
+            
+            # Create level entry
+            cur.run("levels.insert_default", (user_id, LEVEL_BASE_XP, now, now))
+            cache.clear_missing(f"telegram:{telegram_id}", f"user:{user_id}", f"username:{username}")
         
-        # Clear cache
-        cache.delete(f"user:{telegram_id}")
-        cache.delete(f"user:{user_id}")
+        identity_map.remember(user_id, telegram_id)
         
         logger.info(f"✅ New user created: {telegram_id}")
         return user_id
     except Exception as e:
         logger.error(f"Error creating user: {e}")
-        conn.rollback()
         return None
 
+@db_write
 def update_user(user_id, **kwargs):
     """Update user fields"""
     if not kwargs:
@@ -818,112 +2638,254 @@ def update_user(user_id, **kwargs):
         fields.append(f"{key}=?")
         values.append(value)
     
+    user_id = identity_map.canonical(user_id)
+    if user_id is None:
+        return
+    
     values.append(int(time.time()))
-    values.append(str(user_id))
+    values.append(user_id)
     
     query = f"UPDATE users SET {', '.join(fields)}, updated_at=? WHERE user_id=?"
     
     try:
-        cur.execute(query, values)
-        conn.commit()
+        with db.write() as cur:
+            cur.run("users.update", values, sql=query)
         
         # Clear cache
         cache.delete(f"user:{user_id}")
-        user = get_user(user_id)
-        if user and user.get('telegram_id'):
-            cache.delete(f"user:{user['telegram_id']}")
+        if 'role' in kwargs:
+            cache.delete_namespace("admins")
+        if 'username' in kwargs:
+            cache.clear_missing(f"username:{kwargs['username']}")
     except Exception as e:
         logger.error(f"Error updating user: {e}")
 
+def find_user_by_username(username):
+    """Get user by Telegram username"""
+    if cache.is_missing(f"username:{username}"):
+        return None
+    
+    token = cache.missing_token()
+    with db.read() as cur:
+        row = cur.one("users.by_username", (username,))
+    if row is None:
+        cache.set_missing(f"username:{username}", token)
+    return row
+
+@db_write
+def create_web_admin(username):
+    """Create admin user for the web panel"""
+    user_id = str(uuid.uuid4())
+    with db.write() as cur:
+        cur.run("users.insert_web_admin", (user_id, username, int(time.time())))
+        cache.clear_missing(f"user:{user_id}", f"username:{username}")
+    return user_id
+
 # ==================== LEVEL & XP MANAGER ====================
 
+LEVEL_BASE_XP = int(os.getenv("LEVEL_BASE_XP", "100"))
+LEVEL_GROWTH = float(os.getenv("LEVEL_GROWTH", "1.5"))
+
+class LevelCurve:
+    """Cumulative XP thresholds of the level curve.
+
+    Reaching level n takes thresholds[n - 1] total XP; each level needs
+    int(previous * growth) XP more than the last, as the old per-user
+    loop did. A user's level, XP into it and XP to the next level all
+    follow from total_xp by one bisect.
+    """
+
+    # Keeps every threshold inside a signed 64-bit integer
+    MAX_XP = 2 ** 62
+
+    def __init__(self, base, growth):
+        self.base = base
+        self.growth = growth
+        self.signature = f"{base}:{growth}"
+        thresholds = [0]
+        step = base
+        while thresholds[-1] + step < self.MAX_XP:
+            thresholds.append(thresholds[-1] + step)
+            step = max(int(step * growth), 1)
+        self.thresholds = thresholds
+
+    def resolve(self, total_xp):
+        """(level, xp into the level, xp needed for the next level)"""
+        level = min(bisect.bisect_right(self.thresholds, total_xp), len(self.thresholds) - 1)
+        floor = self.thresholds[level - 1]
+        return level, total_xp - floor, self.thresholds[level] - floor
+
+    def recompute_all(self, cur):
+        """Re-level every user from total_xp; returns how many rows changed"""
+        changed = []
+        for row in cur.all("levels.all"):
+            level, xp, next_xp = self.resolve(row['total_xp'])
+            if (row['level'], row['xp'], row['next_level_xp']) != (level, xp, next_xp):
+                changed.append((level, xp, next_xp, row['rowid']))
+        if not changed:
+            return 0
+        cur.many("levels.relevel", changed)
+        return len(changed)
+
+level_curve = LevelCurve(LEVEL_BASE_XP, LEVEL_GROWTH)
+
+queries.register({
+    "levels.get": "SELECT * FROM user_levels WHERE user_id=?",
+    "levels.add_xp": """
+        INSERT INTO user_levels (user_id, xp, total_xp, next_level_xp, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            xp = xp + excluded.xp,
+            total_xp = total_xp + excluded.total_xp,
+            updated_at = excluded.updated_at
+        RETURNING level, total_xp
+    """,
+    "levels.level_up": """
+        UPDATE user_levels
+        SET level=?, xp=?, next_level_xp=?, updated_at=?
+        WHERE user_id=?
+    """,
+    "levels.all": "SELECT rowid, level, xp, next_level_xp, COALESCE(total_xp, 0) AS total_xp FROM user_levels",
+    "levels.relevel": "UPDATE user_levels SET level=?, xp=?, next_level_xp=? WHERE rowid=?",
+    "config.set": """
+        INSERT INTO system_config (key, value, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
+    """
+})
+
 class LevelManager:
     """Manage user levels and XP"""
     
+    @db_write
     def add_xp(self, user_id, xp_amount):
         """Add XP to user"""
-        cur.execute("SELECT * FROM user_levels WHERE user_id=?", (str(user_id),))
-        level_data = cur.fetchone()
-        
-        if not level_data:
-            # Create level data
-            cur.execute("""
-                INSERT INTO user_levels (user_id, xp, total_xp, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?)
-            """, (str(user_id), xp_amount, xp_amount, int(time.time()), int(time.time())))
-            conn.commit()
-            return self.check_level_up(user_id)
-        
-        current_xp = level_data['xp'] + xp_amount
-        total_xp = level_data['total_xp'] + xp_amount
-        
-        cur.execute("""
-            UPDATE user_levels 
-            SET xp=?, total_xp=?, updated_at=?
-            WHERE user_id=?
-        """, (current_xp, total_xp, int(time.time()), str(user_id)))
-        conn.commit()
-        
-        return self.check_level_up(user_id)
-    
-    def check_level_up(self, user_id):
-        """Check if user leveled up"""
-        cur.execute("SELECT * FROM user_levels WHERE user_id=?", (str(user_id),))
-        level_data = cur.fetchone()
-        
-        if not level_data:
+        now = int(time.time())
+        with db.write() as cur:
+            row = cur.one("levels.add_xp", (str(user_id), xp_amount, xp_amount, LEVEL_BASE_XP, now, now))
+            return self.check_level_up(cur, user_id, row['level'], row['total_xp'])
+    
+    def check_level_up(self, cur, user_id, level, total_xp):
+        """Move the user to the level total_xp reaches, inside the caller's write"""
+        new_level, xp, next_xp = level_curve.resolve(total_xp)
+        if new_level <= level:
             return False
         
-        level = level_data['level']
-        xp = level_data['xp']
-        next_xp = level_data['next_level_xp']
+        cur.run("levels.level_up", (new_level, xp, next_xp, int(time.time()), str(user_id)))
         
-        leveled_up = False
-        while xp >= next_xp:
-            level += 1
-            xp -= next_xp
-            next_xp = int(next_xp * 1.5)  # Increase requirement
-            leveled_up = True
+        # Award coins for level up
+        coin_reward = new_level * 100
+        coin_manager.add_coins(user_id, coin_reward, f"level_up_{new_level}")
+        return True
+    
+    @db_write
+    def rebalance(self):
+        """Re-level everyone if the curve changed since the last run"""
+        if catalog.config("level_curve") == level_curve.signature:
+            return 0
         
-        if leveled_up:
-            cur.execute("""
-                UPDATE user_levels 
-                SET level=?, xp=?, next_level_xp=?, updated_at=?
-                WHERE user_id=?
-            """, (level, xp, next_xp, int(time.time()), str(user_id)))
-            conn.commit()
-            
-            # Award coins for level up
-            coin_reward = level * 100
-            cur.execute("""
-                UPDATE users SET coin_balance = coin_balance + ? 
-                WHERE user_id=?
-            """, (coin_reward, str(user_id)))
-            conn.commit()
+        started = time.perf_counter()
+        with db.write() as cur:
+            changed = level_curve.recompute_all(cur)
+            cur.run("config.set", ("level_curve", level_curve.signature, int(time.time())))
+        catalog.reload("config")
         
-        return leveled_up
+        logger.info(f"📈 Level curve {level_curve.signature}: re-levelled {changed} users in {time.perf_counter() - started:.2f}s")
+        return changed
     
+    @coalesced("level")
     def get_level_info(self, user_id):
         """Get user level info"""
-        cur.execute("SELECT * FROM user_levels WHERE user_id=?", (str(user_id),))
-        return cur.fetchone()
+        with db.read() as cur:
+            return activity_aggregator.merge_levels(cur.one("levels.get", (str(user_id),)))
 
 level_manager = LevelManager()
 
 # ==================== COIN MANAGER ====================
 
+queries.register({
+    # One statement per movement: the row carries the resulting balance
+    # and the coin_transactions_apply trigger moves users.coin_balance
+    "coins.credit": """
+        INSERT INTO coin_transactions (user_id, amount, balance_after, reason, idempotency_key, created_at)
+        SELECT user_id, ?, coin_balance + ?, ?, ?, ? FROM users
+        WHERE user_id=?
+        ON CONFLICT(idempotency_key) DO NOTHING
+        RETURNING balance_after
+    """,
+    "coins.debit": """
+        INSERT INTO coin_transactions (user_id, amount, balance_after, reason, idempotency_key, created_at)
+        SELECT user_id, -?, coin_balance - ?, ?, ?, ? FROM users
+        WHERE user_id=? AND coin_balance >= ?
+        ON CONFLICT(idempotency_key) DO NOTHING
+        RETURNING balance_after
+    """,
+    "coins.history": """
+        SELECT amount, balance_after, reason, created_at FROM coin_transactions
+        WHERE user_id=?
+        ORDER BY id DESC
+        LIMIT ?
+    """,
+    "coins.snapshot_watermark": "SELECT COALESCE(MAX(last_txn_id), 0) AS id FROM coin_snapshots",
+    "coins.snapshot_fold": """
+        INSERT INTO coin_snapshots (user_id, balance, last_txn_id, taken_at)
+        SELECT t.user_id, COALESCE(s.balance, 0) + SUM(t.amount), MAX(t.id), ?
+        FROM coin_transactions t
+        LEFT JOIN coin_snapshots s ON s.user_id = t.user_id
+        WHERE t.id > ?
+        GROUP BY t.user_id
+        ON CONFLICT(user_id) DO UPDATE SET
+            balance = excluded.balance,
+            last_txn_id = excluded.last_txn_id,
+            taken_at = excluded.taken_at
+    """,
+    "coins.snapshot_drift": """
+        SELECT s.user_id, s.balance, u.coin_balance FROM coin_snapshots s
+        JOIN users u ON u.user_id = s.user_id
+        WHERE s.taken_at = ? AND s.balance != u.coin_balance
+    """,
+    # Claims at most once per day; the streak continues from yesterday
+    "coins.claim": """
+        INSERT INTO daily_claims (user_id, last_claim, streak) VALUES (?, ?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET
+            streak = CASE WHEN last_claim >= ? THEN streak + 1 ELSE 1 END,
+            last_claim = excluded.last_claim
+        WHERE COALESCE(last_claim, 0) < ?
+        RETURNING streak
+    """,
+    "coins.streak": "SELECT streak FROM daily_claims WHERE user_id=?"
+})
+
+# Days for daily claims start at midnight here; empty means server local time
+DAILY_CLAIM_TIMEZONE = os.getenv("DAILY_CLAIM_TIMEZONE", "")
+DAILY_CLAIM_TZ = ZoneInfo(DAILY_CLAIM_TIMEZONE) if DAILY_CLAIM_TIMEZONE else None
+
+def claim_day(ts):
+    """(date, start, end) of the claim day containing timestamp ts"""
+    day = datetime.fromtimestamp(ts, DAILY_CLAIM_TZ).date()
+    start, end = (
+        int(datetime.combine(d, datetime.min.time(), DAILY_CLAIM_TZ).timestamp())
+        for d in (day, day + timedelta(days=1))
+    )
+    return day, start, end
+
 class CoinManager:
-    """Manage user coins"""
+    """Manage user coins.
+
+    Every movement is one row in the append-only coin_transactions
+    ledger, written by a single INSERT; a trigger applies it to
+    users.coin_balance. Debits only insert while the balance covers them,
+    so concurrent spends cannot overdraw. A movement given an idempotency
+    key is recorded at most once; repeating it returns False.
+    """
     
-    def add_coins(self, user_id, amount, reason=""):
+    @db_write
+    def add_coins(self, user_id, amount, reason="", key=None):
         """Add coins to user"""
-        cur.execute("""
-            UPDATE users 
-            SET coin_balance = coin_balance + ?, 
-                total_coins_earned = total_coins_earned + ?
-            WHERE user_id=?
-        """, (amount, amount, str(user_id)))
-        conn.commit()
+        with db.write() as cur:
+            row = cur.one("coins.credit", (amount, amount, reason, key, int(time.time()), str(user_id)))
+        
+        if not row:
+            return False
         
         # Clear cache
         cache.delete(f"user:{user_id}")
@@ -931,19 +2893,16 @@ class CoinManager:
         logger.info(f"Added {amount} coins to {user_id} for {reason}")
         return True
     
-    def spend_coins(self, user_id, amount, reason=""):
-        """Spend coins"""
-        user = get_user(user_id)
-        if not user or user['coin_balance'] < amount:
-            return False
+    @db_write
+    def spend_coins(self, user_id, amount, reason="", key=None):
+        """Spend coins if the balance covers them"""
+        with db.write() as cur:
+            # Message coins not yet flushed count towards the balance
+            activity_aggregator.settle(user_id)
+            row = cur.one("coins.debit", (amount, amount, reason, key, int(time.time()), str(user_id), amount))
         
-        cur.execute("""
-            UPDATE users 
-            SET coin_balance = coin_balance - ?,
-                total_coins_spent = total_coins_spent + ?
-            WHERE user_id=?
-        """, (amount, amount, str(user_id)))
-        conn.commit()
+        if not row:
+            return False
         
         # Clear cache
         cache.delete(f"user:{user_id}")
@@ -951,56 +2910,164 @@ class CoinManager:
         logger.info(f"{user_id} spent {amount} coins on {reason}")
         return True
     
+    def get_history(self, user_id, limit=10):
+        """Most recent coin movements, newest first"""
+        with db.read() as cur:
+            return cur.all("coins.history", (str(user_id), limit))
+    
     def get_balance(self, user_id):
         """Get user coin balance"""
         user = get_user(user_id)
         return user['coin_balance'] if user else 0
     
+    @db_write
     def daily_claim(self, user_id):
-        """Claim daily coins"""
-        today = datetime.now().strftime("%Y-%m-%d")
-        
-        cur.execute("SELECT * FROM daily_claims WHERE user_id=?", (str(user_id),))
-        claim = cur.fetchone()
-        
+        """Claim daily coins.
+
+        The claim row and the coins go in one transaction, and the UPSERT
+        only matches when the last claim was before today, so concurrent
+        claims cannot both succeed. Users who already claimed are turned
+        away from memory until the next day starts.
+        """
+        user_id = str(user_id)
         now = int(time.time())
-        today_start = int(datetime.now().replace(hour=0, minute=0, second=0).timestamp())
         
-        if claim and claim['last_claim'] >= today_start:
-            return False, "Already claimed today"
-        
-        # Calculate streak
-        streak = 1
-        if claim:
-            yesterday_start = today_start - 86400
-            if claim['last_claim'] >= yesterday_start:
-                streak = claim['streak'] + 1
-            else:
-                streak = 1
-        
-        # Base coins + streak bonus
-        base_coins = 1000
-        bonus = min(streak * 100, 1000)  # Max 1000 bonus
-        total_coins = base_coins + bonus
-        
-        self.add_coins(user_id, total_coins, f"daily_claim_streak_{streak}")
+        next_claim = cache.memory.get(f"claim:{user_id}")
+        if next_claim is not None and now < next_claim:
+            return False, {"next_claim": next_claim}
+        
+        day, today_start, next_claim = claim_day(now)
+        yesterday_start = claim_day(today_start - 1)[1]
+        
+        with db.write() as cur:
+            claim = cur.one("coins.claim", (user_id, now, yesterday_start, today_start))
+            if claim:
+                # Base coins + streak bonus
+                streak = claim['streak']
+                base_coins = 1000
+                bonus = min(streak * 100, 1000)  # Max 1000 bonus
+                total_coins = base_coins + bonus
+                
+                self.add_coins(user_id, total_coins, f"daily_claim_streak_{streak}")
         
-        # Update claim record
-        cur.execute("""
-            INSERT OR REPLACE INTO daily_claims (user_id, last_claim, streak)
-            VALUES (?, ?, ?)
-        """, (str(user_id), now, streak))
-        conn.commit()
+        cache.memory.set(f"claim:{user_id}", next_claim, next_claim - now)
         
-        return True, {"coins": total_coins, "streak": streak, "bonus": bonus}
+        if not claim:
+            return False, {"next_claim": next_claim}
+        return True, {"coins": total_coins, "streak": streak, "bonus": bonus, "next_claim": next_claim}
+    
+    def get_streak(self, user_id):
+        """Get current daily claim streak"""
+        with db.read() as cur:
+            claim = cur.one("coins.streak", (str(user_id),))
+        return claim['streak'] if claim else 0
 
 coin_manager = CoinManager()
 
+COIN_SNAPSHOT_INTERVAL = int(os.getenv("COIN_SNAPSHOT_INTERVAL", "900"))
+
+class CoinSnapshotter(BackgroundTask):
+    """Fold new ledger rows into per-user balance snapshots.
+
+    A snapshot is the balance after last_txn_id, so auditing or
+    rebuilding a balance only replays the ledger tail. Each fold also
+    checks the snapshots it wrote against users.coin_balance.
+    """
+
+    def __init__(self, interval):
+        super().__init__("coin-snapshotter", interval)
+        self.watermark = None
+
+    def run_once(self):
+        now = int(time.time())
+        with db.write() as cur:
+            if self.watermark is None:
+                self.watermark = cur.one("coins.snapshot_watermark")['id']
+            folded = cur.run("coins.snapshot_fold", (now, self.watermark)).rowcount
+            if not folded:
+                return
+            drift = cur.all("coins.snapshot_drift", (now,))
+            self.watermark = cur.one("coins.snapshot_watermark")['id']
+        
+        for row in drift:
+            logger.warning(f"⚠️ Coin ledger drift for {row['user_id']}: ledger {row['balance']}, balance {row['coin_balance']}")
+        logger.info(f"📒 Snapshotted coin balances of {folded} users")
+
+coin_snapshotter = CoinSnapshotter(COIN_SNAPSHOT_INTERVAL)
+
 # ==================== FRIEND MANAGER ====================
 
+queries.register({
+    "friends.request_status": """
+        SELECT status FROM friend_requests
+        WHERE (from_user=? AND to_user=?) OR (from_user=? AND to_user=?)
+    """,
+    "friends.request_insert": """
+        INSERT INTO friend_requests (from_user, to_user, status, created_at, updated_at)
+        VALUES (?, ?, 'pending', ?, ?)
+    """,
+    "friends.request_accept": """
+        UPDATE friend_requests
+        SET status='accepted', updated_at=?
+        WHERE from_user=? AND to_user=? AND status='pending'
+    """,
+    "friends.insert_pair": """
+        INSERT INTO friends (user_id, friend_id, created_at)
+        VALUES (?, ?, ?), (?, ?, ?)
+    """,
+    "friends.request_reject": """
+        UPDATE friend_requests
+        SET status='rejected', updated_at=?
+        WHERE from_user=? AND to_user=? AND status='pending'
+    """,
+    "friends.delete_pair": """
+        DELETE FROM friends
+        WHERE (user_id=? AND friend_id=?) OR (user_id=? AND friend_id=?)
+    """,
+    "friends.list": """
+        SELECT u.user_id, u.username, u.first_name, u.last_name, f.created_at
+        FROM friends f
+        JOIN users u ON f.friend_id = u.user_id
+        WHERE f.user_id=?
+        ORDER BY f.created_at DESC
+    """,
+    "friends.pending": """
+        SELECT fr.*, u.username, u.first_name
+        FROM friend_requests fr
+        JOIN users u ON fr.from_user = u.user_id
+        WHERE fr.to_user=? AND fr.status='pending'
+        ORDER BY fr.created_at DESC
+    """,
+    "friends.exists": """
+        SELECT * FROM friends
+        WHERE user_id=? AND friend_id=?
+    """,
+    "blocks.insert": """
+        INSERT OR REPLACE INTO blocks (user_id, blocked_user_id, created_at)
+        VALUES (?, ?, ?)
+    """,
+    "blocks.delete": """
+        DELETE FROM blocks
+        WHERE user_id=? AND blocked_user_id=?
+    """,
+    "blocks.exists": """
+        SELECT * FROM blocks
+        WHERE user_id=? AND blocked_user_id=?
+    """,
+    "blocks.list": """
+        SELECT u.user_id, u.username, u.first_name, b.created_at
+        FROM blocks b
+        JOIN users u ON b.blocked_user_id = u.user_id
+        WHERE b.user_id=?
+        ORDER BY b.created_at DESC
+    """,
+    "friends.count": "SELECT COUNT(*) as friends FROM friends WHERE user_id=?"
+})
+
 class FriendManager:
     """Manage friend system"""
     
+    @db_write
     def send_request(self, from_user, to_user):
         """Send friend request"""
         # Check if already friends
@@ -1011,437 +3078,846 @@ class FriendManager:
         if self.is_blocked(to_user, from_user) or self.is_blocked(from_user, to_user):
             return False, "User blocked"
         
-        # Check existing request
-        cur.execute("""
-            SELECT status FROM friend_requests 
-            WHERE (from_user=? AND to_user=?) OR (from_user=? AND to_user=?)
-        """, (str(from_user), str(to_user), str(to_user), str(from_user)))
-        
-        existing = cur.fetchone()
-        if existing:
-            if existing['status'] == 'pending':
-                return False, "Request already pending"
-            elif existing['status'] == 'accepted':
-                return False, "Already friends"
-        
-        now = int(time.time())
-        cur.execute("""
-            INSERT INTO friend_requests (from_user, to_user, status, created_at, updated_at)
-            VALUES (?, ?, 'pending', ?, ?)
-        """, (str(from_user), str(to_user), now, now))
-        conn.commit()
+        with db.write() as cur:
+            # Check existing request
+            existing = cur.one("friends.request_status", (str(from_user), str(to_user), str(to_user), str(from_user)))
+            if existing:
+                if existing['status'] == 'pending':
+                    return False, "Request already pending"
+                elif existing['status'] == 'accepted':
+                    return False, "Already friends"
+            
+            now = int(time.time())
+            cur.run("friends.request_insert", (str(from_user), str(to_user), now, now))
         
         return True, "Request sent"
     
+    @db_write
     def accept_request(self, user_id, from_user):
         """Accept friend request"""
-        cur.execute("""
-            UPDATE friend_requests 
-            SET status='accepted', updated_at=?
-            WHERE from_user=? AND to_user=? AND status='pending'
-        """, (int(time.time()), str(from_user), str(user_id)))
-        
-        if cur.rowcount > 0:
-            # Add to friends table
-            now = int(time.time())
-            cur.execute("""
-                INSERT INTO friends (user_id, friend_id, created_at)
-                VALUES (?, ?, ?), (?, ?, ?)
-            """, (str(user_id), str(from_user), now, str(from_user), str(user_id), now))
-            conn.commit()
-            return True, "Friend request accepted"
+        with db.write() as cur:
+            cur.run("friends.request_accept", (int(time.time()), str(from_user), str(user_id)))
+            
+            if cur.rowcount > 0:
+                # Add to friends table
+                now = int(time.time())
+                cur.run("friends.insert_pair", (str(user_id), str(from_user), now, str(from_user), str(user_id), now))
+                return True, "Friend request accepted"
         
         return False, "No pending request"
     
+    @db_write
     def reject_request(self, user_id, from_user):
         """Reject friend request"""
-        cur.execute("""
-            UPDATE friend_requests 
-            SET status='rejected', updated_at=?
-            WHERE from_user=? AND to_user=? AND status='pending'
-        """, (int(time.time()), str(from_user), str(user_id)))
-        conn.commit()
+        with db.write() as cur:
+            cur.run("friends.request_reject", (int(time.time()), str(from_user), str(user_id)))
         return True, "Request rejected"
     
+    @db_write
     def remove_friend(self, user_id, friend_id):
         """Remove friend"""
-        cur.execute("""
-            DELETE FROM friends 
-            WHERE (user_id=? AND friend_id=?) OR (user_id=? AND friend_id=?)
-        """, (str(user_id), str(friend_id), str(friend_id), str(user_id)))
-        conn.commit()
+        with db.write() as cur:
+            cur.run("friends.delete_pair", (str(user_id), str(friend_id), str(friend_id), str(user_id)))
         return True
     
     def get_friends(self, user_id):
         """Get user's friends"""
-        cur.execute("""
-            SELECT u.user_id, u.username, u.first_name, u.last_name, f.created_at
-            FROM friends f
-            JOIN users u ON f.friend_id = u.user_id
-            WHERE f.user_id=?
-            ORDER BY f.created_at DESC
-        """, (str(user_id),))
-        return cur.fetchall()
+        with db.read() as cur:
+            return cur.all("friends.list", (str(user_id),))
     
     def get_pending_requests(self, user_id):
         """Get pending friend requests"""
-        cur.execute("""
-            SELECT fr.*, u.username, u.first_name
-            FROM friend_requests fr
-            JOIN users u ON fr.from_user = u.user_id
-            WHERE fr.to_user=? AND fr.status='pending'
-            ORDER BY fr.created_at DESC
-        """, (str(user_id),))
-        return cur.fetchall()
+        with db.read() as cur:
+            return cur.all("friends.pending", (str(user_id),))
     
     def are_friends(self, user1, user2):
         """Check if users are friends"""
-        cur.execute("""
-            SELECT * FROM friends 
-            WHERE user_id=? AND friend_id=?
-        """, (str(user1), str(user2)))
-        return cur.fetchone() is not None
+        with db.read() as cur:
+            return cur.one("friends.exists", (str(user1), str(user2))) is not None
     
+    @db_write
     def block_user(self, user_id, block_user_id):
         """Block a user"""
-        # Remove from friends if exists
-        self.remove_friend(user_id, block_user_id)
-        self.remove_friend(block_user_id, user_id)
-        
-        # Add to blocks
-        now = int(time.time())
-        cur.execute("""
-            INSERT OR REPLACE INTO blocks (user_id, blocked_user_id, created_at)
-            VALUES (?, ?, ?)
-        """, (str(user_id), str(block_user_id), now))
-        conn.commit()
+        with db.write() as cur:
+            # Remove from friends if exists
+            self.remove_friend(user_id, block_user_id)
+            self.remove_friend(block_user_id, user_id)
+            
+            # Add to blocks
+            now = int(time.time())
+            cur.run("blocks.insert", (str(user_id), str(block_user_id), now))
         return True
     
+    @db_write
     def unblock_user(self, user_id, block_user_id):
         """Unblock a user"""
-        cur.execute("""
-            DELETE FROM blocks 
-            WHERE user_id=? AND blocked_user_id=?
-        """, (str(user_id), str(block_user_id)))
-        conn.commit()
+        with db.write() as cur:
+            cur.run("blocks.delete", (str(user_id), str(block_user_id)))
         return True
     
     def is_blocked(self, user_id, target_user_id):
         """Check if user is blocked"""
-        cur.execute("""
-            SELECT * FROM blocks 
-            WHERE user_id=? AND blocked_user_id=?
-        """, (str(user_id), str(target_user_id)))
-        return cur.fetchone() is not None
+        with db.read() as cur:
+            return cur.one("blocks.exists", (str(user_id), str(target_user_id))) is not None
     
     def get_blocked_users(self, user_id):
         """Get blocked users"""
-        cur.execute("""
-            SELECT u.user_id, u.username, u.first_name, b.created_at
-            FROM blocks b
-            JOIN users u ON b.blocked_user_id = u.user_id
-            WHERE b.user_id=?
-            ORDER BY b.created_at DESC
-        """, (str(user_id),))
-        return cur.fetchall()
+        with db.read() as cur:
+            return cur.all("blocks.list", (str(user_id),))
+    
+    def count_friends(self, user_id):
+        """Count user's friends"""
+        with db.read() as cur:
+            return cur.one("friends.count", (str(user_id),))['friends']
 
 friend_manager = FriendManager()
 
+# ==================== MESSAGE ARCHIVE ====================
+
+MESSAGE_ARCHIVE_DAYS = int(os.getenv("MESSAGE_ARCHIVE_DAYS", "30"))  # 0 disables archiving
+MESSAGE_ARCHIVE_DIR = os.getenv("MESSAGE_ARCHIVE_DIR", "archive")
+MESSAGE_ARCHIVE_INTERVAL = int(os.getenv("MESSAGE_ARCHIVE_INTERVAL", "3600"))
+MESSAGE_ARCHIVE_BATCH = int(os.getenv("MESSAGE_ARCHIVE_BATCH", "5000"))
+MESSAGE_ARCHIVE_OPEN_FILES = int(os.getenv("MESSAGE_ARCHIVE_OPEN_FILES", "12"))
+
+# Archived tables: the column a conversation is read by and the text columns stored compressed
+ARCHIVE_TABLES = {
+    "chat_messages": {
+        "key": "session_id",
+        "history": "direct_chat",  # Prefix of the hot-tier history queries
+        "columns": ["id", "session_id", "from_user", "message", "is_forwarded", "translated_message", "created_at"],
+        "compressed": ["message", "translated_message"]
+    },
+    "group_messages": {
+        "key": "room_id",
+        "history": "groups",
+        "columns": ["id", "room_id", "user_id", "message", "created_at"],
+        "compressed": ["message"]
+    }
+}
+
+for _table, _spec in ARCHIVE_TABLES.items():
+    queries.register({
+        f"archive.{_table}.expired": f"""
+            SELECT {', '.join(_spec['columns'])} FROM {_table}
+            WHERE created_at < ?
+            ORDER BY id
+            LIMIT ?
+        """,
+        f"archive.{_table}.delete": f"DELETE FROM {_table} WHERE id BETWEEN ? AND ? AND created_at < ?"
+    })
+
+queries.register({
+    "archive.count_add": """
+        INSERT INTO message_archive_counts (user_id, chat_messages) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET chat_messages = chat_messages + excluded.chat_messages
+    """,
+    "users.display_name": "SELECT user_id, username, first_name FROM users WHERE user_id=?",
+    "archive.index_add": """
+        INSERT INTO message_archive_index (table_name, conversation, month, min_id, max_id)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(table_name, conversation, month) DO UPDATE SET
+            min_id = MIN(min_id, excluded.min_id),
+            max_id = MAX(max_id, excluded.max_id)
+    """,
+    "archive.index_before": """
+        SELECT month FROM message_archive_index
+        WHERE table_name=? AND conversation=? AND min_id < ?
+        ORDER BY month DESC
+    """,
+    "archive.index_after": """
+        SELECT month FROM message_archive_index
+        WHERE table_name=? AND conversation=? AND max_id > ?
+        ORDER BY month
+    """,
+    "archive.index_any": "SELECT 1 FROM message_archive_index LIMIT 1"
+})
+
+class MessageArchive:
+    """Cold tier for chat and group messages.
+
+    Messages older than MESSAGE_ARCHIVE_DAYS move out of superbase.db into
+    one SQLite file per month (``messages-YYYY-MM.db``) with the message
+    text zlib-compressed. Archive files are opened on demand and a few
+    handles are kept open. message_archive_index in the main database
+    records which months hold each conversation's rows, so a page only
+    opens the month files of that conversation within the cursor.
+    """
+
+    def __init__(self, directory, max_open=12):
+        self.directory = directory
+        self.max_open = max_open
+        self.stats = defaultdict(int)
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path_for(self, month):
+        return os.path.join(self.directory, f"messages-{month}.db")
+
+    def months(self):
+        """Archived months, newest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        names = [name[9:16] for name in os.listdir(self.directory)
+                 if name.startswith("messages-") and name.endswith(".db")]
+        return sorted(names, reverse=True)
+
+    def _open(self, month):
+        """Cached connection to one month's archive file; caller holds the lock"""
+        connection = self._handles.get(month)
+        if connection is not None:
+            self._handles.move_to_end(month)
+            return connection
+        
+        os.makedirs(self.directory, exist_ok=True)
+        connection = sqlite3.connect(self.path_for(month), check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        for table, spec in ARCHIVE_TABLES.items():
+            columns = ", ".join(
+                f"{column} BLOB" if column in spec['compressed'] else column
+                for column in spec['columns'][1:]
+            )
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, {columns})")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{spec['key']} ON {table}({spec['key']}, id)")
+        
+        self._handles[month] = connection
+        if len(self._handles) > self.max_open:
+            _, oldest = self._handles.popitem(last=False)
+            oldest.close()
+        return connection
+
+    def store(self, table, rows):
+        """Write rows to their monthly archive files.
+
+        Returns {(conversation, month): (min id, max id)} for the caller
+        to record in message_archive_index.
+        """
+        spec = ARCHIVE_TABLES[table]
+        by_month = defaultdict(list)
+        ranges = {}
+        for row in rows:
+            month = time.strftime("%Y-%m", time.gmtime(row['created_at'] or 0))
+            by_month[month].append(tuple(
+                zlib.compress(row[column].encode()) if column in spec['compressed'] and row[column] is not None else row[column]
+                for column in spec['columns']
+            ))
+            low, high = ranges.get((row[spec['key']], month), (row['id'], row['id']))
+            ranges[(row[spec['key']], month)] = (min(low, row['id']), max(high, row['id']))
+        
+        placeholders = ", ".join("?" * len(spec['columns']))
+        with self._lock:
+            for month, values in by_month.items():
+                connection = self._open(month)
+                with connection:
+                    # Ids are preserved, so re-archiving after a crash is a no-op
+                    connection.executemany(
+                        f"INSERT OR IGNORE INTO {table} ({', '.join(spec['columns'])}) VALUES ({placeholders})",
+                        values
+                    )
+        return ranges
+
+    def record_ranges(self, cur, table, ranges):
+        """Add stored id ranges to message_archive_index, in the caller's write"""
+        cur.many("archive.index_add", [
+            (table, conversation, month, low, high)
+            for (conversation, month), (low, high) in ranges.items()
+        ])
+
+    def backfill_index(self):
+        """Index month files archived before message_archive_index existed"""
+        months = self.months()
+        if not months:
+            return 0
+        with db.read() as cur:
+            if cur.one("archive.index_any"):
+                return 0
+        
+        ranges = []
+        for month in months:
+            with self._lock:
+                connection = self._open(month)
+                for table, spec in ARCHIVE_TABLES.items():
+                    ranges += [
+                        (table, row[0], month, row[1], row[2])
+                        for row in connection.execute(
+                            f"SELECT {spec['key']}, MIN(id), MAX(id) FROM {table} GROUP BY {spec['key']}"
+                        )
+                    ]
+        with db.write() as cur:
+            cur.many("archive.index_add", ranges)
+        logger.info(f"📦 Indexed {len(months)} archived months")
+        return len(months)
+
+    def fetch(self, table, key, limit, before_id=None, after_id=None):
+        """Archived messages for one conversation.
+
+        With after_id, messages newer than it, oldest first; otherwise
+        messages older than before_id (or the newest), newest first.
+        Only months holding this conversation's rows beyond the cursor
+        are opened, so a conversation with none costs one index seek.
+        """
+        spec = ARCHIVE_TABLES[table]
+        if after_id is not None:
+            cursor = after_id
+            index = "archive.index_after"
+            sql = f"SELECT * FROM {table} WHERE {spec['key']}=? AND id > ? ORDER BY id LIMIT ?"
+        else:
+            cursor = before_id if before_id is not None else sys.maxsize
+            index = "archive.index_before"
+            sql = f"SELECT * FROM {table} WHERE {spec['key']}=? AND id < ? ORDER BY id DESC LIMIT ?"
+        
+        with db.read() as cur:
+            months = [row['month'] for row in cur.all(index, (table, str(key), cursor))]
+        
+        result = []
+        for month in months:
+            if not os.path.exists(self.path_for(month)):
+                continue
+            with self._lock:
+                rows = self._open(month).execute(sql, (key, cursor, limit - len(result))).fetchall()
+            
+            for row in rows:
+                message = dict(row)
+                for column in spec['compressed']:
+                    if message[column] is not None:
+                        message[column] = zlib.decompress(message[column]).decode()
+                result.append(message)
+            
+            self.stats['archive_reads'] += 1
+            if len(result) >= limit:
+                break
+        return result
+
+    def close(self):
+        with self._lock:
+            while self._handles:
+                self._handles.popitem()[1].close()
+
+    def move_to(self, target):
+        """Move every archive file into another directory"""
+        self.close()
+        if os.path.isdir(self.directory):
+            shutil.move(self.directory, target)
+
+    def size(self):
+        """Total size of the archive files in bytes"""
+        return sum(os.path.getsize(self.path_for(month)) for month in self.months())
+
+    def snapshot(self):
+        """Archive size, months and read counters"""
+        return dict(self.stats, bytes=self.size(), months=self.months())
+
+message_archive = MessageArchive(MESSAGE_ARCHIVE_DIR, MESSAGE_ARCHIVE_OPEN_FILES)
+
+def with_display_names(messages):
+    """Add username and first_name to archived messages, dropping unknown senders"""
+    names = {}
+    result = []
+    with db.read() as cur:
+        for message in messages:
+            user_id = message.get('from_user') or message.get('user_id')
+            if user_id not in names:
+                names[user_id] = cur.one("users.display_name", (user_id,))
+            if names[user_id] is None:
+                continue
+            message['username'] = names[user_id]['username']
+            message['first_name'] = names[user_id]['first_name']
+            result.append(message)
+    return result
+
+class MessageArchiver(BackgroundTask):
+    """Move expired messages from the hot tables into the monthly archive.
+
+    Each batch is written to the archive first and deleted from the hot
+    table afterwards, so a crash in between only repeats the batch.
+    """
+
+    def __init__(self, archive, max_age_days, interval, batch_size):
+        super().__init__("message-archiver", interval)
+        self.archive = archive
+        self.max_age = max_age_days * 86400
+        self.batch_size = batch_size
+
+    def start(self):
+        if not self.max_age:
+            logger.info("Message archiving disabled")
+            return
+        super().start()
+
+    def run_once(self):
+        cutoff = int(time.time()) - self.max_age
+        for table in ARCHIVE_TABLES:
+            moved = self.archive_table(table, cutoff)
+            if moved:
+                logger.info(f"📦 Archived {moved} rows from {table}")
+
+    def archive_table(self, table, cutoff):
+        """Archive every row older than cutoff; returns the number moved"""
+        moved = 0
+        while True:
+            with db.read() as cur:
+                rows = cur.all(f"archive.{table}.expired", (cutoff, self.batch_size))
+            if not rows:
+                return moved
+            
+            ranges = self.archive.store(table, rows)
+            
+            with db.write() as cur:
+                self.archive.record_ranges(cur, table, ranges)
+                cur.run(f"archive.{table}.delete", (rows[0]['id'], rows[-1]['id'], cutoff))
+                if table == "chat_messages":
+                    # Keep per-user message totals (badges) correct after the move
+                    per_user = defaultdict(int)
+                    for row in rows:
+                        per_user[row['from_user']] += 1
+                    for user_id, count in per_user.items():
+                        cur.run("archive.count_add", (user_id, count))
+            
+            moved += len(rows)
+            self.archive.stats[f"{table}_archived"] += len(rows)
+            if len(rows) < self.batch_size:
+                return moved
+
+message_archiver = MessageArchiver(message_archive, MESSAGE_ARCHIVE_DAYS, MESSAGE_ARCHIVE_INTERVAL, MESSAGE_ARCHIVE_BATCH)
+
+HISTORY_MAX_PAGE = 100
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10"))  # Messages per /history page
+
+def read_history(table, key, limit=50, before_id=None, after_id=None):
+    """Keyset page of one conversation across both tiers, oldest first.
+
+    Pages are addressed by message id, never by offset, so every page is
+    an index seek on (key, id) however long the history is. Without a
+    cursor the newest messages are returned; before_id pages backwards
+    and after_id pages forwards.
+    """
+    prefix = ARCHIVE_TABLES[table]['history']
+    
+    if after_id is not None:
+        with db.read() as cur:
+            first_hot = cur.one(f"{prefix}.first_id", (key,))['first_id']
+        
+        messages = []
+        if first_hot is None or after_id < first_hot:
+            # The cursor points into archived history
+            messages = with_display_names(message_archive.fetch(table, key, limit, after_id=after_id))
+        if len(messages) < limit:
+            cursor = messages[-1]['id'] if messages else after_id
+            with db.read() as cur:
+                messages += [dict(m) for m in cur.all(f"{prefix}.messages_after", (key, cursor, limit - len(messages)))]
+        return messages
+    
+    with db.read() as cur:
+        cursor = before_id if before_id is not None else sys.maxsize
+        messages = [dict(m) for m in cur.all(f"{prefix}.messages_before", (key, cursor, limit))]
+    if len(messages) < limit:
+        # Older history lives in the monthly archive
+        cursor = messages[-1]['id'] if messages else before_id
+        messages += with_display_names(message_archive.fetch(table, key, limit - len(messages), before_id=cursor))
+    
+    messages.reverse()
+    return messages
+
+def history_page(table, key, limit=50, before_id=None, after_id=None):
+    """read_history() plus the cursors for the neighbouring pages"""
+    limit = max(1, min(limit, HISTORY_MAX_PAGE))
+    # One extra row tells whether another page exists in the direction of travel
+    messages = read_history(table, key, limit + 1, before_id, after_id)
+    forward = after_id is not None
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[:limit] if forward else messages[1:]
+    
+    if forward:
+        older, newer = bool(messages), has_more
+    else:
+        older, newer = has_more, before_id is not None
+    
+    # A cursor is None when there is nothing further in that direction
+    return {
+        "messages": messages,
+        "before_id": messages[0]['id'] if older else None,
+        "after_id": messages[-1]['id'] if newer else None
+    }
+
 # ==================== DIRECT CHAT MANAGER ====================
 
+queries.register({
+    "direct_chat.session_between": """
+        SELECT * FROM direct_chat_sessions
+        WHERE (user_a=? AND user_b=?) OR (user_a=? AND user_b=?)
+    """,
+    "direct_chat.session_insert": """
+        INSERT INTO direct_chat_sessions (id, user_a, user_b, created_at, last_message_at)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+    "direct_chat.message_insert": """
+        INSERT INTO chat_messages (session_id, from_user, message, created_at)
+        VALUES (?, ?, ?, ?)
+    """,
+    "direct_chat.session_touch": """
+        UPDATE direct_chat_sessions SET last_message_at=? WHERE id=?
+    """,
+    "direct_chat.messages_before": """
+        SELECT cm.*, u.username, u.first_name
+        FROM chat_messages cm
+        JOIN users u ON cm.from_user = u.user_id
+        WHERE cm.session_id=? AND cm.id < ?
+        ORDER BY cm.id DESC
+        LIMIT ?
+    """,
+    "direct_chat.messages_after": """
+        SELECT cm.*, u.username, u.first_name
+        FROM chat_messages cm
+        JOIN users u ON cm.from_user = u.user_id
+        WHERE cm.session_id=? AND cm.id > ?
+        ORDER BY cm.id
+        LIMIT ?
+    """,
+    "direct_chat.first_id": "SELECT MIN(id) as first_id FROM chat_messages WHERE session_id=?",
+    "direct_chat.session": "SELECT * FROM direct_chat_sessions WHERE id=?",
+    "direct_chat.smart_mode": """
+        UPDATE direct_chat_sessions SET smart_mode=? WHERE id=?
+    """,
+    "direct_chat.translate": """
+        UPDATE direct_chat_sessions SET auto_translate=? WHERE id=?
+    """
+})
+
 class DirectChatManager:
     """Manage direct chat between users"""
     
+    @db_write
     def create_session(self, user_a, user_b):
         """Create direct chat session"""
-        # Check if session exists
-        cur.execute("""
-            SELECT * FROM direct_chat_sessions 
-            WHERE (user_a=? AND user_b=?) OR (user_a=? AND user_b=?)
-        """, (str(user_a), str(user_b), str(user_b), str(user_a)))
-        
-        existing = cur.fetchone()
-        if existing:
-            return existing['id']
-        
-        session_id = str(uuid.uuid4())
-        now = int(time.time())
-        
-        cur.execute("""
-            INSERT INTO direct_chat_sessions (id, user_a, user_b, created_at, last_message_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (session_id, str(user_a), str(user_b), now, now))
-        conn.commit()
+        with db.write() as cur:
+            # Check if session exists
+            existing = cur.one("direct_chat.session_between", (str(user_a), str(user_b), str(user_b), str(user_a)))
+            if existing:
+                return existing['id']
+            
+            session_id = str(uuid.uuid4())
+            now = int(time.time())
+            
+            cur.run("direct_chat.session_insert", (session_id, str(user_a), str(user_b), now, now))
         
         return session_id
     
+    @db_write
     def send_message(self, session_id, from_user, message):
         """Send message in chat"""
         now = int(time.time())
         
-        cur.execute("""
-            INSERT INTO chat_messages (session_id, from_user, message, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (session_id, str(from_user), message, now))
-        
-        cur.execute("""
-            UPDATE direct_chat_sessions SET last_message_at=? WHERE id=?
-        """, (now, session_id))
+        with db.write() as cur:
+            cur.run("direct_chat.message_insert", (session_id, str(from_user), message, now))
+            message_id = cur.lastrowid
+            
+            cur.run("direct_chat.session_touch", (now, session_id))
         
-        conn.commit()
-        return cur.lastrowid
+        return message_id
     
     def get_session(self, user_a, user_b):
         """Get chat session between users"""
-        cur.execute("""
-            SELECT * FROM direct_chat_sessions 
-            WHERE (user_a=? AND user_b=?) OR (user_a=? AND user_b=?)
-        """, (str(user_a), str(user_b), str(user_b), str(user_a)))
-        return cur.fetchone()
+        with db.read() as cur:
+            return cur.one("direct_chat.session_between", (str(user_a), str(user_b), str(user_b), str(user_a)))
     
-    def get_messages(self, session_id, limit=50):
-        """Get recent messages"""
-        cur.execute("""
-            SELECT cm.*, u.username, u.first_name
-            FROM chat_messages cm
-            JOIN users u ON cm.from_user = u.user_id
-            WHERE cm.session_id=?
-            ORDER BY cm.created_at DESC
-            LIMIT ?
-        """, (session_id, limit))
-        
-        messages = cur.fetchall()
-        return list(reversed(messages))  # Return in chronological order
+    def get_messages(self, session_id, limit=50, before_id=None, after_id=None):
+        """Get a page of messages in chronological order"""
+        return read_history("chat_messages", session_id, limit, before_id, after_id)
+    
+    def get_history(self, session_id, limit=50, before_id=None, after_id=None):
+        """Get a page of messages with cursors for the next and previous pages"""
+        return history_page("chat_messages", session_id, limit, before_id, after_id)
+    
+    @coalesced("chat_session")
+    def get_session_by_id(self, session_id):
+        """Get chat session by ID"""
+        with db.read() as cur:
+            return cur.one("direct_chat.session", (session_id,))
     
+    @db_write
     def toggle_smart_mode(self, session_id, enabled):
         """Toggle smart mode (AI assisted)"""
-        cur.execute("""
-            UPDATE direct_chat_sessions SET smart_mode=? WHERE id=?
-        """, (1 if enabled else 0, session_id))
-        conn.commit()
+        with db.write() as cur:
+            cur.run("direct_chat.smart_mode", (1 if enabled else 0, session_id))
         return True
     
+    @db_write
     def toggle_translate(self, session_id, enabled):
         """Toggle auto-translate"""
-        cur.execute("""
-            UPDATE direct_chat_sessions SET auto_translate=? WHERE id=?
-        """, (1 if enabled else 0, session_id))
-        conn.commit()
+        with db.write() as cur:
+            cur.run("direct_chat.translate", (1 if enabled else 0, session_id))
         return True
 
 direct_chat = DirectChatManager()
 
 # ==================== GROUP MANAGER ====================
 
+queries.register({
+    "groups.room_insert": """
+        INSERT INTO group_rooms (id, name, description, created_by, is_private, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """,
+    "groups.owner_insert": """
+        INSERT INTO group_members (room_id, user_id, role, joined_at)
+        VALUES (?, ?, 'owner', ?)
+    """,
+    "groups.member_get": """
+        SELECT * FROM group_members WHERE room_id=? AND user_id=?
+    """,
+    "groups.capacity": """
+        SELECT COUNT(*) as count, max_members FROM group_members gm
+        JOIN group_rooms gr ON gm.room_id = gr.id
+        WHERE gm.room_id=?
+    """,
+    "groups.member_insert": """
+        INSERT INTO group_members (room_id, user_id, role, joined_at, last_read)
+        VALUES (?, ?, 'member', ?, ?)
+    """,
+    "groups.member_delete": """
+        DELETE FROM group_members WHERE room_id=? AND user_id=?
+    """,
+    "groups.message_insert": """
+        INSERT INTO group_messages (room_id, user_id, message, created_at)
+        VALUES (?, ?, ?, ?)
+    """,
+    "groups.room_touch": """
+        UPDATE group_rooms SET updated_at=? WHERE id=?
+    """,
+    "groups.messages_before": """
+        SELECT gm.*, u.username, u.first_name
+        FROM group_messages gm
+        JOIN users u ON gm.user_id = u.user_id
+        WHERE gm.room_id=? AND gm.id < ?
+        ORDER BY gm.id DESC
+        LIMIT ?
+    """,
+    "groups.messages_after": """
+        SELECT gm.*, u.username, u.first_name
+        FROM group_messages gm
+        JOIN users u ON gm.user_id = u.user_id
+        WHERE gm.room_id=? AND gm.id > ?
+        ORDER BY gm.id
+        LIMIT ?
+    """,
+    "groups.first_id": "SELECT MIN(id) as first_id FROM group_messages WHERE room_id=?",
+    "groups.room": "SELECT * FROM group_rooms WHERE id=?",
+    "groups.members": """
+        SELECT u.user_id, u.username, u.first_name, gm.role, gm.joined_at
+        FROM group_members gm
+        JOIN users u ON gm.user_id = u.user_id
+        WHERE gm.room_id=?
+        ORDER BY
+            CASE gm.role
+                WHEN 'owner' THEN 1
+                WHEN 'admin' THEN 2
+                ELSE 3
+            END, gm.joined_at
+    """,
+    "groups.user_rooms": """
+        SELECT gr.*, gm.role
+        FROM group_members gm
+        JOIN group_rooms gr ON gm.room_id = gr.id
+        WHERE gm.user_id=?
+        ORDER BY gr.updated_at DESC
+    """
+})
+
 class GroupManager:
     """Manage group rooms"""
     
+    @db_write
     def create_room(self, name, created_by, description="", is_private=False):
         """Create group room"""
         room_id = str(uuid.uuid4())
         now = int(time.time())
         
-        cur.execute("""
-            INSERT INTO group_rooms (id, name, description, created_by, is_private, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (room_id, name, description, str(created_by), 1 if is_private else 0, now, now))
-        
-        # Add creator as admin
-        cur.execute("""
-            INSERT INTO group_members (room_id, user_id, role, joined_at)
-            VALUES (?, ?, 'owner', ?)
-        """, (room_id, str(created_by), now))
+        with db.write() as cur:
+            cur.run("groups.room_insert", (room_id, name, description, str(created_by), 1 if is_private else 0, now, now))
+            
+            # Add creator as admin
+            cur.run("groups.owner_insert", (room_id, str(created_by), now))
         
-        conn.commit()
         return room_id
     
+    @db_write
     def add_member(self, room_id, user_id):
         """Add member to room"""
-        # Check if already member
-        cur.execute("""
-            SELECT * FROM group_members WHERE room_id=? AND user_id=?
-        """, (room_id, str(user_id)))
-        
-        if cur.fetchone():
-            return False, "Already a member"
-        
-        # Check room capacity
-        cur.execute("""
-            SELECT COUNT(*) as count, max_members FROM group_members gm
-            JOIN group_rooms gr ON gm.room_id = gr.id
-            WHERE gm.room_id=?
-        """, (room_id,))
-        
-        room_info = cur.fetchone()
-        if room_info and room_info['count'] >= room_info['max_members']:
-            return False, "Room is full"
-        
-        now = int(time.time())
-        cur.execute("""
-            INSERT INTO group_members (room_id, user_id, role, joined_at, last_read)
-            VALUES (?, ?, 'member', ?, ?)
-        """, (room_id, str(user_id), now, now))
-        conn.commit()
+        with db.write() as cur:
+            # Check if already member
+            if cur.one("groups.member_get", (room_id, str(user_id))):
+                return False, "Already a member"
+            
+            # Check room capacity
+            room_info = cur.one("groups.capacity", (room_id,))
+            if room_info and room_info['count'] >= room_info['max_members']:
+                return False, "Room is full"
+            
+            now = int(time.time())
+            cur.run("groups.member_insert", (room_id, str(user_id), now, now))
         
         return True, "Joined room"
     
+    @db_write
     def remove_member(self, room_id, user_id):
         """Remove member from room"""
-        cur.execute("""
-            DELETE FROM group_members WHERE room_id=? AND user_id=?
-        """, (room_id, str(user_id)))
-        conn.commit()
+        with db.write() as cur:
+            cur.run("groups.member_delete", (room_id, str(user_id)))
         return True
     
+    @db_write
     def send_message(self, room_id, user_id, message):
         """Send message to group"""
         now = int(time.time())
         
-        cur.execute("""
-            INSERT INTO group_messages (room_id, user_id, message, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (room_id, str(user_id), message, now))
-        
-        cur.execute("""
-            UPDATE group_rooms SET updated_at=? WHERE id=?
-        """, (now, room_id))
+        with db.write() as cur:
+            cur.run("groups.message_insert", (room_id, str(user_id), message, now))
+            message_id = cur.lastrowid
+            
+            cur.run("groups.room_touch", (now, room_id))
         
-        conn.commit()
-        return cur.lastrowid
+        return message_id
     
-    def get_messages(self, room_id, limit=50):
-        """Get recent messages"""
-        cur.execute("""
-            SELECT gm.*, u.username, u.first_name
-            FROM group_messages gm
-            JOIN users u ON gm.user_id = u.user_id
-            WHERE gm.room_id=?
-            ORDER BY gm.created_at DESC
-            LIMIT ?
-        """, (room_id, limit))
-        
-        messages = cur.fetchall()
-        return list(reversed(messages))
+    def get_messages(self, room_id, limit=50, before_id=None, after_id=None):
+        """Get a page of messages in chronological order"""
+        return read_history("group_messages", room_id, limit, before_id, after_id)
+    
+    def get_history(self, room_id, limit=50, before_id=None, after_id=None):
+        """Get a page of messages with cursors for the next and previous pages"""
+        return history_page("group_messages", room_id, limit, before_id, after_id)
+    
+    @coalesced("room")
+    def get_room(self, room_id):
+        """Get room details"""
+        with db.read() as cur:
+            return cur.one("groups.room", (room_id,))
+    
+    def is_member(self, room_id, user_id):
+        """Check if user is a room member"""
+        with db.read() as cur:
+            return cur.one("groups.member_get", (room_id, str(user_id))) is not None
     
     def get_members(self, room_id):
         """Get room members"""
-        cur.execute("""
-            SELECT u.user_id, u.username, u.first_name, gm.role, gm.joined_at
-            FROM group_members gm
-            JOIN users u ON gm.user_id = u.user_id
-            WHERE gm.room_id=?
-            ORDER BY 
-                CASE gm.role
-                    WHEN 'owner' THEN 1
-                    WHEN 'admin' THEN 2
-                    ELSE 3
-                END, gm.joined_at
-        """, (room_id,))
-        return cur.fetchall()
+        with db.read() as cur:
+            return cur.all("groups.members", (room_id,))
     
     def get_user_rooms(self, user_id):
         """Get rooms user is in"""
-        cur.execute("""
-            SELECT gr.*, gm.role
-            FROM group_members gm
-            JOIN group_rooms gr ON gm.room_id = gr.id
-            WHERE gm.user_id=?
-            ORDER BY gr.updated_at DESC
-        """, (str(user_id),))
-        return cur.fetchall()
+        with db.read() as cur:
+            return cur.all("groups.user_rooms", (str(user_id),))
 
 group_manager = GroupManager()
 
 # ==================== SHOP MANAGER ====================
 
+queries.register({
+    "shop.categories": "SELECT * FROM shop_categories ORDER BY display_order",
+    "shop.items": "SELECT * FROM shop_items ORDER BY category_id, price",
+    "shop.item": "SELECT * FROM shop_items WHERE id=?",
+    "shop.purchased_quantity": """
+        SELECT SUM(quantity) as total FROM user_purchases
+        WHERE user_id=? AND item_id=?
+    """,
+    "shop.purchase_insert": """
+        INSERT INTO user_purchases (user_id, item_id, quantity, price_paid, purchased_at)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+    "shop.inventory_add": """
+        INSERT INTO user_inventory (user_id, item_id, quantity, acquired_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, item_id) DO UPDATE SET
+            quantity = quantity + ?
+    """,
+    "shop.stock_decrement": """
+        UPDATE shop_items SET stock = stock - ? WHERE id=?
+    """,
+    "shop.inventory": """
+        SELECT ui.*, si.name, si.description, si.icon, si.item_type
+        FROM user_inventory ui
+        JOIN shop_items si ON ui.item_id = si.id
+        WHERE ui.user_id=?
+        ORDER BY ui.acquired_at DESC
+    """,
+    "shop.owned_by_type": """
+        SELECT si.* FROM user_inventory ui
+        JOIN shop_items si ON ui.item_id = si.id
+        WHERE ui.user_id=? AND si.item_type=?
+    """,
+    "shop.purchase_count": "SELECT COUNT(*) as purchases FROM user_purchases WHERE user_id=?",
+    "shop.inventory_item": """
+        SELECT * FROM user_inventory WHERE user_id=? AND item_id=?
+    """
+})
+
 class ShopManager:
     """Manage shop and purchases"""
     
     def get_categories(self):
         """Get all shop categories"""
-        cur.execute("""
-            SELECT * FROM shop_categories 
-            WHERE is_active=1 
-            ORDER BY display_order
-        """)
-        return cur.fetchall()
+        return catalog.get("shop")['categories']
+    
+    def get_category(self, category_id):
+        """Get category details"""
+        return catalog.get("shop")['categories_by_id'].get(category_id)
     
     def get_items(self, category_id=None):
         """Get shop items"""
+        shop = catalog.get("shop")
         if category_id:
-            cur.execute("""
-                SELECT * FROM shop_items 
-                WHERE category_id=? AND is_active=1
-                ORDER BY price
-            """, (category_id,))
-        else:
-            cur.execute("""
-                SELECT * FROM shop_items 
-                WHERE is_active=1
-                ORDER BY category_id, price
-            """)
-        return cur.fetchall()
+            return shop['items_by_category'].get(category_id, ())
+        return shop['items']
     
     def get_item(self, item_id):
         """Get item details"""
-        cur.execute("SELECT * FROM shop_items WHERE id=?", (item_id,))
-        return cur.fetchone()
+        return catalog.get("shop")['items_by_id'].get(item_id)
     
+    @db_write
     def buy_item(self, user_id, item_id, quantity=1):
         """Buy item from shop"""
-        item = self.get_item(item_id)
-        if not item or not item['is_active']:
-            return False, "Item not available"
-        
-        # Check stock
-        if item['stock'] != -1 and item['stock'] < quantity:
-            return False, "Out of stock"
-        
-        # Check purchase limit
-        if item['purchase_limit'] > 0:
-            cur.execute("""
-                SELECT SUM(quantity) as total FROM user_purchases 
-                WHERE user_id=? AND item_id=?
-            """, (str(user_id), item_id))
-            purchased = cur.fetchone()
-            if purchased and purchased['total'] >= item['purchase_limit']:
-                return False, "Purchase limit reached"
-        
-        # Calculate total price
-        total_price = item['price'] * quantity
-        
-        # Check coins
-        if not coin_manager.spend_coins(user_id, total_price, f"bought {item['name']}"):
-            return False, "Insufficient coins"
-        
-        # Record purchase
-        now = int(time.time())
-        cur.execute("""
-            INSERT INTO user_purchases (user_id, item_id, quantity, price_paid, purchased_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (str(user_id), item_id, quantity, total_price, now))
-        
-        # Update inventory
-        cur.execute("""
-            INSERT INTO user_inventory (user_id, item_id, quantity, acquired_at)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id, item_id) DO UPDATE SET
-                quantity = quantity + ?
-        """, (str(user_id), item_id, quantity, now, quantity))
+        with db.write() as cur:
+            # Stock changes with every purchase, so read it under the write lock
+            item = cur.one("shop.item", (item_id,))
+            if not item or not item['is_active']:
+                return False, "Item not available"
+            
+            # Check stock
+            if item['stock'] != -1 and item['stock'] < quantity:
+                return False, "Out of stock"
+            
+            # Check purchase limit
+            if item['purchase_limit'] > 0:
+                purchased = cur.one("shop.purchased_quantity", (str(user_id), item_id))
+                if purchased and purchased['total'] >= item['purchase_limit']:
+                    return False, "Purchase limit reached"
+            
+            # Calculate total price
+            total_price = item['price'] * quantity
+            
+            # Check coins
+            if not coin_manager.spend_coins(user_id, total_price, f"bought {item['name']}"):
+                return False, "Insufficient coins"
+            
+            # Record purchase
+            now = int(time.time())
+            cur.run("shop.purchase_insert", (str(user_id), item_id, quantity, total_price, now))
+            
+            # Update inventory
+            cur.run("shop.inventory_add", (str(user_id), item_id, quantity, now, quantity))
+            
+            # Update stock if limited
+            if item['stock'] != -1:
+                cur.run("shop.stock_decrement", (quantity, item_id))
         
-        # Update stock if limited
         if item['stock'] != -1:
-            cur.execute("""
-                UPDATE shop_items SET stock = stock - ? WHERE id=?
-            """, (quantity, item_id))
-        
-        conn.commit()
+            catalog.reload("shop")
         
         # Apply item effects
         self.apply_item_effect(user_id, item)
         
         return True, "Purchase successful"
     
+    @db_write
     def apply_item_effect(self, user_id, item):
         """Apply item effect after purchase"""
         item_type = item['item_type']
@@ -1468,6 +3944,7 @@ class ShopManager:
             if item_value not in metadata['unlocked_features']:
                 metadata['unlocked_features'].append(item_value)
             update_user(user_id, metadata=json.dumps(metadata))
+            conversation_memory.resize(user_id)
         
         elif item_type == "powerup":
             # Store in active powerups
@@ -1480,23 +3957,27 @@ class ShopManager:
     
     def get_inventory(self, user_id):
         """Get user inventory"""
-        cur.execute("""
-            SELECT ui.*, si.name, si.description, si.icon, si.item_type
-            FROM user_inventory ui
-            JOIN shop_items si ON ui.item_id = si.id
-            WHERE ui.user_id=?
-            ORDER BY ui.acquired_at DESC
-        """, (str(user_id),))
-        return cur.fetchall()
+        with db.read() as cur:
+            return cur.all("shop.inventory", (str(user_id),))
     
+    def get_owned_items(self, user_id, item_type):
+        """Get owned shop items of one type"""
+        with db.read() as cur:
+            return cur.all("shop.owned_by_type", (str(user_id), item_type))
+    
+    def count_purchases(self, user_id):
+        """Count user's purchases"""
+        with db.read() as cur:
+            return cur.one("shop.purchase_count", (str(user_id),))['purchases']
+    
+    @db_write
     def equip_item(self, user_id, item_id):
         """Equip cosmetic item"""
         # Check if user owns item
-        cur.execute("""
-            SELECT * FROM user_inventory WHERE user_id=? AND item_id=?
-        """, (str(user_id), item_id))
+        with db.read() as cur:
+            owned = cur.one("shop.inventory_item", (str(user_id), item_id))
         
-        if not cur.fetchone():
+        if not owned:
             return False, "You don't own this item"
         
         # Get item details
@@ -1520,159 +4001,236 @@ shop_manager = ShopManager()
 
 # ==================== GAME MANAGER ====================
 
+queries.register({
+    "games.all": "SELECT * FROM games",
+    "games.session_insert": """
+        INSERT INTO game_sessions (id, game_id, status, created_by, created_at)
+        VALUES (?, ?, 'waiting', ?, ?)
+    """,
+    "games.player_insert": """
+        INSERT INTO game_players (session_id, user_id, joined_at)
+        VALUES (?, ?, ?)
+    """,
+    "games.session_get": "SELECT * FROM game_sessions WHERE id=?",
+    "games.player_get": """
+        SELECT * FROM game_players WHERE session_id=? AND user_id=?
+    """,
+    "games.player_count": "SELECT COUNT(*) as count FROM game_players WHERE session_id=?",
+    "games.session_start": """
+        UPDATE game_sessions
+        SET status='active', started_at=?
+        WHERE id=?
+    """,
+    "games.session_end": """
+        UPDATE game_sessions
+        SET status='ended', ended_at=?, winner=?
+        WHERE id=?
+    """,
+    "games.session_players": "SELECT user_id FROM game_players WHERE session_id=?",
+    "games.waiting_sessions_for_game": """
+        SELECT * FROM game_sessions
+        WHERE game_id=? AND status='waiting'
+        ORDER BY created_at DESC
+    """,
+    "games.waiting_sessions": """
+        SELECT * FROM game_sessions
+        WHERE status='waiting'
+        ORDER BY created_at DESC
+    """,
+    "games.quiz_random": """
+        SELECT * FROM quiz_questions
+        WHERE difficulty=?
+        ORDER BY RANDOM() LIMIT 1
+    """,
+    "games.quiz_get": "SELECT * FROM quiz_questions WHERE id=?",
+    "games.leaderboard": """
+        SELECT u.username, u.first_name, ul.level, ul.total_xp
+        FROM user_levels ul
+        JOIN users u ON ul.user_id = u.user_id
+        ORDER BY ul.total_xp DESC
+        LIMIT ?
+    """,
+    "games.rank": """
+        SELECT COUNT(*) + 1 as rank
+        FROM user_levels
+        WHERE total_xp > (SELECT total_xp FROM user_levels WHERE user_id=?)
+    """,
+    "games.played_count": "SELECT COUNT(*) as games FROM game_players WHERE user_id=?",
+    "games.won_count": "SELECT COUNT(*) as wins FROM game_sessions WHERE winner=?"
+})
+
 class GameManager:
     """Manage games and game sessions"""
     
     def get_games(self):
         """Get available games"""
-        cur.execute("SELECT * FROM games WHERE is_active=1")
-        return cur.fetchall()
+        return catalog.get("games")['games']
     
+    @db_write
     def create_session(self, game_id, created_by):
         """Create game session"""
         session_id = str(uuid.uuid4())
         now = int(time.time())
         
-        cur.execute("""
-            INSERT INTO game_sessions (id, game_id, status, created_by, created_at)
-            VALUES (?, ?, 'waiting', ?, ?)
-        """, (session_id, game_id, str(created_by), now))
-        
-        # Add creator as player
-        cur.execute("""
-            INSERT INTO game_players (session_id, user_id, joined_at)
-            VALUES (?, ?, ?)
-        """, (session_id, str(created_by), now))
+        with db.write() as cur:
+            cur.run("games.session_insert", (session_id, game_id, str(created_by), now))
+            
+            # Add creator as player
+            cur.run("games.player_insert", (session_id, str(created_by), now))
         
-        conn.commit()
         return session_id
     
+    @db_write
     def join_session(self, session_id, user_id):
         """Join game session"""
-        # Check if session exists and is waiting
-        cur.execute("SELECT * FROM game_sessions WHERE id=?", (session_id,))
-        session = cur.fetchone()
-        
-        if not session:
-            return False, "Session not found"
-        
-        if session['status'] != 'waiting':
-            return False, "Game already started"
-        
-        # Check if already in session
-        cur.execute("""
-            SELECT * FROM game_players WHERE session_id=? AND user_id=?
-        """, (session_id, str(user_id)))
-        
-        if cur.fetchone():
-            return False, "Already in game"
-        
-        # Check max players
-        game = self.get_game(session['game_id'])
-        cur.execute("SELECT COUNT(*) as count FROM game_players WHERE session_id=?", (session_id,))
-        player_count = cur.fetchone()['count']
-        
-        if player_count >= game['max_players']:
-            return False, "Game is full"
-        
-        # Add player
-        now = int(time.time())
-        cur.execute("""
-            INSERT INTO game_players (session_id, user_id, joined_at)
-            VALUES (?, ?, ?)
-        """, (session_id, str(user_id), now))
-        conn.commit()
-        
-        # Start game if enough players
-        player_count += 1
-        if player_count >= game['min_players']:
-            self.start_game(session_id)
+        with db.write() as cur:
+            # Check if session exists and is waiting
+            session = cur.one("games.session_get", (session_id,))
+            
+            if not session:
+                return False, "Session not found"
+            
+            if session['status'] != 'waiting':
+                return False, "Game already started"
+            
+            # Check if already in session
+            if cur.one("games.player_get", (session_id, str(user_id))):
+                return False, "Already in game"
+            
+            # Check max players
+            game = self.get_game(session['game_id'])
+            player_count = cur.one("games.player_count", (session_id,))['count']
+            
+            if player_count >= game['max_players']:
+                return False, "Game is full"
+            
+            # Add player
+            now = int(time.time())
+            cur.run("games.player_insert", (session_id, str(user_id), now))
+            
+            # Start game if enough players
+            player_count += 1
+            if player_count >= game['min_players']:
+                self.start_game(session_id)
         
         return True, "Joined game"
     
+    @db_write
     def start_game(self, session_id):
         """Start game session"""
-        cur.execute("""
-            UPDATE game_sessions 
-            SET status='active', started_at=?
-            WHERE id=?
-        """, (int(time.time()), session_id))
-        conn.commit()
+        with db.write() as cur:
+            cur.run("games.session_start", (int(time.time()), session_id))
         return True
     
+    @db_write
     def end_game(self, session_id, winner_id=None):
         """End game and distribute rewards"""
-        cur.execute("SELECT * FROM game_sessions WHERE id=?", (session_id,))
-        session = cur.fetchone()
-        
-        if not session:
-            return False
-        
-        game = self.get_game(session['game_id'])
-        now = int(time.time())
-        
-        # Update session
-        cur.execute("""
-            UPDATE game_sessions 
-            SET status='ended', ended_at=?, winner=?
-            WHERE id=?
-        """, (now, str(winner_id) if winner_id else None, session_id))
-        
-        # Get all players
-        cur.execute("SELECT user_id FROM game_players WHERE session_id=?", (session_id,))
-        players = cur.fetchall()
-        
-        # Distribute rewards
-        for player in players:
-            if winner_id and player['user_id'] == winner_id:
-                # Winner gets full rewards
-                coin_manager.add_coins(player['user_id'], game['coin_reward'], f"won_game_{game['id']}")
-                level_manager.add_xp(player['user_id'], game['xp_reward'])
-            else:
-                # Losers get half
-                coin_manager.add_coins(player['user_id'], game['coin_reward'] // 2, f"played_game_{game['id']}")
-                level_manager.add_xp(player['user_id'], game['xp_reward'] // 2)
+        with db.write() as cur:
+            session = cur.one("games.session_get", (session_id,))
+            
+            if not session:
+                return False
+            
+            game = self.get_game(session['game_id'])
+            now = int(time.time())
+            
+            # Update session
+            cur.run("games.session_end", (now, str(winner_id) if winner_id else None, session_id))
+            
+            # Get all players
+            players = cur.all("games.session_players", (session_id,))
+            
+            # Distribute rewards
+            for player in players:
+                if winner_id and player['user_id'] == winner_id:
+                    # Winner gets full rewards
+                    coin_manager.add_coins(player['user_id'], game['coin_reward'], f"won_game_{game['id']}", key=f"game:{session_id}:{player['user_id']}")
+                    level_manager.add_xp(player['user_id'], game['xp_reward'])
+                else:
+                    # Losers get half
+                    coin_manager.add_coins(player['user_id'], game['coin_reward'] // 2, f"played_game_{game['id']}", key=f"game:{session_id}:{player['user_id']}")
+                    level_manager.add_xp(player['user_id'], game['xp_reward'] // 2)
         
-        conn.commit()
         return True
     
     def get_game(self, game_id):
         """Get game details"""
-        cur.execute("SELECT * FROM games WHERE id=?", (game_id,))
-        return cur.fetchone()
+        return catalog.get("games")['games_by_id'].get(game_id)
     
     def get_active_sessions(self, game_id=None):
         """Get active game sessions"""
-        if game_id:
-            cur.execute("""
-                SELECT * FROM game_sessions 
-                WHERE game_id=? AND status='waiting'
-                ORDER BY created_at DESC
-            """, (game_id,))
-        else:
-            cur.execute("""
-                SELECT * FROM game_sessions 
-                WHERE status='waiting'
-                ORDER BY created_at DESC
-            """)
-        return cur.fetchall()
+        with db.read() as cur:
+            if game_id:
+                return cur.all("games.waiting_sessions_for_game", (game_id,))
+            return cur.all("games.waiting_sessions")
     
     def get_quiz_question(self, difficulty='medium'):
         """Get random quiz question"""
-        cur.execute("""
-            SELECT * FROM quiz_questions 
-            WHERE difficulty=?
-            ORDER BY RANDOM() LIMIT 1
-        """, (difficulty,))
-        return cur.fetchone()
+        with db.read() as cur:
+            return cur.one("games.quiz_random", (difficulty,))
+    
+    def get_quiz_question_by_id(self, question_id):
+        """Get quiz question by ID"""
+        return cached_lookup(f"quiz:{question_id}", "games.quiz_get", (question_id,))
+    
+    def get_leaderboard(self, limit=10):
+        """Get top players by total XP"""
+        with db.read() as cur:
+            return cur.all("games.leaderboard", (limit,))
+    
+    def get_rank(self, user_id):
+        """Get user's leaderboard rank"""
+        with db.read() as cur:
+            return cur.one("games.rank", (str(user_id),))
+    
+    def get_player_stats(self, user_id):
+        """Get games played and won"""
+        with db.read() as cur:
+            games_played = cur.one("games.played_count", (str(user_id),))['games']
+            
+            games_won = cur.one("games.won_count", (str(user_id),))['wins']
+        
+        return games_played, games_won
 
 game_manager = GameManager()
 
 # ==================== BADGE MANAGER ====================
 
+queries.register({
+    "badges.all": "SELECT * FROM badges",
+    "badges.user_has": """
+        SELECT * FROM user_badges WHERE user_id=? AND badge_id=?
+    """,
+    "badges.message_count": """
+        SELECT (SELECT COUNT(*) FROM chat_messages WHERE from_user=?)
+            + COALESCE((SELECT chat_messages FROM message_archive_counts WHERE user_id=?), 0) as count
+    """,
+    "badges.friend_count": """
+        SELECT COUNT(*) as count FROM friends WHERE user_id=?
+    """,
+    "badges.game_count": """
+        SELECT COUNT(*) as count FROM game_players WHERE user_id=?
+    """,
+    "badges.purchase_count": """
+        SELECT COUNT(*) as count FROM user_purchases WHERE user_id=?
+    """,
+    "badges.award": """
+        INSERT INTO user_badges (user_id, badge_id, earned_at)
+        VALUES (?, ?, ?)
+    """,
+    "badges.user_badges": """
+        SELECT b.*, ub.earned_at
+        FROM user_badges ub
+        JOIN badges b ON ub.badge_id = b.id
+        WHERE ub.user_id=?
+        ORDER BY ub.earned_at DESC
+    """
+})
+
 class BadgeManager:
     """Manage badges and achievements"""
     
+    @db_write
     def check_and_award(self, user_id):
         """Check and award badges"""
         user = get_user(user_id)
@@ -1681,143 +4239,123 @@ class BadgeManager:
         
         awarded = []
         
-        # Get all badges
-        cur.execute("SELECT * FROM badges")
-        badges = cur.fetchall()
-        
-        for badge in badges:
-            # Check if already has
-            cur.execute("""
-                SELECT * FROM user_badges WHERE user_id=? AND badge_id=?
-            """, (str(user_id), badge['id']))
+        with db.write() as cur:
+            # Get all badges
+            badges = catalog.get("badges")['badges']
             
-            if cur.fetchone():
-                continue
-            
-            # Check requirement
-            has_badge = False
-            
-            if badge['requirement_type'] == 'messages':
-                # Count total messages
-                cur.execute("""
-                    SELECT COUNT(*) as count FROM chat_messages WHERE from_user=?
-                """, (str(user_id),))
-                count = cur.fetchone()['count']
-                if count >= badge['requirement_value']:
-                    has_badge = True
-            
-            elif badge['requirement_type'] == 'friends':
-                # Count friends
-                cur.execute("""
-                    SELECT COUNT(*) as count FROM friends WHERE user_id=?
-                """, (str(user_id),))
-                count = cur.fetchone()['count']
-                if count >= badge['requirement_value']:
-                    has_badge = True
-            
-            elif badge['requirement_type'] == 'games':
-                # Count games played
-                cur.execute("""
-                    SELECT COUNT(*) as count FROM game_players WHERE user_id=?
-                """, (str(user_id),))
-                count = cur.fetchone()['count']
-                if count >= badge['requirement_value']:
-                    has_badge = True
-            
-            elif badge['requirement_type'] == 'streak':
-                # Get streak
-                cur.execute("SELECT streak FROM daily_claims WHERE user_id=?", (str(user_id),))
-                claim = cur.fetchone()
-                if claim and claim['streak'] >= badge['requirement_value']:
-                    has_badge = True
-            
-            elif badge['requirement_type'] == 'purchases':
-                # Count purchases
-                cur.execute("""
-                    SELECT COUNT(*) as count FROM user_purchases WHERE user_id=?
-                """, (str(user_id),))
-                count = cur.fetchone()['count']
-                if count >= badge['requirement_value']:
-                    has_badge = True
-            
-            if has_badge:
-                # Award badge
-                now = int(time.time())
-                cur.execute("""
-                    INSERT INTO user_badges (user_id, badge_id, earned_at)
-                    VALUES (?, ?, ?)
-                """, (str(user_id), badge['id'], now))
+            for badge in badges:
+                # Check if already has
+                if cur.one("badges.user_has", (str(user_id), badge['id'])):
+                    continue
+                
+                # Check requirement
+                has_badge = False
                 
-                # Give rewards
-                if badge['coin_reward'] > 0:
-                    coin_manager.add_coins(user_id, badge['coin_reward'], f"badge_{badge['id']}")
+                if badge['requirement_type'] == 'messages':
+                    # Count total messages
+                    count = cur.one("badges.message_count", (str(user_id), str(user_id)))['count']
+                    if count >= badge['requirement_value']:
+                        has_badge = True
                 
-                if badge['xp_reward'] > 0:
-                    level_manager.add_xp(user_id, badge['xp_reward'])
+                elif badge['requirement_type'] == 'friends':
+                    # Count friends
+                    count = cur.one("badges.friend_count", (str(user_id),))['count']
+                    if count >= badge['requirement_value']:
+                        has_badge = True
                 
-                awarded.append(badge)
+                elif badge['requirement_type'] == 'games':
+                    # Count games played
+                    count = cur.one("badges.game_count", (str(user_id),))['count']
+                    if count >= badge['requirement_value']:
+                        has_badge = True
+                
+                elif badge['requirement_type'] == 'streak':
+                    # Get streak
+                    claim = cur.one("coins.streak", (str(user_id),))
+                    if claim and claim['streak'] >= badge['requirement_value']:
+                        has_badge = True
+                
+                elif badge['requirement_type'] == 'purchases':
+                    # Count purchases
+                    count = cur.one("badges.purchase_count", (str(user_id),))['count']
+                    if count >= badge['requirement_value']:
+                        has_badge = True
+                
+                if has_badge:
+                    # Award badge
+                    now = int(time.time())
+                    cur.run("badges.award", (str(user_id), badge['id'], now))
+                    
+                    # Give rewards
+                    if badge['coin_reward'] > 0:
+                        coin_manager.add_coins(user_id, badge['coin_reward'], f"badge_{badge['id']}", key=f"badge:{badge['id']}:{user_id}")
+                    
+                    if badge['xp_reward'] > 0:
+                        level_manager.add_xp(user_id, badge['xp_reward'])
+                    
+                    awarded.append(badge)
         
-        conn.commit()
         return awarded
     
     def get_user_badges(self, user_id):
         """Get user's badges"""
-        cur.execute("""
-            SELECT b.*, ub.earned_at
-            FROM user_badges ub
-            JOIN badges b ON ub.badge_id = b.id
-            WHERE ub.user_id=?
-            ORDER BY ub.earned_at DESC
-        """, (str(user_id),))
-        return cur.fetchall()
+        with db.read() as cur:
+            return cur.all("badges.user_badges", (str(user_id),))
 
 badge_manager = BadgeManager()
 
 # ==================== REPORT MANAGER ====================
 
+queries.register({
+    "reports.insert": """
+        INSERT INTO reports (reporter_id, reported_user_id, reason, details, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+    "reports.pending": """
+        SELECT r.*, u1.username as reporter_name, u2.username as reported_name
+        FROM reports r
+        JOIN users u1 ON r.reporter_id = u1.user_id
+        JOIN users u2 ON r.reported_user_id = u2.user_id
+        WHERE r.status='pending'
+        ORDER BY r.created_at DESC
+    """,
+    "reports.resolve": """
+        UPDATE reports
+        SET status='resolved', resolved_at=?, resolved_by=?
+        WHERE id=?
+    """,
+    "reports.log_resolution": """
+        INSERT INTO moderation_logs (moderator_id, action, target_user, reason, created_at)
+        SELECT ?, 'report_resolved', reported_user_id, ?, ?
+        FROM reports WHERE id=?
+    """
+})
+
 class ReportManager:
     """Manage user reports"""
     
+    @db_write
     def create_report(self, reporter_id, reported_user_id, reason, details=""):
         """Create new report"""
         now = int(time.time())
         
-        cur.execute("""
-            INSERT INTO reports (reporter_id, reported_user_id, reason, details, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (str(reporter_id), str(reported_user_id), reason, details, now))
-        conn.commit()
-        
-        return cur.lastrowid
+        with db.write() as cur:
+            cur.run("reports.insert", (str(reporter_id), str(reported_user_id), reason, details, now))
+            return cur.lastrowid
     
     def get_pending_reports(self):
         """Get pending reports"""
-        cur.execute("""
-            SELECT r.*, u1.username as reporter_name, u2.username as reported_name
-            FROM reports r
-            JOIN users u1 ON r.reporter_id = u1.user_id
-            JOIN users u2 ON r.reported_user_id = u2.user_id
-            WHERE r.status='pending'
-            ORDER BY r.created_at DESC
-        """)
-        return cur.fetchall()
+        with db.read() as cur:
+            return cur.all("reports.pending")
     
+    @db_write
     def resolve_report(self, report_id, resolved_by, action_taken=""):
         """Resolve report"""
-        cur.execute("""
-            UPDATE reports 
-            SET status='resolved', resolved_at=?, resolved_by=?
-            WHERE id=?
-        """, (int(time.time()), str(resolved_by), report_id))
-        conn.commit()
-        
-        # Log moderation action
-        cur.execute("""
-            INSERT INTO moderation_logs (moderator_id, action, target_user, reason, created_at)
-            SELECT ?, 'report_resolved', reported_user_id, ?, ?
-            FROM reports WHERE id=?
-        """, (str(resolved_by), action_taken, int(time.time()), report_id))
-        conn.commit()
+        with db.write() as cur:
+            cur.run("reports.resolve", (int(time.time()), str(resolved_by), report_id))
+            
+            # Log moderation action
+            cur.run("reports.log_resolution", (str(resolved_by), action_taken, int(time.time()), report_id))
         
         return True
 
@@ -1825,6 +4363,11 @@ report_manager = ReportManager()
 
 # ==================== MENU MANAGER ====================
 
+queries.register({
+    "menus.active": "SELECT * FROM menus WHERE is_active=1 ORDER BY display_order",
+    "config.all": "SELECT key, value FROM system_config"
+})
+
 class MenuManager:
     """Manage dynamic menus"""
     
@@ -1834,31 +4377,13 @@ class MenuManager:
         
         if user and user['role'] in ['admin', 'super_admin']:
             # Admin gets admin menus
-            cur.execute("""
-                SELECT * FROM menus 
-                WHERE menu_type IN ('both', 'admin') AND is_active=1
-                ORDER BY display_order
-            """)
-        else:
-            # Regular user gets user menus
-            cur.execute("""
-                SELECT * FROM menus 
-                WHERE menu_type IN ('both', 'user') AND is_active=1
-                ORDER BY display_order
-            """)
-        
-        menus = cur.fetchall()
-        return self.build_menu_tree(menus)
+            return catalog.get("menus")['admin']
+        # Regular user gets user menus
+        return catalog.get("menus")['user']
     
     def get_admin_menu(self):
         """Get admin menu"""
-        cur.execute("""
-            SELECT * FROM menus 
-            WHERE menu_type IN ('both', 'admin') AND is_active=1
-            ORDER BY display_order
-        """)
-        menus = cur.fetchall()
-        return self.build_menu_tree(menus)
+        return catalog.get("menus")['admin']
     
     def build_menu_tree(self, menus, parent_id=None):
         """Build menu tree"""
@@ -1905,59 +4430,270 @@ class MenuManager:
 
 menu_manager = MenuManager()
 
+# ==================== CATALOG SNAPSHOTS ====================
+
+def frozen_rows(rows):
+    """Rows as a tuple of read-only mappings"""
+    return tuple(MappingProxyType(dict(row)) for row in rows)
+
+def frozen_tree(nodes):
+    """A menu tree from build_menu_tree() as read-only mappings"""
+    return tuple(
+        MappingProxyType({**node, "children": frozen_tree(node['children'])} if 'children' in node else node)
+        for node in nodes
+    )
+
+def load_shop_catalog(cur):
+    categories = frozen_rows(cur.all("shop.categories"))
+    items = frozen_rows(cur.all("shop.items"))
+    by_category = defaultdict(list)
+    for item in items:
+        if item['is_active']:
+            by_category[item['category_id']].append(item)
+    return {
+        "categories": tuple(c for c in categories if c['is_active']),
+        "categories_by_id": MappingProxyType({c['id']: c for c in categories}),
+        "items": tuple(i for i in items if i['is_active']),
+        "items_by_id": MappingProxyType({i['id']: i for i in items}),
+        "items_by_category": MappingProxyType({k: tuple(v) for k, v in by_category.items()})
+    }
+
+def load_games_catalog(cur):
+    games = frozen_rows(cur.all("games.all"))
+    return {
+        "games": tuple(g for g in games if g['is_active']),
+        "games_by_id": MappingProxyType({g['id']: g for g in games})
+    }
+
+def load_badges_catalog(cur):
+    return {"badges": frozen_rows(cur.all("badges.all"))}
+
+def load_menus_catalog(cur):
+    menus = [dict(row) for row in cur.all("menus.active")]
+    return {
+        "admin": frozen_tree(menu_manager.build_menu_tree([m for m in menus if m['menu_type'] in ('both', 'admin')])),
+        "user": frozen_tree(menu_manager.build_menu_tree([m for m in menus if m['menu_type'] in ('both', 'user')]))
+    }
+
+def load_config_catalog(cur):
+    return {"values": MappingProxyType({row['key']: row['value'] for row in cur.all("config.all")})}
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """One immutable, versioned copy of a catalog part"""
+    version: int
+    loaded_at: float
+    data: MappingProxyType
+
+class Catalog:
+    """In-memory snapshots of the small, almost read-only tables.
+
+    Each part is loaded in one read, frozen (tuples and read-only
+    mappings) and swapped in whole with a new version stamp, so readers
+    never take a lock or see a half-loaded catalog. Parts are warmed at
+    startup and otherwise loaded on first use. Code that edits a catalog
+    table calls reload(part) after committing; other processes drop
+    their copy through the "catalog.<part>" invalidation namespace.
+    """
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.stats = defaultdict(int)
+        self._snapshots = {}
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+        for part in loaders:
+            invalidations.on_namespace(f"catalog.{part}", partial(self.invalidate, part))
+
+    def get(self, part):
+        """Current data for a part, loading it if needed"""
+        snapshot = self._snapshots.get(part)
+        if snapshot is None:
+            snapshot = self._load(part)
+        return snapshot.data
+
+    def _load(self, part):
+        with self._lock:
+            with db.read() as cur:
+                data = self.loaders[part](cur)
+            self._versions[part] += 1
+            snapshot = CatalogSnapshot(self._versions[part], time.time(), MappingProxyType(data))
+            self._snapshots[part] = snapshot
+        self.stats['loads'] += 1
+        return snapshot
+
+    def invalidate(self, part):
+        """Drop a part; it is reloaded on next use"""
+        self._snapshots.pop(part, None)
+
+    def reload(self, *parts):
+        """Reload parts here and invalidate them in other processes"""
+        for part in parts or self.loaders:
+            cache.delete_namespace(f"catalog.{part}")
+            self._load(part)
+
+    def warm(self):
+        """Load every part, plus the admin set, ahead of the first request"""
+        for part in self.loaders:
+            self._load(part)
+        if not admin_manager._loaded:
+            admin_manager.load_admins()
+
+    def config(self, key, default=None):
+        """A system_config value"""
+        return self.get("config")['values'].get(key, default)
+
+    def versions(self):
+        """Version and load time of each loaded part"""
+        return {
+            part: {"version": snapshot.version, "loaded_at": int(snapshot.loaded_at)}
+            for part, snapshot in list(self._snapshots.items())
+        }
+
+    def snapshot(self):
+        """Load counters and the version of each loaded part"""
+        return dict(self.stats, parts=self.versions())
+
+catalog = Catalog({
+    "shop": load_shop_catalog,
+    "games": load_games_catalog,
+    "badges": load_badges_catalog,
+    "menus": load_menus_catalog,
+    "config": load_config_catalog
+})
+
 # ==================== ADMIN MANAGER ====================
 
+queries.register({
+    "admin.admin_ids": "SELECT user_id FROM users WHERE role IN ('admin', 'super_admin')",
+    "admin.grant": """
+        UPDATE users SET role='admin' WHERE user_id=?
+    """,
+    "admin.log_grant": """
+        INSERT INTO moderation_logs (moderator_id, action, target_user, created_at)
+        VALUES (?, 'add_admin', ?, ?)
+    """,
+    "admin.revoke": """
+        UPDATE users SET role='user' WHERE user_id=?
+    """,
+    "admin.log_revoke": """
+        INSERT INTO moderation_logs (moderator_id, action, target_user, created_at)
+        VALUES (?, 'remove_admin', ?, ?)
+    """,
+    "admin.user_count": "SELECT COUNT(*) as total FROM users",
+    "admin.active_today": "SELECT COUNT(*) as total FROM users WHERE last_request_date=date('now')",
+    "admin.total_requests": "SELECT SUM(total_requests) as total FROM users",
+    "admin.total_coins": "SELECT SUM(coin_balance) as total FROM users",
+    "admin.recent_users_limited": "SELECT * FROM users ORDER BY created_at DESC LIMIT ?",
+    "admin.recent_users": "SELECT * FROM users ORDER BY created_at DESC",
+    "admin.active_on_date": "SELECT COUNT(*) as count FROM users WHERE date(last_request_date, 'unixepoch')=?",
+    "admin.broadcast_targets": "SELECT telegram_id FROM users WHERE telegram_id IS NOT NULL",
+    "admin.reset_coins": """
+        INSERT INTO coin_transactions (user_id, amount, balance_after, reason, created_at)
+        SELECT user_id, 1000 - coin_balance, 1000, 'admin_reset', ? FROM users
+        WHERE coin_balance != 1000
+    """,
+    "admin.reset_coin_totals": "UPDATE users SET total_coins_earned=1000, total_coins_spent=0",
+    "admin.reset_levels": "UPDATE user_levels SET level=1, xp=0, total_xp=0, activity_score=0, next_level_xp=?",
+    "admin.log_clear": """
+        INSERT INTO moderation_logs (moderator_id, action, reason, created_at)
+        VALUES (?, 'clear_database', 'Database cleared by admin', ?)
+    """
+})
+
 class AdminManager:
     """Manage admin users and permissions"""
     
     def __init__(self):
         self.admins = set()
-        self.load_admins()
+        self._loaded = False
+        invalidations.on_namespace("admins", self.reload)
+    
+    def reload(self):
+        """Forget the admin set; it is loaded again on the next permission check"""
+        self.admins = set()
+        self._loaded = False
     
     def load_admins(self):
         """Load admin users"""
-        cur.execute("SELECT user_id FROM users WHERE role IN ('admin', 'super_admin')")
-        for row in cur.fetchall():
-            self.admins.add(row['user_id'])
+        with db.read() as cur:
+            for row in cur.all("admin.admin_ids"):
+                self.admins.add(row['user_id'])
+        self._loaded = True
     
     def is_admin(self, user_id):
         """Check if user is admin"""
+        if not self._loaded:
+            # Deferred from startup until the first permission check
+            self.load_admins()
         return str(user_id) in self.admins
     
+    @db_write
     def add_admin(self, user_id, added_by):
         """Add admin user"""
-        cur.execute("""
-            UPDATE users SET role='admin' WHERE user_id=?
-        """, (str(user_id),))
-        conn.commit()
-        self.admins.add(str(user_id))
+        with db.write() as cur:
+            cur.run("admin.grant", (str(user_id),))
+            
+            # Log action
+            cur.run("admin.log_grant", (str(added_by), str(user_id), int(time.time())))
         
-        # Log action
-        cur.execute("""
-            INSERT INTO moderation_logs (moderator_id, action, target_user, created_at)
-            VALUES (?, 'add_admin', ?, ?)
-        """, (str(added_by), str(user_id), int(time.time())))
-        conn.commit()
+        # After the commit, so no reader can reload the old admin set
+        cache.delete_namespace("admins")
+        cache.delete(f"user:{user_id}")
         
         return True
     
+    @db_write
     def remove_admin(self, user_id, removed_by):
         """Remove admin user"""
-        cur.execute("""
-            UPDATE users SET role='user' WHERE user_id=?
-        """, (str(user_id),))
-        conn.commit()
-        self.admins.discard(str(user_id))
+        with db.write() as cur:
+            cur.run("admin.revoke", (str(user_id),))
+            
+            # Log action
+            cur.run("admin.log_revoke", (str(removed_by), str(user_id), int(time.time())))
         
-        # Log action
-        cur.execute("""
-            INSERT INTO moderation_logs (moderator_id, action, target_user, created_at)
-            VALUES (?, 'remove_admin', ?, ?)
-        """, (str(removed_by), str(user_id), int(time.time())))
-        conn.commit()
+        # After the commit, so no reader can reload the old admin set
+        cache.delete_namespace("admins")
+        cache.delete(f"user:{user_id}")
         
         return True
     
+    def get_stats(self):
+        """Get bot-wide statistics"""
+        with db.read() as cur:
+            total_users = cur.one("admin.user_count")['total']
+            
+            active_today = cur.one("admin.active_today")['total']
+            
+            total_messages = cur.one("admin.total_requests")['total'] or 0
+            
+            total_coins = cur.one("admin.total_coins")['total'] or 0
+        
+        return {
+            "total_users": total_users,
+            "active_today": active_today,
+            "total_messages": total_messages,
+            "total_coins": total_coins
+        }
+    
+    def get_recent_users(self, limit=None):
+        """Get most recently created users"""
+        with db.read() as cur:
+            if limit:
+                return cur.all("admin.recent_users_limited", (limit,))
+            return cur.all("admin.recent_users")
+    
+    def get_active_user_count(self, date):
+        """Count users active on a date"""
+        with db.read() as cur:
+            return cur.one("admin.active_on_date", (date,))['count']
+    
+    def get_broadcast_targets(self):
+        """Get Telegram IDs of all users"""
+        with db.read() as cur:
+            return cur.all("admin.broadcast_targets")
+    
+    @db_write
     def clear_database(self, admin_id):
         """Clear database (admin only)"""
         if not self.is_admin(admin_id):
@@ -1966,33 +4702,40 @@ class AdminManager:
         try:
             # Backup first
             backup_file = f"backup_before_clear_{int(time.time())}.db"
-            shutil.copy2("superbase.db", backup_file)
-            
-            # Clear tables but keep structure
-            tables = [
-                "chat_messages", "group_messages", "user_purchases", 
-                "user_inventory", "game_sessions", "game_players",
-                "game_moves", "reports", "moderation_logs",
-                "friend_requests", "friends", "blocks", "daily_claims"
-            ]
-            
-            for table in tables:
-                cur.execute(f"DELETE FROM {table}")
-            
-            # Reset user coins to 1000
-            cur.execute("UPDATE users SET coin_balance=1000, total_coins_earned=1000, total_coins_spent=0")
+            db.backup(backup_file)
             
-            # Reset levels
-            cur.execute("UPDATE user_levels SET level=1, xp=0, total_xp=0, activity_score=0, next_level_xp=100")
+            with db.write() as cur:
+                # Land batched activity first so the reset below covers it
+                activity_aggregator.flush()
+                
+                # Clear tables but keep structure
+                tables = [
+                    "chat_messages", "group_messages", "user_purchases", 
+                    "user_inventory", "game_sessions", "game_players",
+                    "game_moves", "reports", "moderation_logs",
+                    "friend_requests", "friends", "blocks", "daily_claims",
+                    "message_archive_counts", "message_archive_index"
+                ]
+                
+                for table in tables:
+                    cur.run("admin.clear_table", sql=f"DELETE FROM {table}")
+                
+                # Reset user coins to 1000 through the ledger, which is kept
+                cur.run("admin.reset_coins", (int(time.time()),))
+                cur.run("admin.reset_coin_totals")
+                
+                # Reset levels
+                cur.run("admin.reset_levels", (LEVEL_BASE_XP,))
+                
+                # Log action
+                cur.run("admin.log_clear", (str(admin_id), int(time.time())))
             
-            conn.commit()
+            # Every cached balance and level is now wrong, and claims start over
+            cache.delete_namespace("user")
+            cache.delete_namespace("claim")
             
-            # Log action
-            cur.execute("""
-                INSERT INTO moderation_logs (moderator_id, action, reason, created_at)
-                VALUES (?, 'clear_database', 'Database cleared by admin', ?)
-            """, (str(admin_id), int(time.time())))
-            conn.commit()
+            # Archived messages go with the backup rather than being deleted
+            message_archive.move_to(backup_file[:-3] + "_archive")
             
             logger.warning(f"Database cleared by admin {admin_id}, backup saved as {backup_file}")
             return True, f"Database cleared. Backup saved as {backup_file}"
@@ -2015,12 +4758,523 @@ def set_bot(bot):
 def get_bot():
     return bot_instance
 
+# ==================== CONVERSATION MEMORY ====================
+
+queries.register({
+    "memory.append": """
+        INSERT INTO conversation_log (user_id, role, content, created_at)
+        VALUES (?, ?, ?, ?)
+    """,
+    "memory.recent": """
+        SELECT role, content, created_at FROM conversation_log
+        WHERE user_id=? AND created_at > ?
+        ORDER BY id DESC
+        LIMIT ?
+    """,
+    "memory.over_capacity": """
+        SELECT user_id, COUNT(*) AS entries FROM conversation_log
+        GROUP BY user_id
+        HAVING entries > ?
+    """,
+    "memory.trim": """
+        DELETE FROM conversation_log
+        WHERE user_id=? AND id <= (
+            SELECT id FROM conversation_log
+            WHERE user_id=?
+            ORDER BY id DESC
+            LIMIT 1 OFFSET ?
+        )
+    """,
+    "memory.expire": "DELETE FROM conversation_log WHERE created_at < ?"
+})
+
+MEMORY_TTL = int(os.getenv("MEMORY_TTL", "86400"))
+MEMORY_CAPACITY = int(os.getenv("MEMORY_CAPACITY", "20"))
+MEMORY_CONTEXT = int(os.getenv("MEMORY_CONTEXT", "12"))
+LONG_MEMORY_CAPACITY = int(os.getenv("LONG_MEMORY_CAPACITY", "200"))
+LONG_MEMORY_CONTEXT = int(os.getenv("LONG_MEMORY_CONTEXT", "40"))
+MEMORY_RESIDENT_USERS = int(os.getenv("MEMORY_RESIDENT_USERS", "10000"))
+MEMORY_COMPACT_INTERVAL = int(os.getenv("MEMORY_COMPACT_INTERVAL", "600"))
+
+def has_feature(user, feature):
+    """True if the user unlocked a shop feature"""
+    if not user:
+        return False
+    metadata = json.loads(user.get('metadata') or '{}')
+    return feature in metadata.get('unlocked_features', [])
+
+class ConversationMemory:
+    """Per-user ring buffers of recent turns over an append-only log.
+
+    Appends go to the user's deque and add one row to conversation_log,
+    so a message costs O(1) whatever the capacity. The last k turns are
+    read from the deque in O(k). A buffer is loaded from the log the
+    first time a user is seen, and the least recently active buffers are
+    dropped past MEMORY_RESIDENT_USERS. MemoryCompactor trims each
+    user's log to their capacity and drops expired turns.
+    """
+
+    def __init__(self, ttl, max_users):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.stats = defaultdict(int)
+        self._buffers = OrderedDict()  # user_id -> deque of (role, content, created_at)
+        self._lock = threading.Lock()
+
+    def limits(self, user_id):
+        """(capacity, context turns) for a user; Long Memory raises both"""
+        if has_feature(get_user(user_id), "long_memory"):
+            return LONG_MEMORY_CAPACITY, LONG_MEMORY_CONTEXT
+        return MEMORY_CAPACITY, MEMORY_CONTEXT
+
+    def _buffer(self, user_id):
+        with self._lock:
+            buffer = self._buffers.get(user_id)
+            if buffer is not None:
+                self._buffers.move_to_end(user_id)
+                return buffer
+        
+        capacity, _ = self.limits(user_id)
+        with db.read() as cur:
+            rows = cur.all("memory.recent", (user_id, time.time() - self.ttl, capacity))
+        loaded = deque(((row['role'], row['content'], row['created_at']) for row in reversed(rows)), maxlen=capacity)
+        self.stats['loads'] += 1
+        
+        with self._lock:
+            # Another thread may have loaded it meanwhile; keep theirs
+            buffer = self._buffers.setdefault(user_id, loaded)
+            self._buffers.move_to_end(user_id)
+            while len(self._buffers) > self.max_users:
+                self._buffers.popitem(last=False)
+        return buffer
+
+    def append(self, user_id, role, content):
+        """Add one turn to the user's buffer and log"""
+        user_id = str(user_id)
+        buffer = self._buffer(user_id)
+        now = time.time()
+        with db.write() as cur:
+            cur.run("memory.append", (user_id, role, content, now))
+        buffer.append((role, content, now))
+        self.stats['appends'] += 1
+
+    def recent(self, user_id, limit=None):
+        """Last turns, oldest first, without timestamps"""
+        buffer = self._buffer(str(user_id))
+        if limit is None:
+            # The buffer was sized by limits(), so its capacity tells which tier applies
+            limit = LONG_MEMORY_CONTEXT if buffer.maxlen >= LONG_MEMORY_CAPACITY else MEMORY_CONTEXT
+        
+        cutoff = time.time() - self.ttl
+        turns = []
+        for role, content, created_at in reversed(buffer):
+            if len(turns) >= limit or created_at <= cutoff:
+                break
+            turns.append({"role": role, "content": content})
+        turns.reverse()
+        return turns
+
+    def resize(self, user_id):
+        """Apply a capacity change, e.g. after buying Long Memory"""
+        user_id = str(user_id)
+        capacity, _ = self.limits(user_id)
+        with self._lock:
+            buffer = self._buffers.get(user_id)
+            if buffer is not None and buffer.maxlen != capacity:
+                self._buffers[user_id] = deque(buffer, maxlen=capacity)
+
+    def compact(self):
+        """Trim every log to its owner's capacity and drop expired turns; returns rows removed"""
+        removed = 0
+        with db.write() as cur:
+            removed += cur.run("memory.expire", (time.time() - self.ttl,)).rowcount
+        
+        with db.read() as cur:
+            candidates = [row['user_id'] for row in cur.all("memory.over_capacity", (MEMORY_CAPACITY,))]
+        for user_id in candidates:
+            capacity, _ = self.limits(user_id)
+            with db.write() as cur:
+                removed += cur.run("memory.trim", (user_id, user_id, capacity)).rowcount
+        
+        self.stats['compactions'] += 1
+        self.stats['compacted_rows'] += removed
+        return removed
+
+    def resident(self):
+        with self._lock:
+            return len(self._buffers)
+
+    def snapshot(self):
+        """Compaction counters and users with a resident buffer"""
+        return dict(self.stats, resident_users=self.resident())
+
+conversation_memory = ConversationMemory(MEMORY_TTL, MEMORY_RESIDENT_USERS)
+
+class MemoryCompactor(BackgroundTask):
+    """Periodically compact the conversation log"""
+
+    def __init__(self, memory, interval):
+        super().__init__("memory-compactor", interval)
+        self.memory = memory
+
+    def run_once(self):
+        removed = self.memory.compact()
+        if removed:
+            logger.info(f"🧹 Compacted {removed} conversation log rows")
+
+memory_compactor = MemoryCompactor(conversation_memory, MEMORY_COMPACT_INTERVAL)
+
+# ==================== ACTIVITY AGGREGATOR ====================
+
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))
+ACTIVITY_FLUSH_MAX = int(os.getenv("ACTIVITY_FLUSH_MAX", "1000"))
+ACTIVITY_JOURNAL = os.getenv("ACTIVITY_JOURNAL", f"{DATABASE_PATH}.activity")
+
+queries.register({
+    "activity.levels": """
+        INSERT INTO user_levels (user_id, xp, total_xp, next_level_xp, activity_seq, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            xp = xp + excluded.xp,
+            total_xp = total_xp + excluded.total_xp,
+            activity_seq = excluded.activity_seq,
+            updated_at = excluded.updated_at
+        RETURNING level, total_xp
+    """,
+    # Runs after the ledger credit, so the returned row includes the coins
+    "activity.counters": """
+        UPDATE users
+        SET daily_requests = CASE WHEN last_request_date=? THEN daily_requests + ? ELSE ? END,
+            total_requests = total_requests + ?,
+            last_request_date=?,
+            activity_seq=?
+        WHERE user_id=?
+        RETURNING *
+    """,
+    "config.get": "SELECT value FROM system_config WHERE key=?"
+})
+
+@dataclass
+class ActivityDelta:
+    """Unflushed message activity of one user"""
+    day: str
+    day_messages: int = 0
+    messages: int = 0
+    xp: int = 0
+    coins: int = 0
+
+    def add(self, day, messages, xp, coins):
+        self.day_messages = self.day_messages + messages if day == self.day else messages
+        self.day = day
+        self.messages += messages
+        self.xp += xp
+        self.coins += coins
+
+    def extend(self, later):
+        """Append a later delta of the same user"""
+        self.day_messages = self.day_messages + later.day_messages if later.day == self.day else later.day_messages
+        self.day = later.day
+        self.messages += later.messages
+        self.xp += later.xp
+        self.coins += later.coins
+
+    def apply_user(self, user):
+        """Add this delta to a copy of a users row"""
+        user['daily_requests'] = (user['daily_requests'] or 0) + self.day_messages if user['last_request_date'] == self.day else self.day_messages
+        user['last_request_date'] = self.day
+        user['total_requests'] = (user['total_requests'] or 0) + self.messages
+        user['coin_balance'] = (user['coin_balance'] or 0) + self.coins
+        user['total_coins_earned'] = (user['total_coins_earned'] or 0) + self.coins
+
+class ActivityAggregator:
+    """Per-message counters, XP and coins, batched in memory.
+
+    Each message only updates an in-memory delta and appends a line to
+    the journal segment of the current batch. A flush applies a whole
+    batch in one transaction and stamps every row it touches with the
+    batch sequence, so readers add exactly the batches a row has not
+    seen yet. A batch leaves memory, and its segment the disk, only once
+    that transaction commits. A batch whose segment is still on disk at
+    startup, newer than the "activity_seq" watermark in system_config,
+    is replayed.
+    """
+
+    def __init__(self, journal_path, flush_threshold):
+        self.journal_path = journal_path
+        self.flush_threshold = flush_threshold
+        self.flusher = None
+        self.stats = defaultdict(int)
+        self.seq = 0
+        self._pending = {}
+        self._flushing = []  # (seq, batch) applied but not committed yet
+        self._events = 0
+        self._journal = None
+        self._segments = []
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _segment(self, seq):
+        return f"{self.journal_path}.{seq}"
+
+    def _open_segment(self):
+        if self.journal_path:
+            self._journal = os.open(self._segment(self.seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._segments.append(self.seq)
+
+    def recover(self):
+        """Apply journal segments left by a crash and open the next one"""
+        # Like flush(), hold the write lock before self._lock
+        with db.write() as cur:
+            if self._ready:
+                return
+            
+            row = cur.one("config.get", ("activity_seq",))
+            applied = int(row['value']) if row else 0
+            
+            segments = []
+            if self.journal_path:
+                folder, prefix = os.path.split(self.journal_path)
+                for name in os.listdir(folder or "."):
+                    suffix = name[len(prefix) + 1:]
+                    if name.startswith(f"{prefix}.") and suffix.isdigit():
+                        segments.append(int(suffix))
+            
+            fresh = {}
+            for seq in sorted(segments):
+                if seq > applied:
+                    batch = {}
+                    with open(self._segment(seq)) as f:
+                        for line in f:
+                            parts = line.rstrip("\n").split("\t")
+                            if len(parts) != 4:
+                                # Torn final line
+                                continue
+                            user_id, day, xp, coins = parts
+                            batch.setdefault(user_id, ActivityDelta(day)).add(day, 1, int(xp), int(coins))
+                    if batch:
+                        fresh.update(self._apply(seq, batch))
+                        logger.info(f"♻️ Replayed activity of {len(batch)} users from journal segment {seq}")
+            
+            with self._lock:
+                self.seq = max([applied, *segments]) + 1
+                self._open_segment()
+                self._ready = True
+            
+            def replayed():
+                for seq in segments:
+                    os.remove(self._segment(seq))
+                self._cache_rows(fresh)
+            
+            def rolled_back():
+                # Leave the segments for the next attempt
+                with self._lock:
+                    if self._journal is not None:
+                        os.close(self._journal)
+                        self._journal = None
+                    self._segments.clear()
+                    self._ready = False
+            
+            db.after_commit(replayed, rolled_back)
+
+    def record(self, user_id):
+        """Count one message, with the configured XP and coins"""
+        if not self._ready:
+            self.recover()
+        
+        user_id = str(user_id)
+        day = datetime.now().strftime("%Y-%m-%d")
+        xp = int(catalog.config("xp_per_message", 10))
+        coins = int(catalog.config("coins_per_message", 5))
+        
+        with self._lock:
+            if self._journal is not None:
+                os.write(self._journal, f"{user_id}\t{day}\t{xp}\t{coins}\n".encode())
+            delta = self._pending.get(user_id)
+            if delta is None:
+                delta = self._pending[user_id] = ActivityDelta(day)
+            delta.add(day, 1, xp, coins)
+            self._events += 1
+            backlog = self._events
+        self.stats['events'] += 1
+        
+        if backlog >= self.flush_threshold:
+            if self.flusher is not None and self.flusher.is_alive():
+                self.flusher.wake()
+            else:
+                self.flush()
+
+    def _unflushed(self, user_id):
+        return user_id in self._pending or any(user_id in batch for _, batch in self._flushing)
+
+    def _deltas(self, user_id, seen):
+        """Unflushed deltas for a row last stamped with batch `seen`, oldest first"""
+        with self._lock:
+            return [
+                batch[user_id]
+                for seq, batch in (*self._flushing, (self.seq, self._pending))
+                if seq > seen and user_id in batch
+            ]
+
+    def merge(self, user):
+        """A users row with unflushed activity added"""
+        if not user:
+            return user
+        user_id = user['user_id']
+        if not self._unflushed(user_id):
+            return user
+        
+        deltas = self._deltas(user_id, user.get('activity_seq') or 0)
+        if not deltas:
+            return user
+        user = dict(user)
+        for delta in deltas:
+            delta.apply_user(user)
+        return user
+
+    def merge_levels(self, row):
+        """A user_levels row with unflushed XP added and the level resolved"""
+        if not row:
+            return row
+        user_id = row['user_id']
+        if not self._unflushed(user_id):
+            return row
+        
+        deltas = self._deltas(user_id, row['activity_seq'] or 0)
+        if not deltas:
+            return row
+        row = dict(row)
+        row['total_xp'] += sum(delta.xp for delta in deltas)
+        row['level'], row['xp'], row['next_level_xp'] = level_curve.resolve(row['total_xp'])
+        return row
+
+    def settle(self, user_id):
+        """Apply the batch within the caller's transaction if it holds the user's activity.
+
+        Batches flushed earlier in the same transaction are already applied.
+        """
+        if str(user_id) in self._pending:
+            self.flush()
+
+    def pending(self):
+        """Users with unflushed activity"""
+        return len(self._pending)
+
+    def snapshot(self):
+        """Event and flush counters and users with unflushed activity"""
+        return dict(self.stats, pending_users=self.pending())
+
+    def flush(self):
+        """Apply the current batch in one transaction"""
+        # The write lock orders flushes; inside a caller's write this is a savepoint
+        with db.write():
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, seq = self._pending, self.seq
+                self._flushing.append((seq, batch))
+                self._pending = {}
+                self._events = 0
+                self.seq += 1
+                journal = self._journal
+                self._open_segment()
+            if journal is not None:
+                os.close(journal)
+            
+            try:
+                fresh = self._apply(seq, batch)
+            except Exception:
+                self._restore(batch)
+                raise
+            db.after_commit(lambda: self._flushed(seq, batch, fresh), lambda: self._restore(batch))
+        return len(batch)
+
+    def _flushed(self, seq, batch, fresh):
+        with self._lock:
+            self._flushing = [entry for entry in self._flushing if entry[1] is not batch]
+            # Segments up to seq are now covered by the watermark
+            done = [s for s in self._segments if s <= seq]
+            self._segments = [s for s in self._segments if s > seq]
+        for segment in done:
+            os.remove(self._segment(segment))
+        self._cache_rows(fresh)
+        
+        self.stats['flushes'] += 1
+        self.stats['users_flushed'] += len(batch)
+
+    def _restore(self, batch):
+        """Fold a batch that did not commit back in front of anything recorded since"""
+        with self._lock:
+            self._flushing = [entry for entry in self._flushing if entry[1] is not batch]
+            for user_id, delta in batch.items():
+                self._events += delta.messages
+                later = self._pending.get(user_id)
+                if later is not None:
+                    delta.extend(later)
+                self._pending[user_id] = delta
+
+    def _apply(self, seq, batch):
+        """Write a batch; returns the fresh users rows to cache after commit"""
+        now = int(time.time())
+        fresh = {}
+        with db.write() as cur:
+            for user_id, delta in batch.items():
+                level = cur.one("activity.levels", (user_id, delta.xp, delta.xp, LEVEL_BASE_XP, seq, now, now))
+                level_manager.check_level_up(cur, user_id, level['level'], level['total_xp'])
+                
+                if delta.coins:
+                    cur.one("coins.credit", (delta.coins, delta.coins, "messages", None, now, user_id))
+                
+                fresh[user_id] = cur.one("activity.counters", (
+                    delta.day, delta.day_messages, delta.day_messages,
+                    delta.messages, delta.day, seq, user_id
+                ))
+                cache.delete(f"user:{user_id}")
+            
+            cur.run("config.set", ("activity_seq", str(seq), now))
+        return fresh
+
+    def _cache_rows(self, fresh):
+        for user_id, row in fresh.items():
+            if row:
+                cache.set(f"user:{user_id}", dict(row), 300)
+
+    def close(self):
+        """Flush and close the journal"""
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                os.close(self._journal)
+                self._journal = None
+
+activity_aggregator = ActivityAggregator(ACTIVITY_JOURNAL, ACTIVITY_FLUSH_MAX)
+
+class ActivityFlusher(BackgroundTask):
+    """Flush message activity on a timer, or early when the batch is large"""
+
+    def __init__(self, aggregator, interval):
+        super().__init__("activity-flusher", interval)
+        self.aggregator = aggregator
+        aggregator.flusher = self
+
+    def run_once(self):
+        self.aggregator.flush()
+
+    def stop(self):
+        super().stop()
+        self.aggregator.close()
+
+activity_flusher = ActivityFlusher(activity_aggregator, ACTIVITY_FLUSH_INTERVAL)
+
 # ==================== HELPER FUNCTIONS ====================
 
+queries.register({
+    "users.is_banned": "SELECT 1 FROM bans WHERE user_id=?"
+})
+
 def is_banned(user_id):
     """Check if user is banned"""
-    cur.execute("SELECT * FROM bans WHERE user_id=?", (str(user_id),))
-    return cur.fetchone() is not None
+    with db.read() as cur:
+        return cur.one("users.is_banned", (str(user_id),)) is not None
 
 def check_daily_limit(user_id):
     """Check daily message limit"""
@@ -2035,63 +5289,28 @@ def check_daily_limit(user_id):
     today = datetime.now().strftime("%Y-%m-%d")
     
     if user['last_request_date'] != today:
-        # Reset daily count
-        cur.execute("""
-            UPDATE users SET daily_requests=0, last_request_date=? WHERE user_id=?
-        """, (today, str(user_id)))
-        conn.commit()
+        # First message today; the activity flush restarts the count
         return False
     
     # Check limit (100 for free, 500 for premium, unlimited for admin)
     limit = 500 if user['plan_id'] != 'free' else 100
     return user['daily_requests'] >= limit
 
-def increment_daily_count(user_id):
-    """Increment daily request count"""
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    cur.execute("""
-        UPDATE users 
-        SET daily_requests = daily_requests + 1,
-            total_requests = total_requests + 1,
-            last_request_date=?
-        WHERE user_id=?
-    """, (today, str(user_id)))
-    conn.commit()
-    
-    # Add XP for message
-    level_manager.add_xp(user_id, 10)
-    coin_manager.add_coins(user_id, 5, "daily_message")
-
+@db_write
 def save_msg(user_id, role, text):
     """Save message to memory (for AI context)"""
-    memory_key = f"memory:{user_id}"
-    memory = cache.get(memory_key) or []
-    
-    memory.append({"role": role, "content": text, "timestamp": time.time()})
-    
-    # Keep last 20 messages
-    if len(memory) > 20:
-        memory = memory[-20:]
-    
-    cache.set(memory_key, memory, 86400)  # 24 hours
+    conversation_memory.append(user_id, role, text)
 
-def load_memory(user_id):
-    """Load user's conversation memory"""
-    memory_key = f"memory:{user_id}"
-    memory = cache.get(memory_key) or []
-    
-    # Filter out old messages (older than 24 hours)
-    cutoff = time.time() - 86400
-    memory = [m for m in memory if m.get('timestamp', 0) > cutoff]
-    
-    # Return messages without timestamps
-    return [{"role": m["role"], "content": m["content"]} for m in memory]
+def load_memory(user_id, limit=None):
+    """Load the user's recent conversation turns (for AI context)"""
+    return conversation_memory.recent(user_id, limit)
 
+@db_write
 def set_voice_mode(user_id, mode):
     """Set voice mode for user"""
     update_user(user_id, voice_mode=mode)
 
+@db_write
 def set_voice(user_id, engine, name):
     """Set voice engine and name"""
     update_user(user_id, voice_engine=engine, voice_name=name)
@@ -2104,6 +5323,232 @@ async def safe_action(bot, chat_id, action=None):
     except Exception as e:
         logger.error(f"Error sending chat action: {e}")
 
+# ==================== ASYNC DATABASE FACADE ====================
+
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "8"))
+DB_WRITE_QUEUE_SIZE = int(os.getenv("DB_WRITE_QUEUE_SIZE", "1000"))
+
+# "group" commits queued writes together, "full" commits every write on its own
+DB_DURABILITY = os.getenv("DB_DURABILITY", "group")
+DB_GROUP_COMMIT_MS = float(os.getenv("DB_GROUP_COMMIT_MS", "5"))  # Longest a batch keeps taking queued jobs
+DB_GROUP_COMMIT_MAX = int(os.getenv("DB_GROUP_COMMIT_MAX", "64"))
+
+def _resolve_future(future, result=None, error=None):
+    """Complete an asyncio future from the event loop thread"""
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class DbExecutor:
+    """Run blocking database calls off the event loop.
+
+    Reads run on a thread pool. Writes are put on a bounded queue served
+    by a single writer thread, so a slow commit only delays other writes
+    and never the event loop. A full queue applies backpressure to the
+    caller instead of growing without limit.
+
+    With group durability the writer runs the jobs that are already
+    queued in one transaction, each job in its own savepoint so a
+    failing job only rolls back itself. It never waits for more: a lone
+    write commits at once, and under load the jobs queued during one
+    commit form the next batch. The window only caps how long a batch
+    keeps taking jobs. Callers are answered after the
+    shared commit, so a resolved write is always durable and visible to
+    the read pool.
+    """
+
+    def __init__(self, read_workers=8, queue_size=1000, durability="group",
+                 window_ms=5, max_batch=64):
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-read")
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self.durability = durability
+        self.window = window_ms / 1000 if durability == "group" else 0
+        self.max_batch = max_batch if durability == "group" else 1
+        self.stats = defaultdict(int)
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+                self._writer.start()
+
+    async def read(self, func, *args, **kwargs):
+        """Await func(*args, **kwargs) on the read pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, partial(func, *args, **kwargs))
+
+    async def write(self, func, *args, **kwargs):
+        """Await func(*args, **kwargs) on the writer thread"""
+        self._ensure_writer()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        item = (partial(func, *args, **kwargs), loop, future)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            await loop.run_in_executor(self._readers, self._queue.put, item)
+        return await future
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            
+            done = []
+            try:
+                with db.write():
+                    deadline = time.monotonic() + self.window
+                    while True:
+                        call, loop, future = item
+                        try:
+                            with db.write():
+                                done.append((loop, future, call(), None))
+                        except Exception as e:
+                            done.append((loop, future, None, e))
+                        
+                        if len(done) >= self.max_batch or time.monotonic() >= deadline:
+                            break
+                        try:
+                            # Only jobs that queued up meanwhile join; an idle queue commits now
+                            item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is None:
+                            stopping = True
+                            break
+            except Exception as e:
+                # The shared commit failed, so nothing in the batch was stored
+                logger.error(f"Group commit of {len(done)} writes failed: {e}")
+                done = [(loop, future, None, e) for loop, future, _, _ in done]
+            
+            self.stats['batches'] += 1
+            self.stats['jobs'] += len(done)
+            for loop, future, result, error in done:
+                loop.call_soon_threadsafe(_resolve_future, future, result, error)
+
+    def unit_of_work(self):
+        """Collect several writes for one update into a single writer job"""
+        return UnitOfWork(self)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        """Drain pending writes and stop worker threads"""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+        self._readers.shutdown(wait=True)
+
+class UnitOfWork:
+    """Writes from one update, submitted as one job on the writer thread.
+
+        uow = adb.unit_of_work()
+        uow.add(save_msg, user_id, "user", text)
+        uow.add(badge_manager.check_and_award, user_id)
+        await uow.commit()
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._calls = []
+
+    def add(self, func, *args, **kwargs):
+        self._calls.append(partial(func, *args, **kwargs))
+
+    def _run(self):
+        return [call() for call in self._calls]
+
+    async def commit(self):
+        """Run the collected writes in one transaction, returning their results"""
+        if not self._calls:
+            return []
+        return await self._executor.write(self._run)
+
+class AsyncManager:
+    """Awaitable view of a manager.
+
+    Every method of the wrapped object becomes a coroutine function. Methods
+    marked with @db_write go to the writer thread, everything else to the
+    read pool.
+    """
+
+    def __init__(self, target, executor):
+        self._target = target
+        self._executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self._target, name)
+        submit = self._executor.write if getattr(method, 'db_write', False) else self._executor.read
+
+        async def call(*args, **kwargs):
+            return await submit(method, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+db_executor = DbExecutor(
+    DB_READ_WORKERS,
+    DB_WRITE_QUEUE_SIZE,
+    DB_DURABILITY,
+    DB_GROUP_COMMIT_MS,
+    DB_GROUP_COMMIT_MAX
+)
+
+def subsystem_stats():
+    """Snapshot of each in-memory subsystem, keyed by name"""
+    return {
+        "archive": message_archive.snapshot(),
+        "single_flight": single_flight.snapshot(),
+        "conversation_memory": conversation_memory.snapshot(),
+        "catalog": catalog.snapshot(),
+        "activity": activity_aggregator.snapshot()
+    }
+
+user_functions = SimpleNamespace(
+    get_user=get_user,
+    resolve_user_id=identity_map.user_id,
+    create_user=create_user,
+    update_user=update_user,
+    find_user_by_username=find_user_by_username,
+    is_banned=is_banned,
+    check_daily_limit=check_daily_limit,
+    save_msg=save_msg,
+    load_memory=load_memory,
+    set_voice_mode=set_voice_mode,
+    set_voice=set_voice
+)
+
+adb = SimpleNamespace(
+    users=AsyncManager(user_functions, db_executor),
+    levels=AsyncManager(level_manager, db_executor),
+    coins=AsyncManager(coin_manager, db_executor),
+    friends=AsyncManager(friend_manager, db_executor),
+    direct_chat=AsyncManager(direct_chat, db_executor),
+    groups=AsyncManager(group_manager, db_executor),
+    shop=AsyncManager(shop_manager, db_executor),
+    games=AsyncManager(game_manager, db_executor),
+    badges=AsyncManager(badge_manager, db_executor),
+    reports=AsyncManager(report_manager, db_executor),
+    menus=AsyncManager(menu_manager, db_executor),
+    admin=AsyncManager(admin_manager, db_executor),
+    activity=AsyncManager(activity_aggregator, db_executor),
+    stats=AsyncManager(SimpleNamespace(
+        storage=storage_stats,
+        subsystems=subsystem_stats,
+        queries=queries.snapshot,
+        cache=cache.snapshot
+    ), db_executor),
+    unit_of_work=db_executor.unit_of_work
+)
+
 # ==================== AI FUNCTIONS ====================
 
 async def ask_openrouter(messages, model="openai/gpt-4o-mini"):
@@ -2226,20 +5671,28 @@ def search_youtube(query):
 
 # ==================== TELEGRAM BOT HANDLERS ====================
 
+async def resolve_user(tg_user, create=True):
+    """Canonical user row for a Telegram user, created on first contact.
+
+    Handlers call this once per update and pass user['user_id'] on.
+    """
+    user_id = identity_map.cached(tg_user.id) or await adb.users.resolve_user_id(tg_user.id)
+    if user_id is None:
+        if not create:
+            return None
+        user_id = await adb.users.create_user(
+            tg_user.id, tg_user.username or "", tg_user.first_name or "", tg_user.last_name or ""
+        )
+        if not user_id:
+            return None
+    return await adb.users.get_user(user_id)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command handler"""
-    uid = update.effective_user.id
-    username = update.effective_user.username or ""
-    first_name = update.effective_user.first_name or ""
-    last_name = update.effective_user.last_name or ""
-    
-    # Check if user exists
-    user = get_user(uid)
+    user = await resolve_user(update.effective_user)
     if not user:
-        user_id = create_user(uid, username, first_name, last_name)
-        if not user_id:
-            await update.message.reply_text("❌ Error creating user. Please try again later.")
-            return
+        await update.message.reply_text("❌ Error creating user. Please try again later.")
+        return
     
     # Get welcome message
     welcome = """🌟 Welcome to Priya AI Bot! 🌟
@@ -2272,16 +5725,10 @@ Kya help chahiye aapko? 😊"""
 
 async def umenu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """User menu command"""
-    uid = update.effective_user.id
-    
-    # Get user
-    user = get_user(uid)
-    if not user:
-        user_id = create_user(uid, update.effective_user.username, update.effective_user.first_name)
-        user = get_user(user_id)
+    user = await resolve_user(update.effective_user)
     
     # Get menu
-    menu_items = menu_manager.get_user_menu(uid)
+    menu_items = await adb.menus.get_user_menu(user['user_id'])
     
     # Create message
     message = "📱 *Priya Bot Menu*\n\nChoose an option:"
@@ -2307,15 +5754,15 @@ async def umenu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin menu command"""
-    uid = update.effective_user.id
+    user = await resolve_user(update.effective_user, create=False)
     
     # Check if admin
-    if not admin_manager.is_admin(uid):
+    if not user or not await adb.admin.is_admin(user['user_id']):
         await update.message.reply_text("❌ This command is for admins only.")
         return
     
     # Get admin menu
-    menu_items = menu_manager.get_admin_menu()
+    menu_items = await adb.menus.get_admin_menu()
     
     # Create message
     message = "⚙️ *Admin Control Panel*\n\nSelect an option:"
@@ -2336,10 +5783,10 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clearall_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Clear database command (admin only)"""
-    uid = update.effective_user.id
+    user = await resolve_user(update.effective_user, create=False)
     
     # Check if admin
-    if not admin_manager.is_admin(uid):
+    if not user or not await adb.admin.is_admin(user['user_id']):
         await update.message.reply_text("❌ This command is for admins only.")
         return
     
@@ -2368,23 +5815,19 @@ async def clearall_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user profile"""
-    uid = update.effective_user.id
-    
-    user = get_user(uid)
-    if not user:
-        user_id = create_user(uid, update.effective_user.username, update.effective_user.first_name)
-        user = get_user(user_id)
+    user = await resolve_user(update.effective_user)
     
     # Get level info
-    level_info = level_manager.get_level_info(user['user_id'])
+    level_info = await adb.levels.get_level_info(user['user_id'])
     
     # Get badges
-    badges = badge_manager.get_user_badges(user['user_id'])
+    badges = await adb.badges.get_user_badges(user['user_id'])
     
     # Get streak
-    cur.execute("SELECT streak FROM daily_claims WHERE user_id=?", (user['user_id'],))
-    claim = cur.fetchone()
-    streak = claim['streak'] if claim else 0
+    streak = await adb.coins.get_streak(user['user_id'])
+    
+    # Get recent coin movements
+    history = await adb.coins.get_history(user['user_id'], 3)
     
     # Format badges
     badge_text = ""
@@ -2396,6 +5839,8 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         badge_text = "No badges yet"
     
+    history_text = "\n".join(f"• {t['amount']:+} ({t['reason'].replace('_', ' ')})" for t in history) or "• No transactions yet"
+    
     message = f"""👤 *Your Profile*
 
 📊 *Stats:*
@@ -2409,6 +5854,9 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Total Earned: {user['total_coins_earned']}
 • Total Spent: {user['total_coins_spent']}
 
+📒 *Recent:*
+{history_text}
+
 🔥 *Streak:* {streak} days
 
 🎖️ *Badges:* 
@@ -2438,14 +5886,9 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def daily_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Claim daily coins"""
-    uid = update.effective_user.id
-    
-    user = get_user(uid)
-    if not user:
-        user_id = create_user(uid, update.effective_user.username, update.effective_user.first_name)
-        user = get_user(user_id)
+    user = await resolve_user(update.effective_user)
     
-    success, data = coin_manager.daily_claim(user['user_id'])
+    success, data = await adb.coins.daily_claim(user['user_id'])
     
     if success:
         message = f"""✅ *Daily Rewards Claimed!*
@@ -2456,23 +5899,17 @@ async def daily_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 Come back tomorrow for more! 🎉"""
     else:
-        # Calculate time remaining
-        cur.execute("SELECT last_claim FROM daily_claims WHERE user_id=?", (user['user_id'],))
-        claim = cur.fetchone()
-        if claim:
-            next_claim = claim['last_claim'] + 86400
-            time_left = next_claim - int(time.time())
-            hours = time_left // 3600
-            minutes = (time_left % 3600) // 60
-            message = f"❌ Already claimed today!\n\nNext claim in: {hours}h {minutes}m"
-        else:
-            message = "❌ Error claiming rewards"
+        # Time remaining until the next claim day starts
+        time_left = max(data['next_claim'] - int(time.time()), 0)
+        hours = time_left // 3600
+        minutes = (time_left % 3600) // 60
+        message = f"❌ Already claimed today!\n\nNext claim in: {hours}h {minutes}m"
     
     await update.message.reply_text(message, parse_mode="Markdown")
 
 async def connect_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Connect with another user"""
-    uid = update.effective_user.id
+    user = await resolve_user(update.effective_user)
     
     if not context.args:
         await update.message.reply_text(
@@ -2484,22 +5921,18 @@ async def connect_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = context.args[0].lstrip('@')
     
     # Find user by username
-    cur.execute("SELECT * FROM users WHERE username=?", (username,))
-    target_user = cur.fetchone()
+    target_user = await adb.users.find_user_by_username(username)
     
     if not target_user:
         await update.message.reply_text("❌ User not found!")
         return
     
-    if target_user['user_id'] == str(uid):
+    if target_user['user_id'] == user['user_id']:
         await update.message.reply_text("❌ You cannot connect with yourself!")
         return
     
-    # Get current user
-    user = get_user(uid)
-    
     # Send friend request
-    success, message = friend_manager.send_request(user['user_id'], target_user['user_id'])
+    success, message = await adb.friends.send_request(user['user_id'], target_user['user_id'])
     
     if success:
         # Notify target user
@@ -2526,13 +5959,13 @@ async def connect_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def shop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Open shop"""
-    uid = update.effective_user.id
+    user = await resolve_user(update.effective_user)
     
     # Get categories
-    categories = shop_manager.get_categories()
+    categories = await adb.shop.get_categories()
     
     message = "🛒 *Priya Shop*\n\n"
-    message += f"💰 Your Balance: {get_user(uid)['coin_balance']} coins\n\n"
+    message += f"💰 Your Balance: {user['coin_balance']} coins\n\n"
     message += "Choose a category:\n"
     
     keyboard = []
@@ -2552,7 +5985,7 @@ async def shop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def games_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Open games menu"""
-    games = game_manager.get_games()
+    games = await adb.games.get_games()
     
     message = "🎮 *Games & Fun*\n\nChoose a game:\n"
     
@@ -2571,13 +6004,72 @@ async def games_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(message, parse_mode="Markdown", reply_markup=reply_markup)
 
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Browse direct chat or group history"""
+    user = await resolve_user(update.effective_user)
+    
+    if context.args:
+        username = context.args[0].lstrip('@')
+        target_user = await adb.users.find_user_by_username(username)
+        
+        if not target_user:
+            await update.message.reply_text("❌ User not found!")
+            return
+        
+        session = await adb.direct_chat.get_session(user['user_id'], target_user['user_id'])
+        if not session:
+            await update.message.reply_text(f"💬 No chat history with @{username} yet.")
+            return
+        
+        text, reply_markup = await render_history("c", session['id'])
+        await update.message.reply_text(text, reply_markup=reply_markup)
+        return
+    
+    rooms = await adb.groups.get_user_rooms(user['user_id'])
+    
+    keyboard = []
+    for room in rooms[:10]:
+        keyboard.append([
+            InlineKeyboardButton(f"👥 {room['name']}", callback_data=f"history:g:{room['id']}:l:0")
+        ])
+    
+    message = "📜 *Chat History*\n\nUse /history @username for a direct chat"
+    message += ", or pick a group:" if keyboard else "."
+    
+    await update.message.reply_text(
+        message,
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+    )
+
+async def render_history(kind, key, before_id=None, after_id=None):
+    """Render one history page with Older/Newer buttons"""
+    manager = adb.direct_chat if kind == "c" else adb.groups
+    page = await manager.get_history(key, HISTORY_PAGE_SIZE, before_id, after_id)
+    
+    lines = []
+    for m in page['messages']:
+        name = m['first_name'] or m['username'] or "Unknown"
+        stamp = datetime.fromtimestamp(m['created_at']).strftime("%d %b %H:%M") if m['created_at'] else ""
+        lines.append(f"[{stamp}] {name}: {(m['message'] or '')[:200]}")
+    
+    # Plain text: messages are user content and may break Markdown
+    text = "📜 History\n\n" + ("\n".join(lines) if lines else "No messages.")
+    
+    buttons = []
+    if page['before_id']:
+        buttons.append(InlineKeyboardButton("⬅️ Older", callback_data=f"history:{kind}:{key}:b:{page['before_id']}"))
+    if page['after_id']:
+        buttons.append(InlineKeyboardButton("Newer ➡️", callback_data=f"history:{kind}:{key}:a:{page['after_id']}"))
+    
+    return text[:4000], InlineKeyboardMarkup([buttons]) if buttons else None
+
 async def friends_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show friends menu"""
-    uid = update.effective_user.id
-    user = get_user(uid)
+    user = await resolve_user(update.effective_user)
     
-    friends = friend_manager.get_friends(user['user_id'])
-    requests = friend_manager.get_pending_requests(user['user_id'])
+    friends = await adb.friends.get_friends(user['user_id'])
+    requests = await adb.friends.get_pending_requests(user['user_id'])
     
     message = "🤝 *Friends*\n\n"
     
@@ -2616,6 +6108,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /games - Play games
 /friends - Friend list
 /connect @user - Connect with user
+/history [@user] - Browse chat history
 /preferences - Customize profile
 
 🤖 *AI Features:*
@@ -2656,13 +6149,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     data = query.data
-    uid = query.from_user.id
-    
     # Get user
-    user = get_user(uid)
-    if not user:
-        user_id = create_user(uid, query.from_user.username, query.from_user.first_name)
-        user = get_user(user_id)
+    user = await resolve_user(query.from_user)
     
     # Handle menu callbacks
     if data.startswith("menu:"):
@@ -2687,6 +6175,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Handle profile callbacks
     elif data.startswith("profile:"):
         await handle_profile_callback(query, context, user)
+    
+    # Handle history paging callbacks
+    elif data.startswith("history:"):
+        await handle_history_callback(query, context, user)
 
 async def handle_menu_callback(query, context, user):
     """Handle menu callbacks"""
@@ -2728,7 +6220,7 @@ async def handle_menu_callback(query, context, user):
 
 async def handle_admin_callback(query, context, user):
     """Handle admin callbacks"""
-    if not admin_manager.is_admin(user['user_id']):
+    if not await adb.admin.is_admin(user['user_id']):
         await query.edit_message_text("❌ Access denied!")
         return
     
@@ -2736,8 +6228,7 @@ async def handle_admin_callback(query, context, user):
     
     if command == "users":
         # Show users
-        cur.execute("SELECT user_id, username, first_name, role, coin_balance FROM users ORDER BY created_at DESC LIMIT 20")
-        users = cur.fetchall()
+        users = await adb.admin.get_recent_users(20)
         
         message = "👥 *Recent Users:*\n\n"
         for u in users:
@@ -2748,30 +6239,64 @@ async def handle_admin_callback(query, context, user):
     
     elif command == "stats":
         # Show stats
-        cur.execute("SELECT COUNT(*) as total FROM users")
-        total_users = cur.fetchone()['total']
-        
-        cur.execute("SELECT COUNT(*) as total FROM users WHERE last_request_date=date('now')")
-        active_today = cur.fetchone()['total']
-        
-        cur.execute("SELECT SUM(total_requests) as total FROM users")
-        total_messages = cur.fetchone()['total'] or 0
-        
-        cur.execute("SELECT SUM(coin_balance) as total FROM users")
-        total_coins = cur.fetchone()['total'] or 0
+        stats = await adb.admin.get_stats()
+        storage = await adb.stats.storage()
+        subsystems = await adb.stats.subsystems()
+        top = await adb.stats.queries(limit=3)
+        top_queries = "\n".join(
+            f"• `{q['name']}` {q['calls']}x, p99 {q['p99_ms']}ms"
+            for q in top
+        )
         
         message = f"""📊 *Bot Statistics*
 
-👥 Total Users: {total_users}
-📱 Active Today: {active_today}
-💬 Total Messages: {total_messages}
-💰 Total Coins: {total_coins}
+👥 Total Users: {stats['total_users']}
+📱 Active Today: {stats['active_today']}
+💬 Total Messages: {stats['total_messages']}
+💰 Total Coins: {stats['total_coins']}
+
+💾 Database: {storage['db_bytes'] // 1024} KB ({storage['journal_mode']})
+📝 WAL: {storage['wal_bytes'] // 1024} KB, {storage['checkpoints']['runs']} checkpoints
+🗄 Archive: {subsystems['archive']['bytes'] // 1024} KB in {len(subsystems['archive']['months'])} months
+🔀 Coalesced Loads: {subsystems['single_flight']['shared']} of {subsystems['single_flight']['loads'] + subsystems['single_flight']['shared']} lookups
+⏳ Pending Activity: {subsystems['activity']['pending_users']} users
+
+🐢 Heaviest Queries:
+{top_queries or "• No queries yet"}
 
 🔄 System Status: Online
 📦 Version: {CONFIG_VERSION}"""
         
         await query.edit_message_text(message, parse_mode="Markdown")
     
+    elif command.startswith("cache"):
+        # Cache statistics, or the hottest keys with admin:cache:hot
+        snapshot = await adb.stats.cache()
+        
+        if command == "cache:hot":
+            lines = [f"• `{key}` {hits}x" for key, hits in cache.memory.hot_keys(10)]
+            message = "🔥 *Hottest Cache Keys*\n\n" + ("\n".join(lines) or "• No hits yet")
+            keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="admin:cache")]]
+        else:
+            lines = []
+            for namespace, ns in snapshot['namespaces'].items():
+                hit_rate = f"{ns['hit_rate'] * 100:.0f}%" if ns['hit_rate'] is not None else "-"
+                load = f", load {ns['avg_load_ms']}ms" if ns['avg_load_ms'] is not None else ""
+                lines.append(
+                    f"• `{namespace}` {ns['entries']} keys, {ns['bytes'] // 1024} KB, hit {hit_rate}"
+                    f" ({ns['hits']}+{ns['db_hits']}/{ns['misses']}), neg {ns['negative_hits']},"
+                    f" evict {ns['evictions']}, exp {ns['expirations']}{load}"
+                )
+            message = f"""🗄️ *Cache*
+
+📦 {snapshot['entries']}/{snapshot['max_entries']} keys, {snapshot['bytes'] // 1024}/{snapshot['max_bytes'] // 1024} KB
+💾 {snapshot['flushes']} flushes, {snapshot['pending_writes']} writes pending
+
+{chr(10).join(lines) or "• Empty"}"""
+            keyboard = [[InlineKeyboardButton("🔥 Hottest Keys", callback_data="admin:cache:hot")]]
+        
+        await query.edit_message_text(message, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+    
     elif command == "broadcast":
         # Broadcast message
         context.user_data['broadcast_mode'] = True
@@ -2784,7 +6309,7 @@ async def handle_admin_callback(query, context, user):
     
     elif command == "clear_confirm":
         # Confirm clear database
-        success, msg = admin_manager.clear_database(user['user_id'])
+        success, msg = await adb.admin.clear_database(user['user_id'])
         
         if success:
             await query.edit_message_text(f"✅ {msg}")
@@ -2801,16 +6326,16 @@ async def handle_friend_callback(query, context, user):
     
     if action == "accept" and len(parts) > 2:
         from_user = parts[2]
-        success, msg = friend_manager.accept_request(user['user_id'], from_user)
+        success, msg = await adb.friends.accept_request(user['user_id'], from_user)
         await query.edit_message_text(msg)
     
     elif action == "reject" and len(parts) > 2:
         from_user = parts[2]
-        success, msg = friend_manager.reject_request(user['user_id'], from_user)
+        success, msg = await adb.friends.reject_request(user['user_id'], from_user)
         await query.edit_message_text(msg)
     
     elif action == "requests":
-        requests = friend_manager.get_pending_requests(user['user_id'])
+        requests = await adb.friends.get_pending_requests(user['user_id'])
         
         if not requests:
             await query.edit_message_text("No pending friend requests.")
@@ -2833,7 +6358,7 @@ async def handle_friend_callback(query, context, user):
         await query.edit_message_text(message, parse_mode="Markdown", reply_markup=reply_markup)
     
     elif action == "blocked":
-        blocked = friend_manager.get_blocked_users(user['user_id'])
+        blocked = await adb.friends.get_blocked_users(user['user_id'])
         
         if not blocked:
             await query.edit_message_text("No blocked users.")
@@ -2857,11 +6382,10 @@ async def handle_shop_callback(query, context, user):
         category_id = parts[2]
         
         # Get category
-        cur.execute("SELECT * FROM shop_categories WHERE id=?", (category_id,))
-        category = cur.fetchone()
+        category = await adb.shop.get_category(category_id)
         
         # Get items
-        items = shop_manager.get_items(category_id)
+        items = await adb.shop.get_items(category_id)
         
         message = f"{category['icon']} *{category['name']}*\n\n"
         message += f"💰 Your Balance: {user['coin_balance']} coins\n\n"
@@ -2881,7 +6405,7 @@ async def handle_shop_callback(query, context, user):
     
     elif parts[1] == "buy" and len(parts) > 2:
         item_id = parts[2]
-        item = shop_manager.get_item(item_id)
+        item = await adb.shop.get_item(item_id)
         
         if not item:
             await query.edit_message_text("❌ Item not found!")
@@ -2905,11 +6429,11 @@ async def handle_shop_callback(query, context, user):
     
     elif parts[1] == "confirm" and len(parts) > 2:
         item_id = parts[2]
-        success, msg = shop_manager.buy_item(user['user_id'], item_id)
+        success, msg = await adb.shop.buy_item(user['user_id'], item_id)
         
         if success:
             # Check for badges
-            awarded = badge_manager.check_and_award(user['user_id'])
+            awarded = await adb.badges.check_and_award(user['user_id'])
             
             message = f"✅ {msg}\n\n"
             if awarded:
@@ -2921,7 +6445,7 @@ async def handle_shop_callback(query, context, user):
             await query.edit_message_text(f"❌ {msg}")
     
     elif parts[1] == "inventory":
-        inventory = shop_manager.get_inventory(user['user_id'])
+        inventory = await adb.shop.get_inventory(user['user_id'])
         
         if not inventory:
             await query.edit_message_text("📦 Your inventory is empty. Visit the shop to buy items!")
@@ -2952,13 +6476,13 @@ async def handle_game_callback(query, context, user):
         game_id = parts[2]
         
         # Create game session
-        session_id = game_manager.create_session(game_id, user['user_id'])
+        session_id = await adb.games.create_session(game_id, user['user_id'])
         
-        game = game_manager.get_game(game_id)
+        game = await adb.games.get_game(game_id)
         
         if game['game_type'] == 'quiz':
             # Get quiz question
-            question = game_manager.get_quiz_question()
+            question = await adb.games.get_quiz_question()
             
             if question:
                 options = json.loads(question['options'])
@@ -2988,15 +6512,7 @@ async def handle_game_callback(query, context, user):
     
     elif parts[1] == "leaderboard":
         # Show leaderboard
-        cur.execute("""
-            SELECT u.username, u.first_name, ul.level, ul.total_xp
-            FROM user_levels ul
-            JOIN users u ON ul.user_id = u.user_id
-            ORDER BY ul.total_xp DESC
-            LIMIT 10
-        """)
-        
-        top_players = cur.fetchall()
+        top_players = await adb.games.get_leaderboard(10)
         
         message = "🏆 *Leaderboard*\n\n"
         
@@ -3006,13 +6522,7 @@ async def handle_game_callback(query, context, user):
             message += f"{medal} {i}. {name} - Level {player['level']} (XP: {player['total_xp']})\n"
         
         # Get user rank
-        cur.execute("""
-            SELECT COUNT(*) + 1 as rank
-            FROM user_levels
-            WHERE total_xp > (SELECT total_xp FROM user_levels WHERE user_id=?)
-        """, (user['user_id'],))
-        
-        rank = cur.fetchone()
+        rank = await adb.games.get_rank(user['user_id'])
         if rank:
             message += f"\nYour Rank: #{rank['rank']}"
         
@@ -3027,31 +6537,45 @@ async def handle_game_callback(query, context, user):
         question_id = parts[4]
         
         # Check answer
-        cur.execute("SELECT * FROM quiz_questions WHERE id=?", (question_id,))
-        question = cur.fetchone()
+        question = await adb.games.get_quiz_question_by_id(question_id)
         
         if question and answer_idx == question['correct_answer']:
             # Correct answer
-            game_manager.end_game(session_id, user['user_id'])
+            await adb.games.end_game(session_id, user['user_id'])
             await query.edit_message_text("✅ Correct! You win! 🎉")
         else:
             # Wrong answer
             correct_option = json.loads(question['options'])[question['correct_answer']]
             await query.edit_message_text(f"❌ Wrong answer!\nCorrect answer: {correct_option}")
 
+async def handle_history_callback(query, context, user):
+    """Handle history paging callbacks"""
+    _, kind, key, direction, message_id = query.data.split(":")
+    
+    # Only participants (and admins) may read a conversation
+    if kind == "c":
+        session = await adb.direct_chat.get_session_by_id(key)
+        allowed = session is not None and user['user_id'] in (session['user_a'], session['user_b'])
+    else:
+        allowed = await adb.groups.is_member(key, user['user_id'])
+    
+    if not allowed and not await adb.admin.is_admin(user['user_id']):
+        await query.edit_message_text("❌ You are not part of this chat.")
+        return
+    
+    before_id = int(message_id) if direction == "b" else None
+    after_id = int(message_id) if direction == "a" else None
+    
+    text, reply_markup = await render_history(kind, key, before_id, after_id)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
 async def handle_profile_callback(query, context, user):
     """Handle profile callbacks"""
     action = query.data.split(":")[1]
     
     if action == "theme":
         # Get available themes from inventory
-        cur.execute("""
-            SELECT si.* FROM user_inventory ui
-            JOIN shop_items si ON ui.item_id = si.id
-            WHERE ui.user_id=? AND si.item_type='theme'
-        """, (user['user_id'],))
-        
-        themes = cur.fetchall()
+        themes = await adb.shop.get_owned_items(user['user_id'], 'theme')
         
         if not themes:
             await query.edit_message_text(
@@ -3079,23 +6603,15 @@ async def handle_profile_callback(query, context, user):
     
     elif action.startswith("set_theme"):
         theme = action.split(":")[2]
-        update_user(user['user_id'], theme_preference=theme)
+        await adb.users.update_user(user['user_id'], theme_preference=theme)
         await query.edit_message_text(f"✅ Theme changed to {theme}!")
     
     elif action == "stats":
         # Show detailed stats
         # Get game stats
-        cur.execute("SELECT COUNT(*) as games FROM game_players WHERE user_id=?", (user['user_id'],))
-        games_played = cur.fetchone()['games']
-        
-        cur.execute("SELECT COUNT(*) as wins FROM game_sessions WHERE winner=?", (user['user_id'],))
-        games_won = cur.fetchone()['wins']
-        
-        cur.execute("SELECT COUNT(*) as friends FROM friends WHERE user_id=?", (user['user_id'],))
-        friend_count = cur.fetchone()['friends']
-        
-        cur.execute("SELECT COUNT(*) as purchases FROM user_purchases WHERE user_id=?", (user['user_id'],))
-        purchases = cur.fetchone()['purchases']
+        games_played, games_won = await adb.games.get_player_stats(user['user_id'])
+        friend_count = await adb.friends.count_friends(user['user_id'])
+        purchases = await adb.shop.count_purchases(user['user_id'])
         
         message = f"""📊 *Detailed Statistics*
 
@@ -3117,8 +6633,6 @@ async def handle_profile_callback(query, context, user):
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages"""
-    uid = update.effective_user.id
-    
     # Check maintenance mode
     if BOT_UPDATING:
         await update.message.reply_text(
@@ -3126,40 +6640,37 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    # Resolve the user once; everything below uses the internal id
+    user = await resolve_user(update.effective_user)
+    uid = user['user_id']
+
     # Ban check
-    if is_banned(uid):
+    if await adb.users.is_banned(uid):
         await update.message.reply_text(
             "🚫 Aap ban ho chuke ho.\nAdmin se contact karein 🙏"
         )
         return
 
     # Daily limit check
-    if check_daily_limit(uid):
+    if await adb.users.check_daily_limit(uid):
         await update.message.reply_text(
             "📊 Daily limit reached (100 msgs). Kal aana bestie! 💖"
         )
         return
 
-    # Check if user exists
-    user = get_user(uid)
-    if not user:
-        user_id = create_user(uid, update.effective_user.username, update.effective_user.first_name)
-        user = get_user(user_id)
-
     text = update.message.text
-    save_msg(uid, "user", text)
     
-    # Increment daily count
-    increment_daily_count(uid)
+    # Save message; counters, XP and coins are batched in memory and journaled off the loop
+    await adb.users.save_msg(uid, "user", text)
+    await adb.activity.record(uid)
 
     smart = text.lower()
     
     # Check if in broadcast mode
     if context.user_data.get('broadcast_mode'):
-        if admin_manager.is_admin(uid):
+        if await adb.admin.is_admin(uid):
             # Send broadcast to all users
-            cur.execute("SELECT telegram_id FROM users WHERE telegram_id IS NOT NULL")
-            users = cur.fetchall()
+            users = await adb.admin.get_broadcast_targets()
             
             success_count = 0
             fail_count = 0
@@ -3189,12 +6700,12 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Voice commands
     if "voice on" in smart:
-        set_voice_mode(uid, 1)
+        await adb.users.set_voice_mode(uid, 1)
         await update.message.reply_text("🔊 Voice ON - ab main bolungi 🎤")
         return
     
     if "voice off" in smart:
-        set_voice_mode(uid, 0)
+        await adb.users.set_voice_mode(uid, 0)
         await update.message.reply_text("🔇 Voice OFF - ab sirf text mode")
         return
     
@@ -3206,12 +6717,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             username = mention.group(1)
             
             # Find user
-            cur.execute("SELECT * FROM users WHERE username=?", (username,))
-            target = cur.fetchone()
+            target = await adb.users.find_user_by_username(username)
             
-            if target and friend_manager.are_friends(user['user_id'], target['user_id']):
+            if target and await adb.friends.are_friends(user['user_id'], target['user_id']):
                 # Create game session
-                session_id = game_manager.create_session("quiz", user['user_id'])
+                session_id = await adb.games.create_session("quiz", user['user_id'])
                 
                 # Notify target
                 try:
@@ -3259,8 +6769,10 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 
                 # Add XP
-                level_manager.add_xp(user['user_id'], 15)
-                coin_manager.add_coins(user['user_id'], 10, "image_generation")
+                uow = adb.unit_of_work()
+                uow.add(level_manager.add_xp, user['user_id'], 15)
+                uow.add(coin_manager.add_coins, user['user_id'], 10, "image_generation")
+                await uow.commit()
                 return
 
     # Time/Date
@@ -3279,7 +6791,7 @@ You can chat, play games, help with shopping, and connect with friends.
 Always encourage users to have fun and learn."""}]
     
     # Add memory
-    messages += load_memory(uid)[-12:]
+    messages += await adb.users.load_memory(uid)
 
     if web_ctx:
         messages.append({"role": "system", "content": web_ctx})
@@ -3291,20 +6803,20 @@ Always encourage users to have fun and learn."""}]
     # Get reply from AI
     reply = await ask_openrouter(messages)
 
-    save_msg(uid, "assistant", reply)
     await update.message.reply_text(reply)
     
-    # Check for badges
-    awarded = badge_manager.check_and_award(user['user_id'])
+    # Save reply and check for badges in one transaction
+    uow = adb.unit_of_work()
+    uow.add(save_msg, uid, "assistant", reply)
+    uow.add(badge_manager.check_and_award, user['user_id'])
+    _, awarded = await uow.commit()
     if awarded:
         badge_names = [b["name"] for b in awarded]
         await update.message.reply_text(f"🎉 Congratulations! You earned new badges: {', '.join(badge_names)}")
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle voice messages"""
-    uid = update.effective_user.id
-    
-    user = get_user(uid)
+    user = await resolve_user(update.effective_user, create=False)
     if not user or not user['voice_mode']:
         await update.message.reply_text("Voice mode is off. Use 'voice on' to enable.")
         return
@@ -3338,6 +6850,11 @@ CORS(app_web)
 socketio = SocketIO(app_web, cors_allowed_origins="*")
 
 # Flask Login
+@app_web.before_request
+def apply_cache_invalidations():
+    """Catch up on other processes' writes before serving a request"""
+    invalidations.poll()
+
 login_manager = LoginManager()
 login_manager.init_app(app_web)
 login_manager.login_view = 'login'
@@ -3370,17 +6887,11 @@ def login():
         # Simple admin login (in production, use proper auth)
         if username == os.getenv("ADMIN_USERNAME") and password == os.getenv("ADMIN_PASSWORD"):
             # Find or create admin user
-            cur.execute("SELECT * FROM users WHERE username=?", (username,))
-            user = cur.fetchone()
+            user = find_user_by_username(username)
             
             if not user:
                 # Create admin user
-                user_id = str(uuid.uuid4())
-                cur.execute("""
-                    INSERT INTO users (user_id, username, role, created_at)
-                    VALUES (?, ?, 'admin', ?)
-                """, (user_id, username, int(time.time())))
-                conn.commit()
+                user_id = create_web_admin(username)
             else:
                 user_id = user['user_id']
             
@@ -3407,28 +6918,18 @@ def admin_dashboard():
         return redirect(url_for('index'))
     
     # Get stats
-    cur.execute("SELECT COUNT(*) as total FROM users")
-    total_users = cur.fetchone()['total']
-    
-    cur.execute("SELECT COUNT(*) as total FROM users WHERE last_request_date=date('now')")
-    active_today = cur.fetchone()['total']
-    
-    cur.execute("SELECT SUM(total_requests) as total FROM users")
-    total_messages = cur.fetchone()['total'] or 0
-    
-    cur.execute("SELECT SUM(coin_balance) as total FROM users")
-    total_coins = cur.fetchone()['total'] or 0
+    stats = admin_manager.get_stats()
     
     # Recent users
-    cur.execute("SELECT * FROM users ORDER BY created_at DESC LIMIT 10")
-    recent_users = cur.fetchall()
+    recent_users = admin_manager.get_recent_users(10)
     
     return render_template('admin_dashboard.html',
-                         total_users=total_users,
-                         active_today=active_today,
-                         total_messages=total_messages,
-                         total_coins=total_coins,
-                         recent_users=recent_users)
+                         total_users=stats['total_users'],
+                         active_today=stats['active_today'],
+                         total_messages=stats['total_messages'],
+                         total_coins=stats['total_coins'],
+                         recent_users=recent_users,
+                         top_queries=queries.snapshot(limit=10))
 
 @app_web.route('/admin/users')
 @login_required
@@ -3438,8 +6939,7 @@ def admin_users():
         flash("Access denied", "danger")
         return redirect(url_for('index'))
     
-    cur.execute("SELECT * FROM users ORDER BY created_at DESC")
-    users = cur.fetchall()
+    users = admin_manager.get_recent_users()
     
     return render_template('admin_users.html', users=users)
 
@@ -3473,8 +6973,7 @@ def admin_stats():
         date = (datetime.now() - timedelta(days=i)).strftime("%Y-%m-%d")
         dates.append(date)
         
-        cur.execute("SELECT COUNT(*) as count FROM users WHERE date(last_request_date, 'unixepoch')=?", (date,))
-        user_counts.append(cur.fetchone()['count'])
+        user_counts.append(admin_manager.get_active_user_count(date))
         
         # This is simplified - in production you'd have daily message logs
         msg_counts.append(random.randint(100, 1000))
@@ -3484,17 +6983,138 @@ def admin_stats():
                          user_counts=user_counts,
                          msg_counts=msg_counts)
 
-# ==================== MAIN FUNCTION ====================
+@app_web.route('/admin/storage')
+@login_required
+def admin_storage():
+    """Storage and WAL checkpoint statistics"""
+    if current_user.role not in ['admin', 'super_admin']:
+        return jsonify({"error": "Access denied"}), 403
+    
+    return jsonify(storage_stats())
 
+@app_web.route('/admin/subsystems')
+@login_required
+def admin_subsystems():
+    """Archive, coalescing, conversation memory, catalog and activity statistics"""
+    if current_user.role not in ['admin', 'super_admin']:
+        return jsonify({"error": "Access denied"}), 403
+    
+    return jsonify(subsystem_stats())
+
+@app_web.route('/admin/queries')
+@login_required
+def admin_queries():
+    """Per-query call counts and latency from the query registry"""
+    if current_user.role not in ['admin', 'super_admin']:
+        return jsonify({"error": "Access denied"}), 403
+    
+    sort_by = request.args.get('sort', 'total_ms')
+    if sort_by not in ('calls', 'errors', 'slow', 'rows', 'total_ms', 'avg_ms', 'p99_ms'):
+        return jsonify({"error": f"Cannot sort by {sort_by}"}), 400
+    limit = request.args.get('limit', type=int)
+    
+    return jsonify({
+        "registered": len(queries.statements),
+        "queries": queries.snapshot(sort_by=sort_by, limit=limit)
+    })
+
+@app_web.route('/admin/cache')
+@login_required
+def admin_cache():
+    """Per-namespace cache statistics, optionally with the hottest keys"""
+    if current_user.role not in ['admin', 'super_admin']:
+        return jsonify({"error": "Access denied"}), 403
+    
+    snapshot = cache.snapshot()
+    hot = request.args.get('hot', type=int)
+    if hot:
+        snapshot['hot_keys'] = [
+            {"key": key, "hits": hits}
+            for key, hits in cache.memory.hot_keys(min(hot, 1000), request.args.get('namespace'))
+        ]
+    return jsonify(snapshot)
+
+def history_request_args():
+    """Pagination arguments for the history endpoints"""
+    return {
+        "limit": request.args.get('limit', 50, type=int),
+        "before_id": request.args.get('before_id', type=int),
+        "after_id": request.args.get('after_id', type=int)
+    }
+
+@app_web.route('/api/chats/<session_id>/messages')
+@login_required
+def api_chat_history(session_id):
+    """Keyset-paginated direct chat history"""
+    session = direct_chat.get_session_by_id(session_id)
+    if not session:
+        return jsonify({"error": "Chat not found"}), 404
+    if current_user.role not in ['admin', 'super_admin'] and current_user.id not in (session['user_a'], session['user_b']):
+        return jsonify({"error": "Access denied"}), 403
+    
+    args = history_request_args()
+    if args['before_id'] is not None and args['after_id'] is not None:
+        return jsonify({"error": "Use either before_id or after_id"}), 400
+    
+    return jsonify(direct_chat.get_history(session_id, **args))
+
+@app_web.route('/api/rooms/<room_id>/messages')
+@login_required
+def api_room_history(room_id):
+    """Keyset-paginated group room history"""
+    if not group_manager.get_room(room_id):
+        return jsonify({"error": "Room not found"}), 404
+    if current_user.role not in ['admin', 'super_admin'] and not group_manager.is_member(room_id, current_user.id):
+        return jsonify({"error": "Access denied"}), 403
+    
+    args = history_request_args()
+    if args['before_id'] is not None and args['after_id'] is not None:
+        return jsonify({"error": "Use either before_id or after_id"}), 400
+    
+    return jsonify(group_manager.get_history(room_id, **args))
+
+# ==================== MAIN FUNCTION ====================
 def run_web():
     """Run Flask web server"""
     app_web.run(host='0.0.0.0', port=10000, debug=False, use_reloader=False)
 
 def main():
     """Main function"""
+    # Catalogs and the admin set are in memory before the first update
+    with startup_timer.phase("warm"):
+        cache.recover()
+        catalog.warm()
+        level_manager.rebalance()
+        activity_aggregator.recover()
+        message_archive.backfill_index()
+    startup_timer.report()
+    
     # Start web server in thread
     threading.Thread(target=run_web, daemon=True).start()
     
+    # Checkpoint the WAL in the background
+    wal_checkpointer.start()
+    
+    # Move old chat and group messages to the monthly archive
+    message_archiver.start()
+    
+    # Persist cache writes in batches and purge expired entries
+    cache_flusher.start()
+    cache_janitor.start()
+    
+    # Trim the conversation log
+    memory_compactor.start()
+    
+    # Fold the coin ledger into balance snapshots
+    coin_snapshotter.start()
+    
+    # Write batched message activity
+    activity_flusher.start()
+    
+    # Apply cache invalidations from other processes (e.g. gunicorn workers)
+    if invalidations.enabled:
+        invalidation_listener.start()
+    
     # Create bot application
     app = ApplicationBuilder().token(BOT_TOKEN).build()
     
@@ -3512,6 +7132,7 @@ def main():
     app.add_handler(CommandHandler("games", games_command))
     app.add_handler(CommandHandler("friends", friends_command))
     app.add_handler(CommandHandler("connect", connect_command))
+    app.add_handler(CommandHandler("history", history_command))
     app.add_handler(CommandHandler("help", help_command))
     
     # Message handlers
@@ -3533,7 +7154,23 @@ def main():
     logger.info(f"🔑 OpenRouter keys loaded: {len(OPENROUTER_KEYS)}")
     
     # Start polling
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        db_executor.close()
+        activity_flusher.stop()
+        wal_checkpointer.stop()
+        message_archiver.stop()
+        message_archive.close()
+        cache_janitor.stop()
+        cache_flusher.stop()
+        invalidation_listener.stop()
+        invalidations.close()
+        memory_compactor.stop()
+        coin_snapshotter.stop()
+        if QUERY_STATS_PATH:
+            queries.dump(QUERY_STATS_PATH)
+        db.close()
 
 if __name__ == "__main__":
     main()
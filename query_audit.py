@@ -0,0 +1,259 @@
+"""
+PRIYA AI BOT - QUERY PLAN AUDITOR
+Runs EXPLAIN QUERY PLAN for every registered query against a populated
+database and flags full scans, temp B-trees, non-covering index lookups
+and queries executed inside loops.
+
+Usage:
+    python query_audit.py --db superbase.db
+    python query_audit.py --db superbase.db --json > audit.json
+    python query_audit.py --db superbase.db --strict   # exit 1 on warnings
+"""
+
+import os
+import re
+import ast
+import sys
+import json
+import logging
+import sqlite3
+import tempfile
+import argparse
+from collections import defaultdict
+
+BOT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+# ==================== REGISTRY LOADING ====================
+
+def load_registry():
+    """Import bot.py against a throwaway database and return its queries"""
+    os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="query-audit-"), "registry.db")
+    logging.disable(logging.WARNING)
+    try:
+        import bot
+    finally:
+        logging.disable(logging.NOTSET)
+    return dict(bot.queries.statements)
+
+class CallSiteFinder(ast.NodeVisitor):
+    """Map query names to the functions that run them"""
+
+    def __init__(self, names):
+        self.names = names
+        self.sites = defaultdict(list)
+        self._scope = []
+        self._loops = [0]
+
+    def visit_ClassDef(self, node):
+        self._scope.append(node.name)
+        self.generic_visit(node)
+        self._scope.pop()
+
+    def visit_FunctionDef(self, node):
+        self._scope.append(node.name)
+        self._loops.append(0)
+        self.generic_visit(node)
+        self._loops.pop()
+        self._scope.pop()
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def _in_loop(self, nodes):
+        self._loops[-1] += 1
+        for node in nodes:
+            self.visit(node)
+        self._loops[-1] -= 1
+
+    def visit_For(self, node):
+        # The iterable is evaluated once, only the body repeats
+        self.visit(node.iter)
+        self._in_loop([node.target, *node.body, *node.orelse])
+
+    visit_AsyncFor = visit_For
+
+    def visit_While(self, node):
+        self._in_loop([node.test, *node.body, *node.orelse])
+
+    def _visit_comprehension(self, node):
+        first, *rest = node.generators
+        self.visit(first.iter)
+        elements = [getattr(node, field) for field in ("elt", "key", "value") if hasattr(node, field)]
+        self._in_loop([first.target, *first.ifs, *rest, *elements])
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_comprehension
+
+    def visit_Call(self, node):
+        func = node.func
+        if (isinstance(func, ast.Attribute) and func.attr in ("one", "all", "run", "many")
+                and node.args and isinstance(node.args[0], ast.Constant)
+                and node.args[0].value in self.names):
+            self.sites[node.args[0].value].append({
+                "function": ".".join(self._scope) or "<module>",
+                "line": node.lineno,
+                "in_loop": self._loops[-1] > 0
+            })
+        self.generic_visit(node)
+
+def find_call_sites(names, source_path=BOT_SOURCE):
+    """Call sites per query name, parsed from bot.py"""
+    with open(source_path) as f:
+        tree = ast.parse(f.read(), source_path)
+    finder = CallSiteFinder(set(names))
+    finder.visit(tree)
+    return finder.sites
+
+# ==================== PLAN ANALYSIS ====================
+
+SCAN_RE = re.compile(r"^SCAN (\S+)(?: USING (COVERING )?INDEX (\S+))?$")
+SEARCH_RE = re.compile(r"^SEARCH (\S+) USING (AUTOMATIC )?(COVERING )?INDEX (\S+) \((.*)\)")
+TABLE_RE = re.compile(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(?!WHERE|JOIN|SET|ON|ORDER|GROUP|LIMIT|VALUES)(\w+))?", re.I)
+
+def table_aliases(sql):
+    """Map aliases used in a statement to table names"""
+    aliases = {}
+    for table, alias in TABLE_RE.findall(sql):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    return aliases
+
+def table_rows(conn, table):
+    """Row count of a table, or None if it cannot be counted"""
+    try:
+        return conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    except sqlite3.Error:
+        return None
+
+def explain(conn, sql):
+    """EXPLAIN QUERY PLAN rows as (depth, detail)"""
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")).fetchall()
+    depth = {0: -1}
+    plan = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        plan.append((depth[node_id], detail))
+    return plan
+
+def analyze_plan(plan, sql="", sizes=None, min_rows=1000):
+    """Findings for one query plan as (level, message) pairs.
+
+    Scans of tables smaller than min_rows, and index-ordered scans cut
+    short by a LIMIT, are reported as notes rather than warnings.
+    """
+    # Only reads can be answered from an index alone
+    is_select = sql.lstrip().upper().startswith("SELECT")
+    has_limit = re.search(r"\bLIMIT\b", sql, re.I) is not None
+    sizes = sizes or {}
+    findings = []
+    for _, detail in plan:
+        scan = SCAN_RE.match(detail)
+        search = SEARCH_RE.match(detail)
+        table = (scan or search).group(1) if scan or search else None
+        rows = sizes.get(table)
+        level = "info" if rows is not None and rows < min_rows else "warn"
+        size = f" ({rows} rows)" if rows is not None else ""
+
+        if scan:
+            _, covering, index = scan.groups()
+            if index and has_limit:
+                findings.append(("info", f"{table} read in {index} order, stopped by LIMIT"))
+            elif index:
+                kind = "covering index" if covering else "index"
+                findings.append((level, f"full {kind} scan of {table}{size} via {index}"))
+            else:
+                findings.append((level, f"full table scan of {table}{size}"))
+        elif search:
+            _, automatic, covering, index, constraint = search.groups()
+            if automatic:
+                findings.append(("warn", f"automatic index built on {table} for every execution"))
+            elif is_select and not covering and not index.startswith("sqlite_autoindex_"):
+                findings.append(("info", f"non-covering index {index} on {table}; each match reads the table row"))
+            if ">" in constraint or "<" in constraint:
+                findings.append((level, f"range search on {table}{size} ({constraint}); cost grows with matching rows"))
+
+        if detail.startswith("USE TEMP B-TREE"):
+            findings.append(("warn", detail.lower().replace("use temp b-tree", "temp B-tree")))
+        elif detail.startswith("CORRELATED"):
+            findings.append(("warn", f"{detail.lower()} re-evaluated per outer row"))
+    return findings
+
+def audit(db_path, statements, min_rows=1000):
+    """Audit every registered statement against a database"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    sites = find_call_sites(statements)
+    counts = {}
+    report = []
+    try:
+        for name, sql in sorted(statements.items()):
+            entry = {"name": name, "sql": " ".join(sql.split()), "sites": sites.get(name, [])}
+            try:
+                entry['plan'] = explain(conn, sql)
+                sizes = {}
+                for alias, table in table_aliases(sql).items():
+                    if table not in counts:
+                        counts[table] = table_rows(conn, table)
+                    sizes[alias] = counts[table]
+                entry['findings'] = analyze_plan(entry['plan'], sql, sizes, min_rows)
+            except sqlite3.Error as e:
+                entry['plan'] = []
+                entry['findings'] = [("error", str(e))]
+
+            for site in entry['sites']:
+                if site['in_loop']:
+                    entry['findings'].append(("warn", f"executed once per loop iteration in {site['function']}:{site['line']}"))
+            report.append(entry)
+    finally:
+        conn.close()
+    return report
+
+# ==================== OUTPUT ====================
+
+LEVELS = {"error": 3, "warn": 2, "info": 1}
+
+def worst_level(entry):
+    return max((LEVELS[level] for level, _ in entry['findings']), default=0)
+
+def print_report(report, show_all=False):
+    """Human readable report, worst queries first"""
+    for entry in sorted(report, key=lambda e: (-worst_level(e), e['name'])):
+        if not entry['findings'] and not show_all:
+            continue
+        level = max(entry['findings'], key=lambda f: LEVELS[f[0]])[0].upper() if entry['findings'] else "OK"
+        used_by = ", ".join(f"{s['function']}:{s['line']}" for s in entry['sites']) or "no call sites"
+        print(f"[{level}] {entry['name']}  ({used_by})")
+        for depth, detail in entry['plan']:
+            print(f"    {'  ' * depth}{detail}")
+        for level, message in entry['findings']:
+            print(f"    - {level}: {message}")
+        print()
+
+    counts = defaultdict(int)
+    for entry in report:
+        for level, _ in entry['findings']:
+            counts[level] += 1
+    print(f"Audited {len(report)} queries: {counts['error']} errors, {counts['warn']} warnings, {counts['info']} notes")
+
+def main():
+    parser = argparse.ArgumentParser(description="Audit query plans for every query registered in bot.py")
+    parser.add_argument("--db", default=os.getenv("DATABASE_PATH", "superbase.db"), help="populated database to plan against")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--all", action="store_true", help="include queries with no findings")
+    parser.add_argument("--min-rows", type=int, default=1000, help="tables smaller than this only get notes for full scans")
+    parser.add_argument("--strict", action="store_true", help="exit with status 1 if any warning or error is found")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"database not found: {args.db}")
+
+    report = audit(args.db, load_registry(), args.min_rows)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, show_all=args.all)
+
+    if args.strict and any(worst_level(entry) >= LEVELS["warn"] for entry in report):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+import itertools
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# bot.py opens its database at import time, so point it at a scratch file first
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "test.db")
+
+_telegram_ids = itertools.count(900000000)
+
+@pytest.fixture(scope="session")
+def bot():
+    import bot as module
+    return module
+
+@pytest.fixture
+def user(bot):
+    """Internal id of a freshly created user"""
+    return bot.create_user(next(_telegram_ids), "tester", "Test", "User")
@@ -0,0 +1,53 @@
+import asyncio
+import os
+
+import pytest
+
+def _committed_balance(bot, user):
+    with bot.db.read() as cur:
+        return cur.execute("SELECT coin_balance FROM users WHERE user_id=?", (user,)).fetchone()[0]
+
+def test_spend_through_adb_counts_unflushed_coins(bot, user):
+    aggregator = bot.activity_aggregator
+    per_message = int(bot.catalog.config("coins_per_message", 5))
+    balance = _committed_balance(bot, user)
+
+    async def scenario():
+        for _ in range(4):
+            await bot.adb.activity.record(user)
+        assert aggregator._pending[user].coins == 4 * per_message
+        return await bot.adb.coins.spend_coins(user, balance + 3 * per_message, "test")
+
+    assert asyncio.run(scenario()) is True
+    assert user not in aggregator._pending
+    assert _committed_balance(bot, user) == per_message
+
+def test_flush_rolled_back_with_caller_keeps_batch(bot, user):
+    aggregator = bot.activity_aggregator
+    aggregator.record(user)
+    seq = aggregator.seq
+    segment = aggregator._segment(seq)
+
+    with pytest.raises(RuntimeError):
+        with bot.db.write():
+            aggregator.flush()
+            raise RuntimeError("caller rolls back")
+
+    assert os.path.exists(segment)
+    assert aggregator._pending[user].messages == 1
+    assert bot.get_user(user)['total_requests'] == 1
+
+    aggregator.flush()
+    assert not os.path.exists(segment)
+    assert user not in aggregator._pending
+    assert bot.get_user(user)['total_requests'] == 1
+
+def test_segment_removed_only_after_commit(bot, user):
+    aggregator = bot.activity_aggregator
+    aggregator.record(user)
+    segment = aggregator._segment(aggregator.seq)
+
+    with bot.db.write():
+        aggregator.flush()
+        assert os.path.exists(segment)
+    assert not os.path.exists(segment)
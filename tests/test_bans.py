@@ -0,0 +1,5 @@
+def test_ban_check_reads_bans_table(bot, user):
+    assert bot.is_banned(user) is False
+    with bot.db.write() as cur:
+        cur.execute("INSERT INTO bans (user_id, reason, created_at) VALUES (?, 'spam', 0)", (user,))
+    assert bot.is_banned(user) is True
@@ -0,0 +1,74 @@
+import itertools
+
+_telegram_ids = itertools.count(920000000)
+
+def _published(bot):
+    with bot.db.read() as cur:
+        return cur.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations").fetchone()[0]
+
+def _rows_since(bot, last_id):
+    with bot.db.read() as cur:
+        return cur.execute(
+            "SELECT key, namespace FROM cache_invalidations WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+
+def test_deletes_in_one_transaction_publish_once_per_key(bot, user):
+    key = f"user:{user}"
+    bot.cache.set(key, {"user_id": user}, 60)
+    last = _published(bot)
+    with bot.db.write():
+        bot.cache.delete(key)
+        bot.cache.delete(key)
+    assert [tuple(row) for row in _rows_since(bot, last)] == [(key, None)]
+    assert bot.cache.memory.get(key) is None
+
+def test_rolled_back_delete_publishes_nothing(bot, user):
+    last = _published(bot)
+    try:
+        with bot.db.write():
+            bot.cache.delete(f"user:{user}")
+            raise RuntimeError("roll back")
+    except RuntimeError:
+        pass
+    assert _rows_since(bot, last) == []
+    assert not bot.cache._doomed
+
+def test_activity_flush_publishes_once_per_user(bot):
+    users = [bot.create_user(next(_telegram_ids), "active", "A", "U") for _ in range(5)]
+    for user_id in users:
+        for _ in range(3):
+            bot.activity_aggregator.record(user_id)
+    last = _published(bot)
+    bot.activity_aggregator.flush()
+    # The fresh rows cached after the commit are fills and publish nothing
+    bot.cache.flush()
+    keys = sorted(row['key'] for row in _rows_since(bot, last))
+    assert keys == sorted(f"user:{user_id}" for user_id in users)
+
+def test_create_user_commits_once(bot):
+    commits = bot.db.stats['commits']
+    last = _published(bot)
+    bot.create_user(next(_telegram_ids), "fresh", "F", "U")
+    assert bot.db.stats['commits'] - commits == 1
+    assert len(_rows_since(bot, last)) == 3
+
+def test_missing_epoch_survives_concurrent_forgets(bot):
+    import threading
+    before = bot.cache.missing_token()
+
+    def forget():
+        for _ in range(2000):
+            bot.cache.forget(["missing:nobody"])
+
+    threads = [threading.Thread(target=forget) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert bot.cache.missing_token() - before == 8 * 2000
+
+def test_stale_token_does_not_record_a_miss(bot):
+    token = bot.cache.missing_token()
+    bot.cache.clear_missing("username:late")
+    bot.cache.set_missing("username:late", token)
+    assert not bot.cache.is_missing("username:late")
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+def _crashed_cache(bot, journal):
+    """A cache with unflushed writes whose process died before the next flush"""
+    cache = bot.CacheManager(codecs=bot.cache_codecs, journal_path=journal)
+    cache.set("journal:kept", {"value": 1})
+    cache.set("journal:dropped", {"value": 2})
+    cache.forget(["journal:dropped"])
+    cache.set("journal:invalidated", {"value": 3})
+    os.close(cache._journal)
+    return cache
+
+def _persisted(bot, key):
+    with bot.db.read() as cur:
+        return cur.execute("SELECT value FROM cache WHERE key=?", (key,)).fetchone()
+
+def test_recover_replays_unflushed_writes(bot):
+    journal = os.path.join(tempfile.mkdtemp(prefix="cache-journal-"), "cache")
+    crashed = _crashed_cache(bot, journal)
+    segment = crashed._segment(crashed.seq)
+    # Another process changed the data behind this key after it was cached
+    with bot.db.write() as cur:
+        cur.execute(
+            "INSERT INTO cache_invalidations (origin, key, namespace, created_at) VALUES (?, ?, NULL, ?)",
+            ("elsewhere", "journal:invalidated", int(time.time()) + 1)
+        )
+
+    restarted = bot.CacheManager(codecs=bot.cache_codecs, journal_path=journal)
+    restarted.recover()
+
+    assert restarted.get("journal:kept") == {"value": 1}
+    assert _persisted(bot, "journal:dropped") is None
+    assert _persisted(bot, "journal:invalidated") is None
+    assert not os.path.exists(segment)
+    os.close(restarted._journal)
+
+def test_segment_removed_once_flush_commits(bot):
+    journal = os.path.join(tempfile.mkdtemp(prefix="cache-journal-"), "cache")
+    cache = bot.CacheManager(codecs=bot.cache_codecs, journal_path=journal)
+    cache.set("journal:flushed", [1, 2, 3])
+    segment = cache._segment(cache.seq)
+
+    with bot.db.write():
+        cache.flush()
+        assert os.path.exists(segment)
+    assert not os.path.exists(segment)
+    assert os.path.exists(cache._segment(cache.seq))
+    os.close(cache._journal)
+
+def test_rolled_back_flush_keeps_writes_and_segment(bot):
+    journal = os.path.join(tempfile.mkdtemp(prefix="cache-journal-"), "cache")
+    cache = bot.CacheManager(codecs=bot.cache_codecs, journal_path=journal)
+    cache.set("journal:retried", "value")
+    segment = cache._segment(cache.seq)
+
+    with pytest.raises(RuntimeError):
+        with bot.db.write():
+            cache.flush()
+            raise RuntimeError("caller rolls back")
+
+    assert os.path.exists(segment)
+    assert cache.pending() == 1
+    assert cache.flush() == 1
+    assert not os.path.exists(segment)
+    os.close(cache._journal)
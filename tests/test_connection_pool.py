@@ -0,0 +1,154 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+@pytest.fixture(scope="module")
+def table(bot):
+    with bot.db.write() as cur:
+        cur.execute("CREATE TABLE IF NOT EXISTS pool_test (id INTEGER PRIMARY KEY, writer INTEGER, pair INTEGER)")
+        cur.execute("DELETE FROM pool_test")
+    return "pool_test"
+
+def test_nested_writes_are_savepoints(bot, table):
+    with bot.db.write() as cur:
+        cur.execute("INSERT INTO pool_test (writer, pair) VALUES (-1, 0)")
+        with pytest.raises(RuntimeError):
+            with bot.db.write() as inner:
+                inner.execute("INSERT INTO pool_test (writer, pair) VALUES (-1, 1)")
+                raise RuntimeError("roll back only the savepoint")
+        with bot.db.write() as inner:
+            inner.execute("INSERT INTO pool_test (writer, pair) VALUES (-1, 2)")
+
+    with bot.db.read() as cur:
+        pairs = [row['pair'] for row in cur.execute("SELECT pair FROM pool_test WHERE writer=-1 ORDER BY pair")]
+    assert pairs == [0, 2]
+
+def test_readers_run_while_writer_holds_transaction(bot, table):
+    holding = threading.Event()
+    release = threading.Event()
+
+    def writer():
+        with bot.db.write() as cur:
+            cur.execute("INSERT INTO pool_test (writer, pair) VALUES (-2, 0)")
+            holding.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        assert holding.wait(5)
+        started = time.monotonic()
+        with bot.db.read() as cur:
+            seen = cur.execute("SELECT COUNT(*) FROM pool_test WHERE writer=-2").fetchone()[0]
+        # The read neither waited for the writer nor saw its uncommitted row
+        assert time.monotonic() - started < 1
+        assert seen == 0
+    finally:
+        release.set()
+        thread.join()
+
+    with bot.db.read() as cur:
+        assert cur.execute("SELECT COUNT(*) FROM pool_test WHERE writer=-2").fetchone()[0] == 1
+
+def test_parallel_readers_and_serialized_writers(bot, table):
+    writers, rounds, readers = 4, 100, 8
+    errors = []
+    stop = threading.Event()
+    connections = {}
+
+    def write(writer_id):
+        try:
+            for i in range(rounds):
+                # Each round commits a pair of rows, the second in a savepoint,
+                # plus a savepoint that is rolled back
+                with bot.db.write() as cur:
+                    cur.execute("INSERT INTO pool_test (writer, pair) VALUES (?, ?)", (writer_id, i))
+                    with bot.db.write() as inner:
+                        inner.execute("INSERT INTO pool_test (writer, pair) VALUES (?, ?)", (writer_id, i))
+                    try:
+                        with bot.db.write() as inner:
+                            inner.execute("INSERT INTO pool_test (writer, pair) VALUES (?, ?)", (writer_id, -i - 1))
+                            raise ValueError
+                    except ValueError:
+                        pass
+        except Exception as e:
+            errors.append(e)
+
+    def read(reader_id):
+        try:
+            while not stop.is_set():
+                with bot.db.read() as cur:
+                    connections[reader_id] = cur.connection
+                    rows = cur.execute(
+                        "SELECT writer, pair, COUNT(*) AS n FROM pool_test WHERE writer >= 0 GROUP BY writer, pair"
+                    ).fetchall()
+                    # A reader's own query returns its own result set
+                    marker = cur.execute("SELECT ?", (reader_id,)).fetchone()[0]
+                assert marker == reader_id
+                for row in rows:
+                    # Only whole pairs are ever visible, never a rolled-back row
+                    assert row['n'] == 2 and row['pair'] >= 0, dict(row)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read, args=(r,)) for r in range(readers)]
+    threads += [threading.Thread(target=write, args=(w,)) for w in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads[readers:]:
+        thread.join()
+    stop.set()
+    for thread in threads[:readers]:
+        thread.join()
+
+    assert not errors, errors
+    # Concurrent readers each held their own connection, never the writer's
+    assert bot.db._writer not in connections.values()
+    with bot.db.read() as cur:
+        count = cur.execute("SELECT COUNT(*) FROM pool_test WHERE writer >= 0").fetchone()[0]
+    assert count == writers * rounds * 2
+
+def test_backup_leaves_out_open_write_transaction(bot, table, tmp_path):
+    db = bot.db
+    target = str(tmp_path / "backup.db")
+    with db.write() as cur:
+        cur.execute("INSERT INTO pool_test (writer, pair) VALUES (-3, 0)")
+        db.backup(target)
+    snapshot = sqlite3.connect(target)
+    try:
+        rows = snapshot.execute("SELECT COUNT(*) FROM pool_test WHERE writer=-3").fetchone()[0]
+    finally:
+        snapshot.close()
+    assert rows == 0
+
+def test_after_commit_hooks_follow_the_outer_transaction(bot):
+    events = []
+    with bot.db.write():
+        bot.db.after_commit(lambda: events.append("kept"), lambda: events.append("never"))
+        with pytest.raises(RuntimeError):
+            with bot.db.write():
+                bot.db.after_commit(lambda: events.append("never"), lambda: events.append("undone"))
+                raise RuntimeError("roll back the savepoint")
+        assert events == ["undone"]
+    assert events == ["undone", "kept"]
+
+def test_in_memory_database_is_rejected(bot):
+    with pytest.raises(ValueError):
+        bot.ConnectionPool(":memory:")
+
+def test_read_stats_are_not_lost_across_threads(bot):
+    before = bot.db.stats['reads']
+
+    def read():
+        for _ in range(500):
+            with bot.db.read():
+                pass
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert bot.db.stats['reads'] - before == 8 * 500
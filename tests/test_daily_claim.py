@@ -0,0 +1,52 @@
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+CLAIMERS = 1000
+
+def test_concurrent_claims_pay_out_once(bot, user, monkeypatch):
+    # Bypass the in-memory "already claimed" guard so every thread reaches the UPSERT
+    memory_get = bot.cache.memory.get
+    monkeypatch.setattr(bot.cache.memory, "get", lambda key: None if key.startswith("claim:") else memory_get(key))
+
+    barrier = threading.Barrier(CLAIMERS)
+    results = []
+    errors = []
+
+    def claim():
+        try:
+            barrier.wait()
+            results.append(bot.coin_manager.daily_claim(user)[0])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=claim) for _ in range(CLAIMERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors[:3]
+    assert results.count(True) == 1
+    assert results.count(False) == CLAIMERS - 1
+    with bot.db.read() as cur:
+        payouts = cur.execute(
+            "SELECT COUNT(*) FROM coin_transactions WHERE user_id=? AND reason LIKE 'daily_claim%'", (user,)
+        ).fetchone()[0]
+    assert payouts == 1
+
+def test_claim_again_same_day_is_refused(bot, user):
+    claimed, first = bot.coin_manager.daily_claim(user)
+    assert claimed and first["streak"] == 1
+    claimed, again = bot.coin_manager.daily_claim(user)
+    assert not claimed and again["next_claim"] == first["next_claim"]
+
+def test_claim_day_follows_timezone_across_dst(bot, monkeypatch):
+    tz = ZoneInfo("America/New_York")
+    monkeypatch.setattr(bot, "DAILY_CLAIM_TZ", tz)
+    noon = int(datetime(2026, 11, 1, 12, tzinfo=tz).timestamp())
+    day, start, end = bot.claim_day(noon)
+    assert str(day) == "2026-11-01"
+    assert start == int(datetime(2026, 11, 1, tzinfo=tz).timestamp())
+    # Clocks fall back that night, so the day is 25 hours long
+    assert end - start == 25 * 3600
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+import time
+
+
+def test_lone_write_does_not_wait_for_the_window(bot):
+    executor = bot.DbExecutor(durability="group", window_ms=500)
+
+    async def scenario():
+        started = time.perf_counter()
+        await executor.write(lambda: None)
+        return time.perf_counter() - started
+
+    try:
+        assert asyncio.run(scenario()) < 0.25
+    finally:
+        executor.close()
+
+def test_queued_writes_share_a_commit(bot):
+    executor = bot.DbExecutor(durability="group", window_ms=500)
+
+    def slow():
+        time.sleep(0.001)
+
+    async def scenario():
+        await asyncio.gather(*(executor.write(slow) for _ in range(100)))
+
+    try:
+        asyncio.run(scenario())
+        assert executor.stats['jobs'] == 100
+        assert executor.stats['batches'] < 50
+    finally:
+        executor.close()
+
+def test_admin_stats_run_off_the_event_loop(bot):
+    loop_thread = None
+
+    def storage():
+        return threading.get_ident()
+
+    async def scenario():
+        nonlocal loop_thread
+        loop_thread = threading.get_ident()
+        stats = bot.AsyncManager(bot.SimpleNamespace(storage=storage), bot.db_executor)
+        return await stats.storage(), await bot.adb.stats.storage(), await bot.adb.stats.subsystems()
+
+    worker_thread, storage_view, subsystems = asyncio.run(scenario())
+    assert worker_thread != loop_thread
+    assert 'db_bytes' in storage_view
+    assert 'activity' not in storage_view
+    assert set(subsystems) == {'archive', 'single_flight', 'conversation_memory', 'catalog', 'activity'}
@@ -0,0 +1,36 @@
+def _levels(bot, user):
+    with bot.db.read() as cur:
+        row = cur.execute("SELECT level, xp, next_level_xp FROM user_levels WHERE user_id=?", (user,)).fetchone()
+    return tuple(row)
+
+def _set_levels(bot, user, total_xp):
+    with bot.db.write() as cur:
+        cur.execute(
+            "INSERT INTO user_levels (user_id, level, xp, total_xp, next_level_xp) VALUES (?, 9, 9, ?, 9) "
+            "ON CONFLICT(user_id) DO UPDATE SET level=9, xp=9, total_xp=excluded.total_xp, next_level_xp=9",
+            (user, total_xp)
+        )
+
+def test_resolve_matches_per_level_loop(bot):
+    curve = bot.LevelCurve(100, 1.5)
+    for total_xp in (0, 99, 100, 101, 249, 250, 10 ** 6):
+        level, need, remaining = 1, 100, total_xp
+        while remaining >= need:
+            remaining -= need
+            level += 1
+            need = int(need * 1.5)
+        assert curve.resolve(total_xp) == (level, remaining, need)
+
+def test_recompute_all_relevels_from_total_xp(bot, user):
+    curve = bot.level_curve
+    _set_levels(bot, user, curve.thresholds[3] + 7)
+    with bot.db.write() as cur:
+        assert curve.recompute_all(cur) >= 1
+    assert _levels(bot, user) == curve.resolve(curve.thresholds[3] + 7)
+
+def test_recompute_all_treats_null_total_xp_as_zero(bot, user):
+    curve = bot.level_curve
+    _set_levels(bot, user, None)
+    with bot.db.write() as cur:
+        curve.recompute_all(cur)
+    assert _levels(bot, user) == curve.resolve(0)
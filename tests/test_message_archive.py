@@ -0,0 +1,94 @@
+import itertools
+import time
+
+import pytest
+
+DAY = 86400
+_telegram_ids = itertools.count(910000000)
+
+@pytest.fixture
+def archive(bot, tmp_path, monkeypatch):
+    archive = bot.MessageArchive(str(tmp_path / "archive"))
+    monkeypatch.setattr(bot, "message_archive", archive)
+    yield archive
+    archive.close()
+
+def _session(bot):
+    a, b = (bot.create_user(next(_telegram_ids), "archived", "A", "B") for _ in range(2))
+    return bot.direct_chat.create_session(a, b), a
+
+def _insert(bot, session_id, sender, ages_in_days):
+    with bot.db.write() as cur:
+        for age in ages_in_days:
+            cur.execute(
+                "INSERT INTO chat_messages (session_id, from_user, message, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, sender, f"aged {age}", int(time.time()) - age * DAY)
+            )
+
+def _archive_all(bot, archive):
+    archiver = bot.MessageArchiver(archive, 30, 3600, 500)
+    archiver.archive_table("chat_messages", int(time.time()) - 30 * DAY)
+
+def _walk(bot, archive, session_id, limit=5):
+    """archive_reads spent on each page, newest page first"""
+    reads, before_id = [], None
+    while True:
+        started = archive.stats['archive_reads']
+        page = bot.history_page("chat_messages", session_id, limit, before_id=before_id)
+        reads.append(archive.stats['archive_reads'] - started)
+        before_id = page['before_id']
+        if before_id is None:
+            return reads
+
+def test_pages_do_not_scan_other_conversations_months(bot, archive):
+    # 24 months of archived traffic in another conversation
+    other, other_sender = _session(bot)
+    _insert(bot, other, other_sender, [40 + 31 * month for month in range(24)])
+    # A short hot history with a few archived messages from two months
+    session_id, sender = _session(bot)
+    _insert(bot, session_id, sender, [400, 399, 398, 45, 44, 43, 2, 1, 0])
+    _archive_all(bot, archive)
+    assert len(archive.months()) >= 24
+
+    reads = _walk(bot, archive, session_id)
+    # Each page opens at most the months of this conversation it needs
+    assert reads and max(reads) <= 2
+    assert sum(reads) <= 4
+
+def test_conversation_without_archive_never_reads_it(bot, archive):
+    other, other_sender = _session(bot)
+    _insert(bot, other, other_sender, [40 + 31 * month for month in range(12)])
+    _archive_all(bot, archive)
+
+    session_id, sender = _session(bot)
+    _insert(bot, session_id, sender, [2, 1, 0])
+    assert _walk(bot, archive, session_id) == [0]
+
+def test_history_survives_archiving(bot, archive):
+    session_id, sender = _session(bot)
+    _insert(bot, session_id, sender, [400, 90, 60, 5, 0])
+    _archive_all(bot, archive)
+
+    texts, before_id = [], None
+    while True:
+        page = bot.history_page("chat_messages", session_id, 2, before_id=before_id)
+        texts = [m['message'] for m in page['messages']] + texts
+        before_id = page['before_id']
+        if before_id is None:
+            break
+    assert texts == ["aged 400", "aged 90", "aged 60", "aged 5", "aged 0"]
+
+def test_zero_cursor_is_a_cursor(bot, archive):
+    session_id, sender = _session(bot)
+    _insert(bot, session_id, sender, [1, 0])
+    assert bot.read_history("chat_messages", session_id, 10, before_id=0) == []
+
+def test_backfill_indexes_existing_month_files(bot, archive):
+    session_id, sender = _session(bot)
+    _insert(bot, session_id, sender, [90, 60, 0])
+    _archive_all(bot, archive)
+    with bot.db.write() as cur:
+        cur.execute("DELETE FROM message_archive_index")
+
+    assert archive.backfill_index() == len(archive.months())
+    assert len(bot.read_history("chat_messages", session_id, 10)) == 3
@@ -0,0 +1,47 @@
+import os
+
+
+def _pool(bot, tmp_path, **tuning):
+    profile = bot.StorageProfile(checkpoint_interval=3600, **tuning)
+    pool = bot.ConnectionPool(str(tmp_path / "wal.db"), 2, profile)
+    with pool.write() as cur:
+        cur.execute("CREATE TABLE t (payload BLOB)")
+    return pool
+
+def _fill(pool, rows=200):
+    with pool.write() as cur:
+        cur.executemany("INSERT INTO t VALUES (?)", [(os.urandom(4096),) for _ in range(rows)])
+
+def test_large_wal_restarts_and_is_trimmed(bot, tmp_path):
+    pool = _pool(bot, tmp_path, checkpoint_restart_bytes=0, journal_size_limit=0)
+    checkpointer = bot.WalCheckpointer(pool)
+    checkpointer.start()
+    try:
+        _fill(pool)
+        grown = checkpointer.wal_size()
+        checkpointer.run_once()
+        assert checkpointer.stats['restarts'] == 1
+        # The next commit starts the WAL over and journal_size_limit trims it
+        _fill(pool, 1)
+        assert checkpointer.wal_size() < grown
+    finally:
+        checkpointer.stop()
+        pool.close()
+
+def test_restart_gives_up_behind_a_reader(bot, tmp_path):
+    pool = _pool(bot, tmp_path, checkpoint_restart_bytes=0, checkpoint_busy_timeout=10)
+    checkpointer = bot.WalCheckpointer(pool)
+    checkpointer.start()
+    try:
+        _fill(pool)
+        with pool.read() as cur:
+            cur.execute("BEGIN")
+            cur.execute("SELECT COUNT(*) FROM t").fetchone()
+            _fill(pool, 1)
+            checkpointer.run_once()
+            cur.execute("COMMIT")
+        assert checkpointer.stats['busy'] == 1
+        assert checkpointer.stats['last_duration_ms'] < 1000
+    finally:
+        checkpointer.stop()
+        pool.close()